@@ -23,16 +23,29 @@
 # SOFTWARE.
 
 
+import concurrent.futures
+import hashlib
+import io
 import json
+import logging
 import os
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
 import textwrap
+import time
 import unittest
 
 from patches_constants import PATCHES_DIR
 from patches_constants import HEADERS
 
+PROOFS_DIR = os.path.abspath(os.path.join(PATCHES_DIR, "..", "proofs"))
+sys.path.append(PROOFS_DIR)
+
+from proof_index import ProofIndex
+
 
 DEFINE_REGEX_MAKEFILE = re.compile(r"(?:['\"])?([\w]+)")
 DEFINE_REGEX_HEADER = re.compile(r"\s*#\s*define\s*([\w]+)")
@@ -55,65 +68,158 @@ def find_all_defines():
     """Collects all define values in Makefile.json.
 
        Some of the Makefiles use # in the json to make comments.
-       As this is non standard json, we need to remove the comment
+       As this is non standard json, the proof index removes the comment
        lines before parsing. Then we extract all defines from the file.
     """
     defines = set()
 
-    proof_dir = os.path.abspath(os.path.join(PATCHES_DIR, "..", "proofs"))
+    index = ProofIndex(PROOFS_DIR)
 
-    for fldr, _, fyles in os.walk(proof_dir):
+    for fldr, fyles in index.walk():
         if "Makefile.json" in fyles:
-            file = os.path.join(fldr, "Makefile.json")
+            file = "Makefile.json"
             key = "DEF"
         elif "MakefileCommon.json" in fyles:
-            file = os.path.join(fldr, "MakefileCommon.json")
+            file = "MakefileCommon.json"
             key = "DEF "
         else:
             continue
-        with open(file, "r") as source:
-            content = "".join([line for line in source
-                               if line and not line.strip().startswith("#")])
-            makefile = json.loads(content)
-            if key in makefile.keys():
-                """This regex parses the define declaration in Makefile.json
-                   'macro(x)=false' is an example for a declaration.
-                   'macro' is expected to be matched.
-                """
-                for define in makefile[key]:
-                    matched = DEFINE_REGEX_MAKEFILE.match(define)
-                    if matched:
-                        defines.add(matched.group(1))
+        makefile = index.json(fldr, file)
+        if key in makefile.keys():
+            """This regex parses the define declaration in Makefile.json
+               'macro(x)=false' is an example for a declaration.
+               'macro' is expected to be matched.
+            """
+            for define in makefile[key]:
+                matched = DEFINE_REGEX_MAKEFILE.match(define)
+                if matched:
+                    defines.add(matched.group(1))
     return defines
 
+def header_regex(defines):
+    """Compiles a regex matching the definition of any of the defines.
+
+       The name of the matched define is the group "target".
+    """
+    if not defines:
+        # A regex that never matches
+        return re.compile(r"(?!)")
+    names = "|".join(re.escape(define)
+                     for define in sorted(defines, key=len, reverse=True))
+    return re.compile(r"\s*#\s*define\s*(?P<target>{})(?!\w)".format(names))
+
+
+def stream_headerfile(regex, source, output):
+    """Copies source to output, wrapping defines matched by regex in an ifndef.
+
+       Returns True if any define was wrapped.
+    """
+    modified = False
+    last = ""
+    for line in source:
+        match = regex.match(line)
+        if match and not last.lstrip().startswith("#ifndef"):
+            full_def = line
+            # this loop deals with multiline definitions
+            while line.rstrip().endswith("\\"):
+                line = next(source)
+                full_def += line
+            # indentation for multiline definitions can be improved
+            output.write(textwrap.dedent("""\
+                #ifndef {target}
+                    {original}\
+                #endif
+                """.format(target=match.group("target"), original=full_def)))
+            modified = True
+        else:
+            output.write(line)
+        last = line
+    return modified
+
+
+def patch_headerfile(regex, header_file):
+    """Wraps all defines matched by regex in an ifndef.
+
+       The patched header is written to a temporary file that replaces
+       the header, so an interrupted run never leaves a truncated header.
+       The header is left untouched if no define needs to be wrapped.
+       Returns True if the header was modified.
+    """
+    directory, name = os.path.split(header_file)
+    handle, tmp = tempfile.mkstemp(dir=directory, prefix="." + name)
+    try:
+        with open(header_file, "r") as source, \
+                os.fdopen(handle, "w") as output:
+            modified = stream_headerfile(regex, source, output)
+        if modified:
+            shutil.copymode(header_file, tmp)
+            os.replace(tmp, header_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return modified
+
+
 def manipulate_headerfile(defines, header_file):
     """Wraps all defines used in an ifndef."""
+    patch_headerfile(header_regex(defines), header_file)
+
+
+PATCHED_HEADERS = os.path.join(PATCHES_DIR, ".patched_headers.json")
 
-    # This regex matches the actual define in the header file.
-    modified_content = ""
-    with open(header_file, "r") as source:
-        last = ""
-        for line in source:
-            match = DEFINE_REGEX_HEADER.match(line)
-            if (match and
-                    match.group(1) in defines and
-                    not last.lstrip().startswith("#ifndef")):
-                full_def = line
-                # this loop deals with multiline definitions
-                while line.rstrip().endswith("\\"):
-                    line = next(source)
-                    full_def += line
-                # indentation for multiline definitions can be improved
-                modified_content += textwrap.dedent("""\
-                    #ifndef {target}
-                        {original}\
-                    #endif
-                    """.format(target=match.group(1), original=full_def))
-            else:
-                modified_content += line
-            last = line
-    with open(header_file, "w") as output:
-        output.write(modified_content)
+
+def file_digest(file):
+    digest = hashlib.sha256()
+    with open(file, "rb") as source:
+        for block in iter(lambda: source.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def patch_headerfiles(defines, header_files, jobs=None):
+    """Wraps all defines used in an ifndef in several headers concurrently.
+
+       A single regex is compiled for the defines and shared by all
+       headers, and the headers are patched in a thread pool. The hash
+       of each patched header is recorded in PATCHED_HEADERS together
+       with a hash of the defines, and a header whose content still
+       has the recorded hash is skipped without being read again.
+       Returns a dict mapping each header to its status and the time
+       spent on it in seconds.
+    """
+    regex = header_regex(defines)
+    defines_digest = hashlib.sha256(
+        "\n".join(sorted(defines)).encode()).hexdigest()
+    try:
+        with open(PATCHED_HEADERS) as state_file:
+            state = json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        state = {}
+
+    def patch_one(header_file):
+        start = time.perf_counter()
+        recorded = state.get(header_file)
+        digest = file_digest(header_file)
+        if recorded == {"defines": defines_digest, "sha256": digest}:
+            status = "skipped"
+        else:
+            status = ("patched" if patch_headerfile(regex, header_file)
+                      else "unchanged")
+            digest = file_digest(header_file)
+        return (header_file, status, digest, time.perf_counter() - start)
+
+    report = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for header_file, status, digest, seconds in pool.map(patch_one,
+                                                             header_files):
+            state[header_file] = {"defines": defines_digest, "sha256": digest}
+            report[header_file] = {"status": status, "seconds": seconds}
+            logging.info("%s %s in %.3fs", status, header_file, seconds)
+
+    with open(PATCHED_HEADERS + ".tmp", "w") as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(PATCHED_HEADERS + ".tmp", PATCHED_HEADERS)
+    return report
 
 
 def header_dirty(header_files):
@@ -237,5 +343,40 @@ class TestDefineRegexes(unittest.TestCase):
         self.assertEqual(match2.group(1), "ipconfigMAX_ARP_RETRANSMISSIONS")
         self.assertEqual(match3.group(1), "ipconfigINCLUDE_FULL_INET_ADDR")
 
+    def test_define_set_regex(self):
+        regex = header_regex({"configASSERT", "ipconfigMAX_ARP_AGE"})
+        input1 = "#define configASSERT( x )    if( ( x ) == 0 )"
+        input2 = "  #  define ipconfigMAX_ARP_AGE 150"
+        input3 = "#define ipconfigMAX_ARP_AGE_LIMIT 150"
+        input4 = "#define ipconfigMAX_ARP_RETRANSMISSIONS ( 5 )"
+
+        self.assertEqual(regex.match(input1).group("target"), "configASSERT")
+        self.assertEqual(regex.match(input2).group("target"),
+                         "ipconfigMAX_ARP_AGE")
+        self.assertIsNone(regex.match(input3))
+        self.assertIsNone(regex.match(input4))
+        self.assertIsNone(header_regex(set()).match(input1))
+
+    def test_stream_headerfile(self):
+        regex = header_regex({"A", "B"})
+        source = iter(["#define A 1\n",
+                       "#ifndef B\n",
+                       "#define B 2\n",
+                       "#endif\n",
+                       "#define C \\\n",
+                       "    3\n"])
+        output = io.StringIO()
+
+        self.assertTrue(stream_headerfile(regex, source, output))
+        self.assertEqual(output.getvalue(),
+                         "#ifndef A\n"
+                         "    #define A 1\n"
+                         "#endif\n"
+                         "#ifndef B\n"
+                         "#define B 2\n"
+                         "#endif\n"
+                         "#define C \\\n"
+                         "    3\n")
+
 if __name__ == '__main__':
     create_patches(HEADERS)
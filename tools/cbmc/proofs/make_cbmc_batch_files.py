@@ -26,9 +26,11 @@ import os
 import platform
 import subprocess
 
+from proof_index import ProofIndex
+
 
 def remove_cbmc_yaml_files():
-    for dyr, _, files in os.walk("."):
+    for dyr, files in ProofIndex(".").walk():
         cbmc_batch_files = [os.path.join(os.path.abspath(dyr), file)
                             for file in files if file == "cbmc-batch.yaml"]
         for file in cbmc_batch_files:
@@ -39,7 +41,7 @@ def create_cbmc_yaml_files():
     # The YAML files are only used by CI and are not needed on Windows.
     if platform.system() == "Windows":
         return
-    for dyr, _, files in os.walk("."):
+    for dyr, files in ProofIndex(".").walk():
         harness = [file for file in files if file.endswith("_harness.c")]
         if harness and "Makefile" in files:
             subprocess.run(["make", "cbmc-batch.yaml"],
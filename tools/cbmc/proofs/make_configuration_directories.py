@@ -22,7 +22,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import argparse
 import collections
+import concurrent.futures
 import json
 import logging
 import os
@@ -31,6 +33,7 @@ import shutil
 import textwrap
 
 from make_proof_makefiles import load_json_config_file
+from proof_index import ProofIndex
 
 LOGGER = logging.getLogger("ComputeConfigurations")
 
@@ -94,17 +97,32 @@ def prolog():
 
         These Makefile.json files then can be turned into Makefiles for running
         the proof by executing the make-proof-makefiles.py script.
+
+        The harness is hard-linked rather than copied where possible, files
+        whose content is unchanged are not rewritten, and config_
+        subdirectories that no longer appear in Configurations.json are
+        removed.
         """)
 
 
-def process(folder, files):
-    json_content = load_json_config_file(os.path.join(folder,
-                                                      "Configurations.json"))
+def configurations(folder, files, json_content):
+    """Compute the configuration directories to create for folder.
+
+    Returns a list of (directory, harnesses, Makefile.json content)
+    tuples, where harnesses is a list of (source, destination) pairs,
+    or None if the Configurations.json file is malformed.
+    """
     try:
         def_list = json_content["DEF"]
     except KeyError:
         LOGGER.error("Expected DEF as key in a Configurations.json files.")
-        return
+        return None
+    harnesses = [file for file in files if file.endswith("harness.c")]
+    if not harnesses:
+        LOGGER.error("Could not find a harness in folder %s.", folder)
+        LOGGER.error("This folder is not processed do the end!")
+        return None
+    tasks = []
     for config in def_list:
         logging.debug(config)
         try:
@@ -124,20 +142,8 @@ def process(folder, files):
             ]
                 """))
             LOGGER.error("The offending entry is %s", config)
-            return
+            return None
         new_config_folder = os.path.join(folder, "config_" + configname)
-        pathlib.Path(new_config_folder).mkdir(exist_ok=True, parents=True)
-        harness_copied = False
-        for file in files:
-            if file.endswith("harness.c"):
-                shutil.copy(os.path.join(folder, file),
-                            os.path.join(new_config_folder, file))
-                harness_copied = True
-
-        if not harness_copied:
-            LOGGER.error("Could not find a harness in folder %s.", folder)
-            LOGGER.error("This folder is not processed do the end!")
-            return
         # The order of keys must be maintained as otherwise the
         # make_proof_makefiles script might fail.
         current_config = collections.OrderedDict(json_content)
@@ -146,18 +152,111 @@ def process(folder, files):
             current_config["EXPECTED"] = config["EXPECTED"]
         else:
             current_config["EXPECTED"] = True
-        with open(os.path.join(new_config_folder, "Makefile.json"),
-                  "w") as output_file:
-            json.dump(current_config, output_file, indent=2)
+        tasks.append((new_config_folder,
+                      [(os.path.join(folder, file),
+                        os.path.join(new_config_folder, file))
+                       for file in harnesses],
+                      json.dumps(current_config, indent=2)))
+    return tasks
+
+
+def link_harness(source, destination):
+    """Hard-link the harness into a configuration directory.
+
+    The harness is copied instead if it cannot be linked, for example
+    across file systems.
+    """
+    try:
+        if os.path.samefile(source, destination):
+            return
+    except FileNotFoundError:
+        pass
+    tmp = destination + ".tmp"
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copy(source, tmp)
+    os.replace(tmp, destination)
+
 
+def write_if_changed(file, content):
+    """Write content to file unless the file already holds it."""
+    try:
+        with open(file) as handle:
+            if handle.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(file, "w") as handle:
+        handle.write(content)
+    return True
+
+
+def expand(task):
+    """Create one configuration directory."""
+    new_config_folder, harnesses, makefile_json = task
+    pathlib.Path(new_config_folder).mkdir(exist_ok=True, parents=True)
+    for source, destination in harnesses:
+        link_harness(source, destination)
+    write_if_changed(os.path.join(new_config_folder, "Makefile.json"),
+                     makefile_json)
+
+
+def prune(folder, tasks):
+    """Remove configuration directories no longer in Configurations.json."""
+    current = {os.path.basename(task[0]) for task in tasks}
+    for entry in os.scandir(folder):
+        if (entry.is_dir() and entry.name.startswith("config_") and
+                entry.name not in current):
+            LOGGER.info("Removing stale configuration %s", entry.path)
+            shutil.rmtree(entry.path)
+
+
+def process(folder, files, json_content=None):
+    if json_content is None:
+        json_content = load_json_config_file(
+            os.path.join(folder, "Configurations.json"))
+    tasks = configurations(folder, files, json_content)
+    if tasks is None:
+        return
+    for task in tasks:
+        expand(task)
+    prune(folder, tasks)
+
+
+def main(jobs=1):
+    """Expand every Configurations.json below the current directory.
+
+    With more than one job, the configuration directories of all
+    folders are created in a process pool.
+    """
+    index = ProofIndex(".")
+    folders = [(fldr, fyles) for fldr, fyles in index.walk()
+               if "Configurations.json" in fyles]
+    if jobs <= 1:
+        for fldr, fyles in folders:
+            process(fldr, fyles, index.json(fldr, "Configurations.json"))
+        return
 
-def main():
-    for fldr, _, fyles in os.walk("."):
-        if "Configurations.json" in fyles:
-            process(fldr, fyles)
+    expansions = []
+    for fldr, fyles in folders:
+        tasks = configurations(fldr, fyles,
+                               index.json(fldr, "Configurations.json"))
+        if tasks is not None:
+            expansions.append((fldr, tasks))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(expand, [task for _, tasks in expansions
+                               for task in tasks]))
+    for fldr, tasks in expansions:
+        prune(fldr, tasks)
 
 
 if __name__ == '__main__':
     logging.basicConfig(format="{script}: %(levelname)s %(message)s".format(
         script=os.path.basename(__file__)))
-    main()
+    parser = argparse.ArgumentParser(
+        description=prolog(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes expanding configurations")
+    main(parser.parse_args().jobs)
@@ -26,6 +26,7 @@
 import argparse
 import ast
 import collections
+import hashlib
 import json
 import logging
 import operator
@@ -35,6 +36,7 @@ import platform
 import re
 import sys
 import textwrap
+import time
 import traceback
 
 
@@ -130,6 +132,12 @@ def prolog():
         as a Makefile called "Makefile.common", which contains the actual Make
         rules. The final line of each of the generated Makefiles will be an
         include statement, including Makefile.common.
+
+        With --incremental, a fingerprint of each Makefile.json, of
+        MakefileCommon.json, and of the platform is recorded in
+        ".makefile_fingerprints.json". Directories whose fingerprint is
+        unchanged are skipped, and Makefiles whose content is unchanged are
+        never rewritten, so their modification times stay stable.
     """)
 
 def load_json_config_file(file):
@@ -148,6 +156,7 @@ def load_json_config_file(file):
 
 
 def dump_makefile(dyr, system):
+    """Write the Makefile for dyr, unless its content is unchanged."""
     data = load_json_config_file(os.path.join(dyr, "Makefile.json"))
 
     makefile = collections.OrderedDict()
@@ -161,15 +170,7 @@ def dump_makefile(dyr, system):
     makefile["OBJS_EXCEPT_HARNESS"] = " ".join(
         o for o in data["OBJS"] if not o.endswith("_harness.goto"))
 
-    so_far = collections.OrderedDict()
-    for name, value in data.items():
-        if isinstance(value, list):
-            new_value = []
-            for item in value:
-                new_value.append(compute(item, so_far, system, name, dyr, True))
-            makefile[name] = " ".join(new_value)
-        else:
-            makefile[name] = compute(value, so_far, system, name, dyr)
+    makefile.update(evaluate_makefile_json(data, system, dyr))
 
     if (("EXPECTED" not in makefile.keys()) or
             str(makefile["EXPECTED"]).lower() == "true"):
@@ -183,13 +184,72 @@ def dump_makefile(dyr, system):
     common_dir_path = "..%s" % _platform_choices[system]["path-sep"]
     common_dir_path = common_dir_path * len(dyr.split(os.path.sep)[1:])
 
-    with open(os.path.join(dyr, "Makefile"), "w") as handle:
-        handle.write(("""{contents}
+    contents = ("""{contents}
 
 {include} {common_dir_path}Makefile.common""").format(
-            contents="\n".join(makefile),
-            include=_platform_choices[system]["makefile-inc"],
-            common_dir_path=common_dir_path))
+        contents="\n".join(makefile),
+        include=_platform_choices[system]["makefile-inc"],
+        common_dir_path=common_dir_path)
+
+    try:
+        with open(os.path.join(dyr, "Makefile")) as handle:
+            if handle.read() == contents:
+                logging.info("Makefile in %s is unchanged", dyr)
+                return
+    except FileNotFoundError:
+        pass
+    with open(os.path.join(dyr, "Makefile"), "w") as handle:
+        handle.write(contents)
+
+
+# ______________________________________________________________________________
+# Incremental generation
+# ``````````````````````````````````````````````````````````````````````````````
+
+FINGERPRINTS_FILE = ".makefile_fingerprints.json"
+
+
+def hash_file(digest, file):
+    try:
+        with open(file, "rb") as handle:
+            digest.update(handle.read())
+    except FileNotFoundError:
+        pass
+
+
+def common_fingerprint(system):
+    """Fingerprint of the inputs shared by all Makefiles.
+
+    This covers MakefileCommon.json, the platform, and this script
+    itself, so that changing how Makefiles are generated regenerates
+    all of them.
+    """
+    digest = hashlib.sha256()
+    digest.update(system.encode())
+    hash_file(digest, "MakefileCommon.json")
+    hash_file(digest, os.path.abspath(__file__))
+    return digest.hexdigest()
+
+
+def fingerprint(dyr, common):
+    digest = hashlib.sha256(common.encode())
+    hash_file(digest, os.path.join(dyr, "Makefile.json"))
+    return digest.hexdigest()
+
+
+def load_fingerprints():
+    try:
+        with open(FINGERPRINTS_FILE) as handle:
+            return json.load(handle)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def save_fingerprints(fingerprints):
+    tmp = FINGERPRINTS_FILE + ".tmp"
+    with open(tmp, "w") as handle:
+        json.dump(fingerprints, handle, indent=2, sort_keys=True)
+    os.replace(tmp, FINGERPRINTS_FILE)
 
 
 def compute(value, so_far, system, key, harness, appending=False):
@@ -248,12 +308,117 @@ def compute(value, so_far, system, key, harness, appending=False):
     return final_value
 
 
+class ExprError(Exception):
+    """An expression that cannot be evaluated"""
+
+
+_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    # Use floordiv (i.e. //) so that we never need to
+    # cast to an int
+    ast.Div: operator.floordiv,
+}
+
+_VALID_CALLS = {
+    "max": max,
+    "min": min,
+}
+
+# Evaluator closures, memoized by expression text. Variables are
+# substituted into an expression before it is evaluated, so the text
+# of an expression includes the values of the variables it uses.
+_compiled_exprs = {}
+
+EVAL_STATS = collections.Counter()
+
+
+def _operator(node):
+    try:
+        return _OPERATORS[type(node)]
+    except KeyError:
+        raise ExprError("there was expression that was impossible to "
+                        "evaluate")
+
+
+def _compile_node(node):
+    """Compile an expression tree into a closure that evaluates it"""
+    logging.debug(node)
+    if isinstance(node, ast_num):
+        number = node.n
+        return lambda: number
+    # We're only doing IfExp, which is Python's ternary operator
+    # (i.e. it's an expression). NOT If, which is a statement.
+    if isinstance(node, ast.IfExp):
+        test = _compile_node(node.test)
+        body = _compile_node(node.body)
+        orelse = _compile_node(node.orelse)
+
+        def if_exp():
+            # Let's be strict and only allow actual booleans in the guard
+            guard = test()
+            if guard is not True and guard is not False:
+                raise ExprError("there was an invalid guard for an if "
+                                "statement.")
+            return body() if guard else orelse()
+        return if_exp
+    if isinstance(node, ast.Compare):
+        left = _compile_node(node.left)
+        # Don't allow expressions like (a < b) < c
+        right = _compile_node(node.comparators[0])
+        op = _operator(node.ops[0])
+        return lambda: op(left(), right())
+    if isinstance(node, ast.BinOp):
+        left = _compile_node(node.left)
+        right = _compile_node(node.right)
+        op = _operator(node.op)
+        return lambda: op(left(), right())
+    if isinstance(node, ast.Call):
+        name = getattr(node.func, "id", None)
+        if name not in _VALID_CALLS:
+            raise ExprError("there was an invalid call to %s()" % name)
+        call = _VALID_CALLS[name]
+        left = _compile_node(node.args[0])
+        right = _compile_node(node.args[1])
+        return lambda: call(left(), right())
+    raise ExprError("there was expression that was impossible to evaluate")
+
+
+def compile_expr(expr_string):
+    """
+    Compile a purely arithmetic expression into an evaluator closure
+
+    Raises SyntaxError for an invalid expression and ExprError for an
+    expression outside of the restricted language.
+    """
+    try:
+        evaluator = _compiled_exprs[expr_string]
+        EVAL_STATS["cache hits"] += 1
+        return evaluator
+    except KeyError:
+        pass
+    tree = ast.parse(expr_string, mode="eval").body
+    evaluator = _compile_node(tree)
+    _compiled_exprs[expr_string] = evaluator
+    EVAL_STATS["compiled"] += 1
+    return evaluator
+
+
 def eval_expr(expr_string, harness, key, value):
     """
     Safe evaluation of purely arithmetic expressions
     """
+    EVAL_STATS["expressions"] += 1
     try:
-        tree = ast.parse(expr_string, mode="eval").body
+        return compile_expr(expr_string)()
     except SyntaxError:
         traceback.print_exc()
         logging.error(wrap("""\
@@ -261,71 +426,42 @@ def eval_expr(expr_string, harness, key, value):
             '%s' which is an invalid expression"""), harness, key,
                       value, expr_string)
         exit(1)
+    except ExprError as e:
+        logging.error(wrap("in file %s at key '%s', %s"), harness, key,
+                      str(e))
+        exit(1)
 
-    def eval_single_node(node):
-        logging.debug(node)
-        if isinstance(node, ast_num):
-            return node.n
-        # We're only doing IfExp, which is Python's ternary operator
-        # (i.e. it's an expression). NOT If, which is a statement.
-        if isinstance(node, ast.IfExp):
-            # Let's be strict and only allow actual booleans in the guard
-            guard = eval_single_node(node.test)
-            if guard is not True and guard is not False:
-                logging.error(wrap("""\
-                    in file %s at key '%s', there was an invalid guard
-                    for an if statement."""), harness, key)
-                exit(1)
-            if guard:
-                return eval_single_node(node.body)
-            return eval_single_node(node.orelse)
-        if isinstance(node, ast.Compare):
-            left = eval_single_node(node.left)
-            # Don't allow expressions like (a < b) < c
-            right = eval_single_node(node.comparators[0])
-            op = eval_single_node(node.ops[0])
-            return op(left, right)
-        if isinstance(node, ast.BinOp):
-            left = eval_single_node(node.left)
-            right = eval_single_node(node.right)
-            op = eval_single_node(node.op)
-            return op(left, right)
-        if isinstance(node, ast.Call):
-            valid_calls = {
-                "max": max,
-                "min": min,
-            }
-            if node.func.id not in valid_calls:
-                logging.error(wrap("""\
-                    in file %s at key '%s', there was an invalid
-                    call to %s()"""), harness, key, node.func.id)
-                exit(1)
-            left = eval_single_node(node.args[0])
-            right = eval_single_node(node.args[1])
-            return valid_calls[node.func.id](left, right)
-        try:
-            return {
-                ast.Eq: operator.eq,
-                ast.NotEq: operator.ne,
-                ast.Lt: operator.lt,
-                ast.LtE: operator.le,
-                ast.Gt: operator.gt,
-                ast.GtE: operator.ge,
-
-                ast.Add: operator.add,
-                ast.Sub: operator.sub,
-                ast.Mult: operator.mul,
-                # Use floordiv (i.e. //) so that we never need to
-                # cast to an int
-                ast.Div: operator.floordiv,
-            }[type(node)]
-        except KeyError:
-            logging.error(wrap("""\
-                in file %s at key '%s', there was expression that
-                was impossible to evaluate"""), harness, key)
-            exit(1)
 
-    return eval_single_node(tree)
+def evaluate_makefile_json(data, system, dyr):
+    """
+    Evaluate all keys of a Makefile.json in one pass
+
+    Returns an ordered dict mapping each key to its final value. Lists
+    are joined with whitespace. The time spent is added to EVAL_STATS.
+    """
+    start = time.perf_counter()
+    makefile = collections.OrderedDict()
+    so_far = collections.OrderedDict()
+    for name, value in data.items():
+        if isinstance(value, list):
+            new_value = []
+            for item in value:
+                new_value.append(compute(item, so_far, system, name, dyr, True))
+            makefile[name] = " ".join(new_value)
+        else:
+            makefile[name] = compute(value, so_far, system, name, dyr)
+    EVAL_STATS["files"] += 1
+    EVAL_STATS["seconds"] += time.perf_counter() - start
+    return makefile
+
+
+def log_eval_stats():
+    logging.info(wrap("""\
+        evaluated %d files and %d expressions in %.3fs
+        (%d compiled, %d cache hits)"""),
+                 EVAL_STATS["files"], EVAL_STATS["expressions"],
+                 EVAL_STATS["seconds"], EVAL_STATS["compiled"],
+                 EVAL_STATS["cache hits"])
 
 
 _platform_choices = {
@@ -369,6 +505,10 @@ _args = [{
                 Defaults to the current platform (%(default)s);
                 choices are {choices}""").format(
                     choices="[%s]" % ", ".join(_platform_choices)),
+}, {
+    "flags": ["-i", "--incremental"],
+    "help": "only regenerate Makefiles whose inputs changed",
+    "action": "store_true",
 }, {
     "flags": ["-v", "--verbose"],
     "help": "verbose output",
@@ -403,13 +543,37 @@ def set_up_logging(args):
 def wrap(string):
     return re.sub(r"\s+", " ", re.sub("\n", " ", string))
 
-def main():
+def main(incremental=None):
     args = get_args()
     set_up_logging(args)
-
-    for root, _, fyles in os.walk("."):
-        if "Makefile.json" in fyles:
-            dump_makefile(root, args.system)
+    if incremental is not None:
+        args.incremental = incremental
+
+    # Imported here since proof_index depends on this module
+    from proof_index import ProofIndex
+    index = ProofIndex(".")
+
+    if not args.incremental:
+        for root, fyles in index.walk():
+            if "Makefile.json" in fyles:
+                dump_makefile(root, args.system)
+        log_eval_stats()
+        return
+
+    old_fingerprints = load_fingerprints()
+    new_fingerprints = {}
+    common = common_fingerprint(args.system)
+    for root, fyles in index.walk():
+        if "Makefile.json" not in fyles:
+            continue
+        new_fingerprints[root] = fingerprint(root, common)
+        if (old_fingerprints.get(root) == new_fingerprints[root] and
+                "Makefile" in fyles):
+            logging.info("Skipping %s: inputs are unchanged", root)
+            continue
+        dump_makefile(root, args.system)
+    save_fingerprints(new_fingerprints)
+    log_eval_stats()
 
 
 if __name__ == "__main__":
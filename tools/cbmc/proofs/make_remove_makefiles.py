@@ -25,6 +25,7 @@
 import os
 
 from make_cbmc_batch_files import remove_cbmc_yaml_files
+from proof_index import ProofIndex
 
 def main():
     try:
@@ -32,7 +33,7 @@ def main():
     except FileNotFoundError:
         pass
 
-    for root, _, files in os.walk("."):
+    for root, files in ProofIndex(".").walk():
         # We do not want to remove hand-written Makefiles, so
         # only remove Makefiles that are in the same directory as
         # a Makefile.json. Such Makefiles are generated from the
@@ -7,6 +7,15 @@ Given a list of folders containing cbmc proofs, write a ninja build
 file the generate reports for these proofs.  The list of folders may
 be given on the command line, in a json file, or found in the file
 system.
+
+By default, the goto binaries are built one at a time.  With
+--parallel, goto binaries are built in parallel, serializing only the
+builds of proofs that share object files, and proofs are scheduled
+longest-first using the runtimes recorded in the ninja log.
+
+With --changed, only the proofs affected by a list of changed files
+are written.  With --shards, the proofs are also split into shards that can be run
+by independent processes with proof_shards.py.
 """
 
 # Add task pool
@@ -15,7 +24,14 @@ import sys
 import os
 import platform
 import argparse
+import glob
 import json
+import time
+
+from proof_impact import affected_proofs
+from proof_impact import common_variables
+from proof_impact import read_changed_files
+from proof_index import ProofIndex
 
 ################################################################
 # The command line parser
@@ -44,8 +60,71 @@ def argument_parser():
                         help='Folder containing a cbmc proof')
     parser.add_argument('--proofs', metavar='JSON',
                         help='Json file listing folders containing cbmc proofs')
+    parser.add_argument('--parallel', action='store_true',
+                        help="""Build goto binaries in parallel, serializing
+                        only the proofs that build the same object files,
+                        and order proofs longest-first using the runtimes
+                        recorded in the telemetry ledger or
+                        NINJA_LOG""")
+    parser.add_argument('--jobs', metavar='N', type=int,
+                        default=os.cpu_count() or 1,
+                        help="""Maximum number of goto builds and cbmc runs
+                        to run concurrently with --parallel
+                        (default: %(default)s)""")
+    parser.add_argument('--memory-budget', metavar='GB', type=float,
+                        help="""Memory available to concurrent goto builds
+                        and cbmc runs with --parallel (default: unbounded)""")
+    parser.add_argument('--memory-per-job', metavar='GB', type=float,
+                        default=2.0,
+                        help="""Memory assumed for each goto build or cbmc
+                        run when applying --memory-budget
+                        (default: %(default)s)""")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help="""Restore the outputs of cbmc, coverage,
+                        property, and report from a result cache in DIR
+                        when their inputs are unchanged""")
+    parser.add_argument('--cache-size', metavar='GB', type=float,
+                        default=10.0,
+                        help="""Maximum size of the result cache
+                        (default: %(default)s)""")
+    parser.add_argument('--changed', metavar='FILE',
+                        help="""File listing changed source files, one per
+                        line and relative to the root of the repository, as
+                        output by git diff --name-only (- for the standard
+                        input).  Only the proofs building or including a
+                        changed file are written to the ninja build file""")
+    parser.add_argument('--shards', metavar='N', type=positive_int,
+                        help="""Also split the proofs into N shards of
+                        roughly equal recorded runtime, and write a ninja
+                        build file for each shard and a manifest of the
+                        shards to be run with proof_shards.py""")
+    parser.add_argument('--telemetry', metavar='LEDGER',
+                        help="""Record the wall time, cpu time, peak memory,
+                        and exit status of every proof step in LEDGER""")
+    parser.add_argument('--run-id', metavar='RUN',
+                        default=time.strftime('%Y%m%dT%H%M%S'),
+                        help="""Name of the run recorded in the telemetry
+                        ledger (default: the current time)""")
+    parser.add_argument('--ninja-log', metavar='NINJA_LOG',
+                        default='.ninja_log',
+                        help="""Ninja log of a previous run used to order
+                        proofs longest-first, along with the ninja logs of
+                        the shards in the same directory
+                        (default: %(default)s)""")
     return parser
 
+def positive_int(value):
+    """Parse a command line argument that must be at least 1."""
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "{} is not a positive integer".format(value))
+    return number
+
 ################################################################
 # The list of folders containing proofs
 #
@@ -80,41 +159,44 @@ def find_proofs_in_json_file(filename):
 def find_proofs_in_filesystem():
     """Locate the folders containing proofs in the filesystem."""
 
-    proofs = []
-    for root, _, files in os.walk('.'):
-        if FS_KEY in files:
-            proofs.append(os.path.normpath(root))
-    return proofs
+    return [os.path.normpath(root)
+            for root in ProofIndex('.').directories(FS_KEY)]
 
 ################################################################
 # The strings used to write sections of the ninja file
 
-NINJA_RULES = """
+NINJA_BUILDDIR = """
 ################################################################
-# task pool to force sequential builds of goto binaries
+# directory of the ninja logs
 
-pool goto_pool
-  depth = 1
+builddir = {builddir}
+"""
 
+NINJA_POOLS = """
 ################################################################
-# proof target rules
+# task pools to bound concurrent builds of goto binaries and, with
+# --parallel, cbmc runs
 
-rule build_goto
-  command = make -C ${folder} goto
-  pool = goto_pool
-
-rule build_cbmc
-  command = make -C ${folder} cbmc
+pool goto_pool
+  depth = {goto_depth}
+"""
 
-rule build_coverage
-  command = make -C ${folder} coverage
+NINJA_CBMC_POOL = """
+pool cbmc_pool
+  depth = {cbmc_depth}
+"""
 
-rule build_property
-  command = make -C ${folder} property
+NINJA_STEP_RULES = """
+################################################################
+# proof target rules
+"""
 
-rule build_report
-  command = make -C ${folder} report
+NINJA_STEP_RULE = """
+rule build_{step}
+  command = {command}{pool}
+"""
 
+NINJA_RULES = """
 rule clean_folder
   command = make -C ${folder} clean
 
@@ -126,11 +208,22 @@ rule open_proof
 
 """
 
+NINJA_PATCH = """
+################################################################
+# patch the sources once before any goto binary is built
+
+rule patch_sources
+  command = {command}
+
+build {patched}: patch_sources
+  patches={patches}
+"""
+
 NINJA_BUILDS = """
 ################################################################
 # {folder} proof targets
 
-build {folder}/{entry}.goto: build_goto
+build {folder}/{entry}.goto: build_goto{order_only}
   folder={folder}
 
 build {folder}/cbmc.txt: build_cbmc {folder}/{entry}.goto
@@ -171,6 +264,243 @@ build veryclean: phony {veryclean_targets}
 build open: phony {open_targets}
 """
 
+################################################################
+# The commands used to build the proof targets
+
+STEPS = ['goto', 'cbmc', 'coverage', 'property', 'report']
+
+STEP_POOLS = {
+    'goto': 'goto_pool',
+}
+
+# With --parallel, the cbmc runs are also bounded by --jobs and
+# --memory-budget
+PARALLEL_STEP_POOLS = dict(STEP_POOLS,
+                           cbmc='cbmc_pool',
+                           coverage='cbmc_pool',
+                           property='cbmc_pool')
+
+PROOFS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def step_command(step, args, shard=False):
+    """Return the command used to build a proof target."""
+
+    if shard and step == 'goto':
+        command = '{} {} lock --folder ${{folder}} -- make -C ${{folder}} goto'.format(
+            sys.executable, os.path.join(PROOFS_DIR, 'proof_shards.py'))
+    elif args.cache_dir and step != 'goto':
+        command = '{} {} --cache-dir {} --max-size {} ${{folder}} {}'.format(
+            sys.executable, os.path.join(PROOFS_DIR, 'proof_cache.py'),
+            os.path.abspath(args.cache_dir), args.cache_size, step)
+    else:
+        command = 'make -C ${{folder}} {}'.format(step)
+    if args.telemetry:
+        command = ('{} {} --ledger {} record --run {} --folder ${{folder}} '
+                   '--step {} -- {}').format(
+                       sys.executable,
+                       os.path.join(PROOFS_DIR, 'proof_telemetry.py'),
+                       os.path.abspath(args.telemetry), args.run_id, step,
+                       command)
+    return command
+
+def patch_command(shard=False):
+    """Return the command used to patch the sources."""
+
+    command = 'cd $patches && ./patch.py'
+    if shard:
+        command = "{} {} lock --name patch -- sh -c '{}'".format(
+            sys.executable, os.path.join(PROOFS_DIR, 'proof_shards.py'),
+            command)
+    return command
+
+def step_rules(args, shard=False):
+    """Return the ninja rules used to build the proof targets."""
+
+    rules = NINJA_STEP_RULES
+    pools = PARALLEL_STEP_POOLS if args.parallel else STEP_POOLS
+    for step in STEPS:
+        pool = pools.get(step)
+        rules += NINJA_STEP_RULE.format(
+            step=step,
+            command=step_command(step, args, shard),
+            pool='\n  pool = {}'.format(pool) if pool else '')
+    return rules
+
+################################################################
+# Scheduling of goto builds
+#
+# Building a goto binary for a proof also builds the goto binaries
+# for the object files listed in OBJS, and these object files live in
+# the source tree.  Two proofs listing the same object file can not
+# build their goto binaries at the same time, but all other goto
+# builds can run in parallel.  Each goto build is given an order-only
+# dependency on the goto build of the previous proof listing the same
+# object file, so that the builds of each object file are serialized.
+
+PATCHES_DIR = os.path.normpath(os.path.join(PROOFS_DIR, '..', 'patches'))
+
+def get_objects(folder):
+    """Find the object files built for the proof in the proof Makefile."""
+
+    objects = []
+    with open('{}/Makefile'.format(folder)) as makefile:
+        for line in makefile:
+            if line.strip().lower().startswith('h_objs_except_harness'):
+                objects.extend(line[line.find('=')+1:].split())
+    return objects
+
+def read_ninja_log(filename):
+    """Read the build time in milliseconds of each target in a ninja log.
+
+    The ninja log is a tab-separated file of start time, end time,
+    modification time, target, and command hash.  A target built more
+    than once appears more than once, and the last entry is the most
+    recent.
+    """
+
+    runtimes = {}
+    try:
+        with open(filename) as log:
+            for line in log:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 4:
+                    continue
+                try:
+                    runtimes[fields[3]] = int(fields[1]) - int(fields[0])
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return runtimes
+
+def ninja_logs(ninja_log):
+    """Return the ninja log and the ninja logs of the shards, oldest first.
+
+    The shards keep their ninja logs in build directories of their own,
+    next to the ninja log of the unsharded build.
+    """
+
+    # Imported here since proof_shards needs fcntl, missing on Windows
+    from proof_shards import shard_build_dir
+
+    def modification_time(filename):
+        try:
+            return os.path.getmtime(filename)
+        except FileNotFoundError:
+            return 0
+
+    shard_logs = glob.glob(os.path.join(os.path.dirname(ninja_log),
+                                        shard_build_dir('*'), '.ninja_log'))
+    return sorted([ninja_log] + sorted(shard_logs), key=modification_time)
+
+def read_ninja_logs(ninja_log):
+    """Read the build times of the targets in the ninja logs of a build.
+
+    A target built by more than one log is given its build time in the
+    most recently modified log.
+    """
+
+    runtimes = {}
+    for filename in ninja_logs(ninja_log):
+        runtimes.update(read_ninja_log(filename))
+    return runtimes
+
+def proof_runtimes(proofs, runtimes):
+    """Sum the build time in milliseconds of the targets of each proof.
+
+    A proof missing from the log is given the mean runtime of the
+    proofs present in the log.
+    """
+
+    totals = {}
+    for proof in proofs:
+        prefix = os.path.normpath(proof) + '/'
+        times = [time for target, time in runtimes.items()
+                 if os.path.normpath(target).startswith(prefix)]
+        if times:
+            totals[proof] = sum(times)
+    return fill_runtimes(proofs, totals)
+
+def ledger_runtimes(proofs, ledger):
+    """Read the runtime in milliseconds of each proof from a telemetry ledger.
+
+    The runtime of a proof is its cost in the ledger: the total wall
+    time of its steps, each step from the last run in which it was not
+    restored from the cache.  A proof missing from the ledger is given
+    the mean runtime of the proofs present in the ledger.
+    """
+
+    # Imported here since proof_telemetry needs fcntl and resource,
+    # missing on Windows
+    from proof_telemetry import proof_costs
+
+    costs = proof_costs(ledger)
+    totals = {proof: int(costs[os.path.normpath(proof)] * 1000)
+              for proof in proofs if os.path.normpath(proof) in costs}
+    return fill_runtimes(proofs, totals)
+
+def fill_runtimes(proofs, totals):
+    """Give proofs without a runtime the mean of the known runtimes."""
+
+    default = sum(totals.values()) // len(totals) if totals else 0
+    return {proof: totals.get(proof, default) for proof in proofs}
+
+def recorded_runtimes(proofs, args):
+    """Return the runtime of each proof recorded by a previous run.
+
+    The telemetry ledger is preferred to the ninja log, since the
+    ledger marks the steps restored from the cache and keeps the
+    runtimes of earlier runs, so a proof restored from the cache is
+    still given the runtime of its last real build.  The ninja log only
+    holds the runtimes of the last build, and a cache hit is recorded
+    there as a build taking next to no time.
+    """
+
+    if args.telemetry:
+        # Imported here since proof_telemetry needs fcntl and resource,
+        # missing on Windows
+        from proof_telemetry import proof_costs
+        if proof_costs(args.telemetry):
+            return ledger_runtimes(proofs, args.telemetry)
+    return proof_runtimes(proofs, read_ninja_logs(args.ninja_log))
+
+def longest_first(proofs, runtimes):
+    """Order the proofs by decreasing runtime."""
+
+    return sorted(proofs, key=lambda proof: runtimes[proof], reverse=True)
+
+def goto_dependencies(proofs, entries, objects):
+    """Map each proof to the goto binaries it must be built after.
+
+    The proofs are assumed to be in the order in which they should be
+    built.  A proof is built after the last earlier proof that builds
+    one of its object files.
+    """
+
+    last_builder = {}
+    dependencies = {}
+    for proof in proofs:
+        after = []
+        for obj in objects[proof]:
+            previous = last_builder.get(obj)
+            if previous is not None and previous not in after:
+                after.append(previous)
+            last_builder[obj] = proof
+        dependencies[proof] = ['{}/{}.goto'.format(folder, entries[folder])
+                               for folder in after]
+    return dependencies
+
+def pool_depth(args):
+    """Compute the number of concurrent jobs allowed by the budget."""
+
+    depth = max(1, args.jobs)
+    if args.memory_budget is not None:
+        depth = min(depth,
+                    max(1, int(args.memory_budget // args.memory_per_job)))
+    return depth
+
 ################################################################
 # The main function
 
@@ -185,6 +515,56 @@ def get_entry(folder):
                 return line[line.find('=')+1:].strip()
     raise UserWarning("Can't find ENTRY in {}/Makefile".format(folder))
 
+def write_ninja_file(filename, proofs, entries, runtimes, args, shard=False,
+                     builddir=None):
+    """Write a ninja build file to generate the results of some proofs.
+
+    The build file for a shard patches the sources and builds goto
+    binaries holding locks, since other shards may be running on the
+    same machine, and is given a build directory of its own for its
+    ninja logs.
+    """
+
+    depth = pool_depth(args)
+    dependencies = {proof: [] for proof in proofs}
+    patched = os.path.join(PATCHES_DIR, 'patched')
+    if args.parallel:
+        proofs = longest_first(proofs, runtimes)
+        objects = {proof: get_objects(proof) for proof in proofs}
+        dependencies = goto_dependencies(proofs, entries, objects)
+    if args.parallel or shard:
+        for proof in proofs:
+            dependencies[proof].insert(0, patched)
+
+    with open(filename, 'w') as ninja:
+        if builddir:
+            ninja.write(NINJA_BUILDDIR.format(builddir=builddir))
+        ninja.write(NINJA_POOLS.format(
+            goto_depth=depth if args.parallel else 1))
+        if args.parallel:
+            ninja.write(NINJA_CBMC_POOL.format(cbmc_depth=depth))
+        ninja.write(step_rules(args, shard))
+        ninja.write(NINJA_RULES)
+        if args.parallel or shard:
+            ninja.write(NINJA_PATCH.format(
+                patched=patched,
+                patches=PATCHES_DIR,
+                command=patch_command(shard)))
+        for proof in proofs:
+            order_only = (' || ' + ' '.join(dependencies[proof])
+                          if dependencies[proof] else '')
+            ninja.write(NINJA_BUILDS.format(folder=proof,
+                                            entry=entries[proof],
+                                            order_only=order_only))
+        targets = lambda kind, folders: ' '.join(
+            ['{}_{}'.format(kind, folder) for folder in folders]
+        )
+        ninja.write(NINJA_GLOBALS.format(
+            clean_targets=targets('clean', proofs),
+            veryclean_targets=targets('veryclean', proofs),
+            open_targets=targets('open', proofs)
+        ))
+
 def write_ninja_build_file():
     """Write a ninja build file to generate proof results."""
 
@@ -199,19 +579,31 @@ def write_ninja_build_file():
               find_proofs_in_json_file(args.proofs) or
               find_proofs_in_filesystem())
 
-    with open('build.ninja', 'w') as ninja:
-        ninja.write(NINJA_RULES)
-        for proof in proofs:
-            entry = get_entry(proof)
-            ninja.write(NINJA_BUILDS.format(folder=proof, entry=entry))
-        targets = lambda kind, folders: ' '.join(
-            ['{}_{}'.format(kind, folder) for folder in folders]
-        )
-        ninja.write(NINJA_GLOBALS.format(
-            clean_targets=targets('clean', proofs),
-            veryclean_targets=targets('veryclean', proofs),
-            open_targets=targets('open', proofs)
-        ))
+    if args.changed:
+        changed = read_changed_files(args.changed,
+                                     common_variables()['FREERTOS'])
+        selected = affected_proofs(proofs, changed)
+        print("Selected {} of {} proofs affected by {} changed files".format(
+            len(selected), len(proofs), len(changed)))
+        proofs = selected
+
+    entries = {proof: get_entry(proof) for proof in proofs}
+    runtimes = (recorded_runtimes(proofs, args)
+                if args.parallel or args.shards else {})
+
+    write_ninja_file('build.ninja', proofs, entries, runtimes, args)
+
+    if args.shards:
+        # Imported here since proof_shards needs fcntl, missing on Windows
+        from proof_shards import MANIFEST, partition, shard_build_dir
+        from proof_shards import shard_build_file, write_manifest
+
+        shards = partition(runtimes, args.shards)
+        for index, shard in enumerate(shards):
+            write_ninja_file(shard_build_file(index), shard, entries,
+                             runtimes, args, shard=True,
+                             builddir=shard_build_dir(index))
+        write_manifest(MANIFEST, shards, runtimes)
 
 ################################################################
 
@@ -42,7 +42,7 @@ sys.path.append(os.path.normpath(os.path.join(CWD, "..", "patches")))
 from patches_constants import HEADERS
 
 from compute_patch import find_all_defines
-from compute_patch import manipulate_headerfile
+from compute_patch import patch_headerfiles
 
 import patch
 
@@ -74,17 +74,19 @@ def patch_headers(headers):
     creating patch files.  One potential vulnerability of this
     function is that it could cause preexisting patch files to fail if
     they patch a file being modified here.
+
+    The headers are patched concurrently, and headers that are already
+    patched for the current set of defines are skipped.
     """
     defines = find_all_defines()
-    for header in headers:
-        manipulate_headerfile(defines, header)
+    patch_headerfiles(defines, headers)
 
 ################################################################
 
 def build():
-    process_configurations()
+    process_configurations(jobs=os.cpu_count() or 1)
     make_common_file()
-    make_proof_files()
+    make_proof_files(incremental=True)
     try:
         create_cbmc_yaml_files()
     except CalledProcessError as e:
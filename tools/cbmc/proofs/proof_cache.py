@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""
+Cache the results of cbmc proofs by the content of their inputs.
+
+Run a proof target (cbmc, coverage, property, or report) in a proof
+folder, but first look for the outputs of the target in a local cache.
+The cache is keyed on the content of the goto binary for the proof
+(which is built from the preprocessed harness and the preprocessed
+sources it links against), the exact commands make would run to build
+the target (which contain the cbmc flags), and the version of cbmc.
+On a cache hit, the outputs are restored without running cbmc.  On a
+cache miss, the target is built with make and the outputs are stored.
+
+The cache is bounded in size.  Each hit refreshes the timestamp of the
+cached entry, and the least recently used entries are removed when
+the cache grows larger than the bound.  The total size of the cache is
+kept in a file updated with each new entry, so the cache is only
+scanned once it is over the bound.
+
+Proof targets may be built concurrently.  An entry is moved out of
+the way before it is removed, and a target whose entry is removed
+while it is being restored is built as on a cache miss.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from ninja import get_entry
+from proof_telemetry import report_cache_hit
+
+################################################################
+# The command line parser
+
+def argument_parser():
+    """Return the command line parser."""
+
+    parser = argparse.ArgumentParser(
+        description='Build a cbmc proof target using a result cache.',
+        epilog="""
+            Build the target TARGET in the proof folder PROOF with make,
+            unless the outputs of the target are found in the cache.
+            The target must be one of cbmc, coverage, property, or
+            report.
+        """
+    )
+    parser.add_argument('folder', metavar='PROOF',
+                        help='Folder containing a cbmc proof')
+    parser.add_argument('target', metavar='TARGET', choices=OUTPUTS,
+                        help='Proof target to build')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        default=DEFAULT_CACHE_DIR,
+                        help='Directory holding the cache (default: %(default)s)')
+    parser.add_argument('--max-size', metavar='GB', type=float,
+                        default=DEFAULT_MAX_SIZE,
+                        help='Maximum size of the cache (default: %(default)s)')
+    return parser
+
+################################################################
+# The outputs of each proof target
+
+OUTPUTS = {
+    'cbmc': ['cbmc.txt'],
+    'coverage': ['coverage.xml'],
+    'property': ['property.xml'],
+    'report': ['html'],
+}
+
+# The outputs of the other targets are inputs to the report
+REPORT_INPUTS = ['cbmc.txt', 'coverage.xml', 'property.xml']
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cbmc-proofs')
+DEFAULT_MAX_SIZE = 10.0
+
+BLOCK_SIZE = 1 << 20
+
+# Files in the cache directory holding the total size of the entries,
+# and serializing the updates to it
+SIZE_FILE = 'size'
+LOCK_FILE = '.lock'
+
+################################################################
+# The cache key
+
+def hash_file(digest, filename):
+    """Add the content of a file to a digest."""
+
+    with open(filename, 'rb') as data:
+        for block in iter(lambda: data.read(BLOCK_SIZE), b''):
+            digest.update(block)
+
+def make_commands(folder, entry, target):
+    """Return the commands make would run to build the target.
+
+    The goto binary is assumed to be newer than everything, so only
+    the commands that use the goto binary are listed.
+    """
+
+    goal = target if target == 'report' else OUTPUTS[target][0]
+    result = subprocess.run(['make', '--no-print-directory', '-n', '-C', folder,
+                             '-W', '{}.goto'.format(entry), goal],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True, check=True)
+    return result.stdout
+
+def cbmc_version():
+    """Return the version of cbmc, or the empty string if not installed."""
+
+    try:
+        result = subprocess.run(['cbmc', '--version'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True)
+    except FileNotFoundError:
+        return ''
+    return result.stdout.strip()
+
+def cache_key(folder, target):
+    """Compute the cache key for a proof target."""
+
+    entry = get_entry(folder)
+    digest = hashlib.sha256()
+    digest.update(target.encode())
+    digest.update(cbmc_version().encode())
+    digest.update(make_commands(folder, entry, target).encode())
+    hash_file(digest, os.path.join(folder, '{}.goto'.format(entry)))
+    if target == 'report':
+        for name in REPORT_INPUTS:
+            hash_file(digest, os.path.join(folder, name))
+    return digest.hexdigest()
+
+################################################################
+# The cache
+
+def entry_path(cache_dir, key):
+    """Return the path of the cache entry for a key."""
+
+    return os.path.join(cache_dir, key[:2], key)
+
+def copy_output(src, dst):
+    """Copy an output file or directory, replacing any existing copy.
+
+    The copy is given a new modification time, so that ninja considers
+    a restored output newer than the goto binary it was computed from.
+    """
+
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=shutil.copy)
+    else:
+        shutil.copy(src, dst)
+
+def remove_output(path):
+    """Remove an output file or directory, if present."""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def restore(cache_dir, key, folder, target):
+    """Restore the outputs of a proof target from the cache.
+
+    Return True if the outputs were found in the cache.  An entry
+    removed by another process while its outputs are copied counts as
+    missing, and the outputs copied so far are removed.
+    """
+
+    path = entry_path(cache_dir, key)
+    if not os.path.isdir(path):
+        return False
+    try:
+        for name in OUTPUTS[target]:
+            copy_output(os.path.join(path, name), os.path.join(folder, name))
+    except OSError:
+        # shutil.Error, raised by copytree, is an OSError
+        for name in OUTPUTS[target]:
+            remove_output(os.path.join(folder, name))
+        return False
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+class CacheLock:
+    """An exclusive lock on the total size of the cache."""
+
+    def __init__(self, cache_dir):
+        self.filename = os.path.join(cache_dir, LOCK_FILE)
+        self.lock = None
+
+    def __enter__(self):
+        self.lock = open(self.filename, 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.close()
+
+def read_total(cache_dir):
+    """Return the total size of the cache, or None if it is not known."""
+
+    try:
+        with open(os.path.join(cache_dir, SIZE_FILE)) as total:
+            return int(total.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_total(cache_dir, size):
+    with open(os.path.join(cache_dir, SIZE_FILE), 'w') as total:
+        total.write('{}\n'.format(size))
+
+def store(cache_dir, key, folder, target):
+    """Store the outputs of a proof target in the cache.
+
+    The outputs are copied into a temporary directory that is renamed
+    into place, so a concurrent reader never sees a partial entry.
+    Return the total size of the cache, or None if it is not known.
+    """
+
+    path = entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        for name in OUTPUTS[target]:
+            copy_output(os.path.join(folder, name), os.path.join(tmp, name))
+        size = entry_size(tmp)
+        with CacheLock(cache_dir):
+            os.rename(tmp, path)
+            total = read_total(cache_dir)
+            if total is not None:
+                total += size
+                write_total(cache_dir, total)
+            return total
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        return read_total(cache_dir)
+
+def entry_size(path):
+    """Return the total size in bytes of the files in a cache entry.
+
+    Files removed while the entry is scanned are not counted.
+    """
+
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+    return size
+
+def cache_entries(cache_dir):
+    """Return the modification time, path, and size of each cache entry.
+
+    Entries removed while the cache is scanned are skipped, and the
+    leftovers of removals that were interrupted are removed.
+    """
+
+    entries = []
+    for bucket in os.scandir(cache_dir):
+        if not bucket.is_dir():
+            continue
+        for entry in os.scandir(bucket.path):
+            if entry.name.startswith('.evict-'):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    entries.append((entry.stat().st_mtime, entry.path,
+                                    entry_size(entry.path)))
+            except FileNotFoundError:
+                continue
+    return entries
+
+def evict(cache_dir, max_size):
+    """Remove least recently used entries until the cache fits max_size bytes.
+
+    An entry is renamed before it is removed, so a concurrent restore
+    either finds the whole entry or fails to copy it.
+    """
+
+    with CacheLock(cache_dir):
+        entries = cache_entries(cache_dir)
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= max_size:
+                break
+            doomed = os.path.join(os.path.dirname(path),
+                                  '.evict-' + os.path.basename(path))
+            try:
+                os.rename(path, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
+        write_total(cache_dir, total)
+
+################################################################
+# The main function
+
+def build_target(folder, target, cache_dir, max_size):
+    """Build a proof target, using the cache if possible.
+
+    Return the exit status of make, or 0 on a cache hit.
+    """
+
+    key = cache_key(folder, target)
+    if restore(cache_dir, key, folder, target):
+        print("Restored {} for {} from the cache".format(target, folder))
+        report_cache_hit()
+        return 0
+
+    status = subprocess.run(['make', '-C', folder, target]).returncode
+    if not status:
+        max_bytes = int(max_size * (1 << 30))
+        total = store(cache_dir, key, folder, target)
+        if total is None or total > max_bytes:
+            evict(cache_dir, max_bytes)
+    return status
+
+def main():
+    args = argument_parser().parse_args()
+    sys.exit(build_target(args.folder, args.target,
+                          args.cache_dir, args.max_size))
+
+################################################################
+
+if __name__ == "__main__":
+    main()
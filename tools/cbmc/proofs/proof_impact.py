@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Select the cbmc proofs affected by a change to the source tree.
+
+A proof is affected by a changed file if the file is in the proof
+folder, or if the file is one of the sources the proof builds or is
+included by them, directly or indirectly.  The sources of a proof are
+its harness and the sources of the object files in OBJS.  A proof
+generated from a Configurations.json in a config_ folder is also
+affected by the files in the folder holding Configurations.json, and
+its sources include the harness in that folder, of which the harness
+in the config_ folder is a copy.  Include
+directives are resolved against the directory of the including file
+and against the include paths INC of the proof and of Makefile.common.
+Include directives are followed whatever the preprocessor conditions
+around them, so the selection is conservative: it may select a proof
+whose DEF values exclude a changed header, but never misses a proof
+that includes it.
+
+A change to the files generating the Makefiles, or to the patches
+applied to the sources, affects every proof.  So does the deletion of
+a source file, since deleted files can not be scanned.
+"""
+
+import os
+import re
+import sys
+
+PROOFS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Changes to these files affect every proof
+GLOBAL_FILES = [
+    os.path.join(PROOFS_DIR, name)
+    for name in ['Makefile.template', 'MakefileCommon.json',
+                 'MakefileLinux.json', 'MakefileWindows.json',
+                 'make_common_makefile.py', 'make_proof_makefiles.py',
+                 'make_configuration_directories.py']
+]
+GLOBAL_DIRS = [os.path.normpath(os.path.join(PROOFS_DIR, '..', 'patches'))]
+
+INCLUDE_REGEX = re.compile(r'\s*#\s*include\s*[<"]([^>"]+)[>"]')
+SOURCE_SUFFIXES = ('.c', '.h')
+
+################################################################
+# Reading the Makefiles
+
+def read_makefile_variables(filename):
+    """Read the variable definitions in a generated Makefile.
+
+    Definitions continued over several lines with a backslash are
+    joined, and comments are dropped.
+    """
+
+    variables = {}
+    try:
+        with open(filename) as makefile:
+            text = makefile.read()
+    except FileNotFoundError:
+        return variables
+    for line in re.sub(r'\\\n', ' ', text).splitlines():
+        match = re.match(r'(\w+)\s*=(.*)', line)
+        if match:
+            variables[match.group(1)] = match.group(2).split('#')[0].strip()
+    return variables
+
+def expand(value, variables):
+    """Expand the references $(NAME) to make variables in a value."""
+
+    return re.sub(r'\$\((\w+)\)',
+                  lambda match: variables.get(match.group(1), ''),
+                  value)
+
+def common_variables():
+    """Return the variables defined in Makefile.common."""
+
+    variables = read_makefile_variables(
+        os.path.join(PROOFS_DIR, 'Makefile.common'))
+    variables.setdefault('FREERTOS', os.path.normpath(
+        os.path.join(PROOFS_DIR, '..', '..', '..')))
+    variables.setdefault('PROOFS', PROOFS_DIR)
+    return variables
+
+def include_paths(folder, variables):
+    """Return the include paths of a proof as absolute paths."""
+
+    paths = []
+    for name in ['C_INC', 'O_INC', 'H_INC']:
+        for flag in expand(variables.get(name, ''), variables).split():
+            if flag.startswith('-I'):
+                paths.append(os.path.normpath(
+                    os.path.join(folder, flag[len('-I'):])))
+    return paths
+
+def configuration_folder(folder):
+    """Return the folder holding the Configurations.json of a proof.
+
+    Return None unless the proof is a config_ folder generated by
+    make_configuration_directories.py.
+    """
+
+    parent = os.path.dirname(folder)
+    if (os.path.basename(folder).startswith('config_') and
+            os.path.isfile(os.path.join(parent, 'Configurations.json'))):
+        return parent
+    return None
+
+def in_proof_folders(filename, folder):
+    """Is a file in the folder of a proof, or in its configuration folder?"""
+
+    if filename.startswith(folder + os.sep):
+        return True
+    parent = configuration_folder(folder)
+    if parent is None or not filename.startswith(parent + os.sep):
+        return False
+    # Files in the other configurations of the proof belong to them
+    parts = os.path.relpath(filename, parent).split(os.sep)
+    return (len(parts) == 1 or not parts[0].startswith('config_') or
+            parts[0] == os.path.basename(folder))
+
+def proof_sources(folder, variables):
+    """Return the harness and the sources of the object files of a proof."""
+
+    # Imported here since ninja.py imports this module
+    from ninja import get_objects
+
+    harness_folders = [folder]
+    parent = configuration_folder(folder)
+    if parent is not None:
+        harness_folders.append(parent)
+    sources = [os.path.join(directory, name)
+               for directory in harness_folders
+               for name in os.listdir(directory)
+               if name.endswith('_harness.c')]
+    for obj in get_objects(folder):
+        source = os.path.join(folder, expand(obj, variables))
+        sources.append(os.path.normpath(re.sub(r'\.goto$', '.c', source)))
+    return sources
+
+################################################################
+# Following the include directives
+
+class IncludeGraph:
+    """The include directives of the files in the source tree.
+
+    The include directives of each file are read once and shared by
+    all proofs.
+    """
+
+    def __init__(self):
+        self.includes = {}
+
+    def direct_includes(self, filename):
+        """Return the names included by a file."""
+
+        if filename not in self.includes:
+            try:
+                with open(filename, errors='replace') as source:
+                    self.includes[filename] = [
+                        match.group(1) for match in map(INCLUDE_REGEX.match, source)
+                        if match]
+            except (FileNotFoundError, IsADirectoryError):
+                self.includes[filename] = []
+        return self.includes[filename]
+
+    def closure(self, sources, paths):
+        """Return the sources and all the files they include."""
+
+        seen = set()
+        stack = [os.path.abspath(source) for source in sources]
+        while stack:
+            filename = stack.pop()
+            if filename in seen:
+                continue
+            seen.add(filename)
+            for name in self.direct_includes(filename):
+                for directory in [os.path.dirname(filename)] + paths:
+                    candidate = os.path.normpath(os.path.join(directory, name))
+                    if os.path.isfile(candidate):
+                        stack.append(candidate)
+                        break
+        return seen
+
+################################################################
+# Selecting the affected proofs
+
+def affects_all(changed):
+    """Does a change affect every proof?"""
+
+    for filename in changed:
+        if filename in GLOBAL_FILES:
+            return True
+        if any(filename.startswith(directory + os.sep)
+               for directory in GLOBAL_DIRS):
+            return True
+        if filename.endswith(SOURCE_SUFFIXES) and not os.path.exists(filename):
+            return True
+    return False
+
+def affected_proofs(proofs, changed):
+    """Return the proofs affected by a list of changed files.
+
+    The changed files are absolute paths, and the proofs are folders
+    containing generated Makefiles.
+    """
+
+    changed = {os.path.normpath(filename) for filename in changed}
+    if affects_all(changed):
+        return list(proofs)
+
+    common = common_variables()
+    graph = IncludeGraph()
+    affected = []
+    for proof in proofs:
+        folder = os.path.abspath(proof)
+        if any(in_proof_folders(filename, folder) for filename in changed):
+            affected.append(proof)
+            continue
+        variables = dict(common)
+        variables.update(read_makefile_variables(os.path.join(proof, 'Makefile')))
+        variables['ENTRY'] = variables.get('H_ENTRY', '')
+        files = graph.closure(proof_sources(folder, variables),
+                              include_paths(folder, variables))
+        if files & changed:
+            affected.append(proof)
+    return affected
+
+def read_changed_files(filename, root):
+    """Read a list of changed files, one per line.
+
+    Relative paths are relative to root, as in the output of
+    git diff --name-only run in the root of the repository.  The list
+    is read from the standard input if filename is "-".
+    """
+
+    if filename == '-':
+        return parse_changed_files(sys.stdin, root)
+    with open(filename) as changes:
+        return parse_changed_files(changes, root)
+
+def parse_changed_files(changes, root):
+    return [os.path.normpath(os.path.join(root, line.strip()))
+            for line in changes if line.strip()]
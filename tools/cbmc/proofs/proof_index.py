@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Index the directory tree containing the cbmc proofs.
+
+The scripts preparing the proofs all need to know which folders
+contain a Makefile.json, a Configurations.json, a harness, or a
+generated Makefile, and several of them need the content of the json
+files.  This module walks the tree once with os.scandir, parses the
+json files once, and persists the result in a manifest in the root of
+the tree.
+
+The manifest is invalidated one directory at a time: the listing of a
+directory is reused while the modification time of the directory is
+unchanged, and the content of a json file is reused while its
+modification time and size are unchanged.  Like git, an entry that was
+modified too close to the time the manifest was written is considered
+racy and is always read again.
+"""
+
+import json
+import os
+import time
+
+from make_proof_makefiles import load_json_config_file
+
+MANIFEST = '.proof_index.json'
+MANIFEST_VERSION = 1
+
+# The json files whose content is recorded in the index
+JSON_FILES = ['Makefile.json', 'MakefileCommon.json', 'Configurations.json']
+
+# Entries modified within this many nanoseconds of the time the
+# manifest was written are read again
+RACY_WINDOW = 2 * 10**9
+
+################################################################
+# The index
+
+class ProofIndex:
+    """An index of the directory tree rooted at root.
+
+    Directories are named as os.walk(root) would name them, so that
+    the index can replace os.walk in the existing scripts.
+    """
+
+    def __init__(self, root='.'):
+        self.root = root
+        self.manifest = os.path.join(root, MANIFEST)
+        self.dirs = {}
+        self.refresh()
+
+    def path(self, relpath):
+        """Return the name of a directory given its path from the root."""
+
+        return self.root if relpath == '.' else os.path.join(self.root, relpath)
+
+    def refresh(self):
+        """Bring the index up to date with the file system."""
+
+        cached, written = self._load_manifest()
+        self.dirs = {}
+        changed = not cached
+        stack = ['.']
+        while stack:
+            relpath = stack.pop()
+            record = self._scan(relpath, cached.get(relpath), written)
+            if record is not cached.get(relpath):
+                changed = True
+            self.dirs[relpath] = record
+            stack.extend(os.path.join(relpath, subdir) if relpath != '.' else subdir
+                         for subdir in reversed(record['subdirs']))
+        if changed or set(cached) != set(self.dirs):
+            self._save_manifest()
+
+    def walk(self):
+        """Generate (dirpath, files) for each directory, top-down."""
+
+        stack = ['.']
+        while stack:
+            relpath = stack.pop()
+            record = self.dirs[relpath]
+            yield self.path(relpath), record['files']
+            stack.extend(os.path.join(relpath, subdir) if relpath != '.' else subdir
+                         for subdir in reversed(record['subdirs']))
+
+    def directories(self, filename):
+        """Return the directories containing a file named filename."""
+
+        return [dirpath for dirpath, files in self.walk() if filename in files]
+
+    def json(self, dirpath, filename):
+        """Return the content of a json file recorded in the index."""
+
+        relpath = os.path.relpath(dirpath, self.root)
+        return self.dirs[relpath]['json'][filename]['data']
+
+    def entry(self, dirpath):
+        """Return the ENTRY of the proof in a directory, or None."""
+
+        relpath = os.path.relpath(dirpath, self.root)
+        for record in self.dirs[relpath]['json'].values():
+            if isinstance(record['data'], dict) and 'ENTRY' in record['data']:
+                return record['data']['ENTRY']
+        return None
+
+    ################################################################
+    # Scanning the file system
+
+    def _scan(self, relpath, cached, written):
+        """Return the record for a directory, reusing cached if valid."""
+
+        dirpath = self.path(relpath)
+        mtime = os.stat(dirpath).st_mtime_ns
+        if cached and cached['mtime'] == mtime and not racy(mtime, written):
+            files, subdirs = cached['files'], cached['subdirs']
+        else:
+            cached = None
+            files, subdirs = [], []
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+            files.sort()
+            subdirs.sort()
+
+        old_json = cached['json'] if cached else {}
+        new_json = {}
+        for filename in JSON_FILES:
+            if filename not in files:
+                continue
+            stat = os.stat(os.path.join(dirpath, filename))
+            old = old_json.get(filename)
+            if (old and old['mtime'] == stat.st_mtime_ns and
+                    old['size'] == stat.st_size and
+                    not racy(stat.st_mtime_ns, written)):
+                new_json[filename] = old
+            else:
+                new_json[filename] = {
+                    'mtime': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'data': load_json_config_file(
+                        os.path.join(dirpath, filename)),
+                }
+
+        if cached and new_json == old_json:
+            return cached
+        return {
+            'mtime': mtime,
+            'files': files,
+            'subdirs': subdirs,
+            'json': new_json,
+        }
+
+    ################################################################
+    # The manifest
+
+    def _load_manifest(self):
+        """Return the cached records and the time they were written."""
+
+        try:
+            with open(self.manifest) as handle:
+                manifest = json.load(handle)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}, 0
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}, 0
+        return manifest['dirs'], manifest['written']
+
+    def _save_manifest(self):
+        """Write the manifest atomically."""
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'written': time.time_ns(),
+            'dirs': self.dirs,
+        }
+        tmp = '{}.{}.tmp'.format(self.manifest, os.getpid())
+        try:
+            with open(tmp, 'w') as handle:
+                json.dump(manifest, handle)
+            os.replace(tmp, self.manifest)
+        except OSError:
+            # The index still works without a manifest
+            pass
+
+def racy(mtime, written):
+    """Is a modification time too close to the time of the manifest?"""
+
+    return mtime >= written - RACY_WINDOW
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+"""
+Run the cbmc proofs in shards and merge the results.
+
+ninja.py with --shards N splits the proofs into N shards of roughly
+equal cost, writes one ninja build file for each shard, and writes a
+manifest listing the proofs in each shard.  Each shard can be run by
+an independent process, on this machine or another:
+
+    proof_shards.py run --shard 0
+
+runs the ninja build file for shard 0 and writes a summary of the
+results of the proofs in the shard.  Once the summaries of all shards
+are collected in one place,
+
+    proof_shards.py merge
+
+combines them into a single summary of all the proofs.
+
+Shards running on the same machine share the object files built in the
+source tree, so each goto build of a shard holds a lock on the object
+files of its proof while it runs.  Each shard keeps its ninja log and
+dependency log in a build directory of its own, since ninja does not
+support concurrent runs sharing them.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+import subprocess
+import sys
+
+################################################################
+# The command line parser
+
+def argument_parser():
+    """Return the command line parser."""
+
+    parser = argparse.ArgumentParser(
+        description='Run cbmc proofs in shards and merge the results.')
+    parser.add_argument('--manifest', metavar='JSON', default=MANIFEST,
+                        help='Manifest of the shards (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run = commands.add_parser(
+        'run', help='Run the proofs in a shard and summarize the results')
+    run.add_argument('--shard', metavar='N', type=int, required=True,
+                     help='Index of the shard to run')
+    run.add_argument('--ninja', metavar='NINJA', default='ninja',
+                     help='Ninja executable (default: %(default)s)')
+    run.add_argument('--jobs', metavar='N', type=int,
+                     help='Number of jobs passed to ninja')
+
+    merge = commands.add_parser(
+        'merge', help='Merge the summaries of the shards')
+    merge.add_argument('--output', metavar='JSON', default=SUMMARY,
+                       help='Merged summary (default: %(default)s)')
+
+    lock = commands.add_parser(
+        'lock', help='Run a goto build holding locks on its object files')
+    locked = lock.add_mutually_exclusive_group(required=True)
+    locked.add_argument('--folder', metavar='PROOF',
+                        help='Folder containing the cbmc proof')
+    locked.add_argument('--name', metavar='NAME',
+                        help='Name of a lock to hold instead')
+    lock.add_argument('cmd', metavar='COMMAND', nargs=argparse.REMAINDER,
+                      help='Command building the goto binary, after --')
+    return parser
+
+MANIFEST = 'shards.json'
+SUMMARY = 'summary.json'
+LOCK_DIR = '.goto-locks'
+
+def shard_build_file(shard):
+    return 'build-shard-{}.ninja'.format(shard)
+
+def shard_build_dir(shard):
+    return '.ninja-shard-{}'.format(shard)
+
+def shard_summary_file(shard):
+    return 'shard-{}-summary.json'.format(shard)
+
+################################################################
+# Partitioning the proofs
+
+def partition(costs, count):
+    """Split the proofs into count shards of roughly equal total cost.
+
+    Each proof, from the most to the least costly, is assigned to the
+    shard with the least total cost so far, and then to the shard with
+    the fewest proofs so far, so that proofs without a recorded cost
+    are spread evenly.
+    """
+
+    if count < 1:
+        raise UserWarning("Can't split proofs into {} shards".format(count))
+    shards = [[] for _ in range(count)]
+    loads = [(0, 0, shard) for shard in range(count)]
+    for proof in sorted(costs, key=lambda proof: costs[proof], reverse=True):
+        load, size, shard = heapq.heappop(loads)
+        shards[shard].append(proof)
+        heapq.heappush(loads, (load + costs[proof], size + 1, shard))
+    return shards
+
+def write_manifest(filename, shards, costs):
+    """Write the manifest listing the proofs in each shard."""
+
+    with open(filename, 'w') as manifest:
+        json.dump({
+            'shards': [{
+                'build': shard_build_file(index),
+                'builddir': shard_build_dir(index),
+                'summary': shard_summary_file(index),
+                'cost': sum(costs[proof] for proof in proofs),
+                'proofs': proofs,
+            } for index, proofs in enumerate(shards)]
+        }, manifest, indent=2)
+
+def read_manifest(filename):
+    try:
+        with open(filename) as manifest:
+            return json.load(manifest)['shards']
+    except (FileNotFoundError, KeyError, ValueError):
+        raise UserWarning("Can't read shard manifest {}".format(filename))
+
+################################################################
+# Summarizing the results
+
+def get_expected(folder):
+    """Find the expected result of the proof in the proof Makefile."""
+
+    with open('{}/Makefile'.format(folder)) as makefile:
+        for line in makefile:
+            if line.strip().lower().startswith('h_expected'):
+                return line[line.find('=')+1:].strip()
+    return 'SUCCESSFUL'
+
+def get_result(folder):
+    """Find the result of the proof in the cbmc output."""
+
+    try:
+        with open('{}/cbmc.txt'.format(folder)) as output:
+            for line in output:
+                if line.startswith('VERIFICATION SUCCESSFUL'):
+                    return 'SUCCESSFUL'
+                if line.startswith('VERIFICATION FAILED'):
+                    return 'FAILURE'
+    except FileNotFoundError:
+        return 'MISSING'
+    return 'ERROR'
+
+def summarize(proofs):
+    """Summarize the results of a list of proofs."""
+
+    summary = {}
+    for proof in proofs:
+        expected = get_expected(proof)
+        result = get_result(proof)
+        summary[proof] = {
+            'expected': expected,
+            'result': result,
+            'passed': result == expected,
+        }
+    return summary
+
+def run_shard(manifest, shard, ninja, jobs):
+    """Run the proofs in a shard and write the summary of the shard."""
+
+    shards = read_manifest(manifest)
+    if not 0 <= shard < len(shards):
+        raise UserWarning("No shard {} in {}".format(shard, manifest))
+    command = [ninja, '-k', '0', '-f', shards[shard]['build']]
+    if jobs:
+        command += ['-j', str(jobs)]
+    status = subprocess.run(command).returncode
+    with open(shards[shard]['summary'], 'w') as summary:
+        json.dump({'shard': shard,
+                   'status': status,
+                   'proofs': summarize(shards[shard]['proofs'])},
+                  summary, indent=2)
+    return status
+
+def merge(manifest, output):
+    """Merge the summaries of the shards into one summary.
+
+    The proofs of a shard without a summary are reported as missing.
+    Return 0 if every proof has its expected result.
+    """
+
+    proofs = {}
+    for index, shard in enumerate(read_manifest(manifest)):
+        try:
+            with open(shard['summary']) as summary:
+                results = json.load(summary)['proofs']
+        except (FileNotFoundError, KeyError, ValueError):
+            results = {}
+        for proof in shard['proofs']:
+            proofs[proof] = results.get(proof, {'expected': None,
+                                                'result': 'MISSING',
+                                                'passed': False})
+            proofs[proof]['shard'] = index
+
+    failed = sorted(proof for proof, result in proofs.items()
+                    if not result['passed'])
+    with open(output, 'w') as summary:
+        json.dump({'total': len(proofs),
+                   'passed': len(proofs) - len(failed),
+                   'failed': failed,
+                   'proofs': proofs}, summary, indent=2, sort_keys=True)
+
+    print("{} of {} proofs passed".format(len(proofs) - len(failed),
+                                          len(proofs)))
+    for proof in failed:
+        print("  {}: expected {}, got {} (shard {})".format(
+            proof, proofs[proof]['expected'], proofs[proof]['result'],
+            proofs[proof]['shard']))
+    return 1 if failed else 0
+
+################################################################
+# Locking the object files of a goto build
+
+def lock_names(folder, name):
+    """Return the names of the locks for a goto build or a named lock."""
+
+    if name:
+        return [name]
+    # Imported here since ninja.py imports this module
+    from ninja import get_objects
+    return sorted({hashlib.sha1(obj.encode()).hexdigest()
+                   for obj in get_objects(folder)})
+
+def run_locked(names, cmd):
+    """Run a command holding a list of locks.
+
+    The locks are taken in a fixed order so that two goto builds
+    sharing object files can not deadlock.
+    """
+
+    if cmd and cmd[0] == '--':
+        cmd = cmd[1:]
+    if not cmd:
+        raise UserWarning("No command given to run holding {}".format(
+            ' '.join(names)))
+    lock_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    locks = []
+    try:
+        for name in sorted(names):
+            lock = open(os.path.join(lock_dir, name), 'w')
+            locks.append(lock)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return subprocess.run(cmd).returncode
+    finally:
+        for lock in locks:
+            lock.close()
+
+################################################################
+# The main function
+
+def main():
+    args = argument_parser().parse_args()
+    if args.command == 'run':
+        sys.exit(run_shard(args.manifest, args.shard, args.ninja, args.jobs))
+    if args.command == 'merge':
+        sys.exit(merge(args.manifest, args.output))
+    if args.command == 'lock':
+        sys.exit(run_locked(lock_names(args.folder, args.name), args.cmd))
+
+################################################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+Record and report the runtime and memory use of cbmc proofs.
+
+The record command runs one step of a proof (goto, cbmc, coverage,
+property, or report) and appends its wall time, cpu time, peak
+resident set size, exit status, and whether it was restored from the
+result cache of proof_cache.py to a ledger.  The ledger is a file
+with one json object per line.  The ninja build file written by
+ninja.py with --telemetry wraps every proof step in the record command.
+
+The report command ranks the proofs in a run by runtime and by memory
+use, and the diff command lists the proofs whose runtime or memory use
+grew between two runs.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+################################################################
+# The command line parser
+
+def argument_parser():
+    """Return the command line parser."""
+
+    parser = argparse.ArgumentParser(
+        description='Record and report cbmc proof telemetry.')
+    parser.add_argument('--ledger', metavar='LEDGER', default=DEFAULT_LEDGER,
+                        help='Ledger of proof telemetry (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    record = commands.add_parser(
+        'record', help='Run a proof step and record its telemetry')
+    record.add_argument('--run', metavar='RUN', required=True,
+                        help='Name of the run the step belongs to')
+    record.add_argument('--folder', metavar='PROOF', required=True,
+                        help='Folder containing the cbmc proof')
+    record.add_argument('--step', metavar='STEP', required=True,
+                        help='Name of the proof step')
+    record.add_argument('cmd', metavar='COMMAND', nargs=argparse.REMAINDER,
+                        help='Command running the proof step, after --')
+
+    report = commands.add_parser(
+        'report', help='Rank the slowest and most memory-hungry proofs')
+    report.add_argument('--run', metavar='RUN',
+                        help='Run to report on (default: the last run)')
+    report.add_argument('--top', metavar='N', type=int, default=10,
+                        help='Number of proofs to list (default: %(default)s)')
+
+    diff = commands.add_parser(
+        'diff', help='List the proofs that regressed between two runs')
+    diff.add_argument('--base', metavar='RUN',
+                      help='Run to compare against (default: the next to last run)')
+    diff.add_argument('--run', metavar='RUN',
+                      help='Run to compare (default: the last run)')
+    diff.add_argument('--threshold', metavar='FRACTION', type=float,
+                      default=0.2,
+                      help='Minimum relative growth reported (default: %(default)s)')
+    return parser
+
+DEFAULT_LEDGER = 'proof-telemetry.jsonl'
+
+# The environment variable naming the file a step writes to when it
+# restores its outputs from the result cache
+CACHE_HIT_ENV = 'PROOF_TELEMETRY_CACHE_HIT_FILE'
+
+################################################################
+# Recording
+
+def peak_rss_bytes(usage):
+    """Return the peak resident set size in a resource usage in bytes."""
+
+    # Linux reports kilobytes and macOS reports bytes
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+def report_cache_hit():
+    """Tell the record command running this step that it was a cache hit."""
+
+    hit_file = os.environ.get(CACHE_HIT_ENV)
+    if hit_file:
+        with open(hit_file, 'w') as handle:
+            handle.write('hit\n')
+
+def run_step(cmd):
+    """Run a command and return its telemetry."""
+
+    handle, hit_file = tempfile.mkstemp(prefix='proof-telemetry-')
+    os.close(handle)
+    try:
+        env = dict(os.environ)
+        env[CACHE_HIT_ENV] = hit_file
+        start = time.monotonic()
+        status = subprocess.run(cmd, env=env).returncode
+        wall = time.monotonic() - start
+        cache_hit = os.path.getsize(hit_file) > 0
+    finally:
+        os.remove(hit_file)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': round(wall, 3),
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        'rss': peak_rss_bytes(usage),
+        'status': status,
+        'cache_hit': cache_hit,
+    }
+
+def append_record(ledger, record):
+    """Append a record to the ledger.
+
+    The ledger is locked so that concurrent steps do not interleave
+    their records.
+    """
+
+    with open(ledger, 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        handle.write(json.dumps(record, sort_keys=True) + '\n')
+
+def record_step(ledger, run, folder, step, cmd):
+    """Run a proof step, record its telemetry, and return its exit status."""
+
+    if cmd and cmd[0] == '--':
+        cmd = cmd[1:]
+    if not cmd:
+        raise UserWarning("No command given for step {} of {}".format(step, folder))
+    record = {
+        'run': run,
+        'proof': os.path.normpath(folder),
+        'step': step,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    record.update(run_step(cmd))
+    append_record(ledger, record)
+    return record['status']
+
+################################################################
+# Reporting
+
+def read_ledger(ledger):
+    """Read the records in a ledger, skipping any malformed line."""
+
+    records = []
+    try:
+        with open(ledger) as handle:
+            for line in handle:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+def runs(records):
+    """Return the names of the runs in a ledger in order of appearance."""
+
+    names = []
+    for record in records:
+        if record['run'] not in names:
+            names.append(record['run'])
+    return names
+
+def proof_totals(records, run):
+    """Summarize the steps of each proof in a run.
+
+    Return a dict mapping each proof to its total wall time, total cpu
+    time, peak resident set size, the steps that failed, and the steps
+    restored from the result cache.  A step recorded more than once in
+    a run counts only once, with its last record.
+    """
+
+    steps = {}
+    for record in records:
+        if record['run'] == run:
+            steps[(record['proof'], record['step'])] = record
+    totals = {}
+    for (proof, step), record in steps.items():
+        total = totals.setdefault(proof, {'wall': 0.0, 'cpu': 0.0, 'rss': 0,
+                                          'failed': [], 'cached': []})
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['rss'] = max(total['rss'], record['rss'])
+        if record['status']:
+            total['failed'].append(step)
+        if record.get('cache_hit'):
+            total['cached'].append(step)
+    return totals
+
+def proof_costs(ledger):
+    """Return the cost of each proof recorded in a ledger.
+
+    The cost of a proof is the sum of the wall times of its steps, each
+    step taken from the last run in which it was not restored from the
+    result cache, since a restored step costs next to nothing but would
+    cost as much as before when the cache misses.
+    """
+
+    steps = {}
+    for record in read_ledger(ledger):
+        if not record.get('cache_hit'):
+            steps[(record['proof'], record['step'])] = record['wall']
+    costs = {}
+    for (proof, _), wall in steps.items():
+        costs[proof] = costs.get(proof, 0.0) + wall
+    return costs
+
+def megabytes(size):
+    return '{:.0f}MB'.format(size / (1 << 20))
+
+def report(ledger, run, top):
+    """Print the slowest and most memory-hungry proofs in a run."""
+
+    records = read_ledger(ledger)
+    if not records:
+        print("No telemetry in {}".format(ledger))
+        return
+    run = run or runs(records)[-1]
+    totals = proof_totals(records, run)
+
+    print("Run {}: {} proofs, {:.1f}s wall, {:.1f}s cpu, "
+          "{} steps from the cache".format(
+              run, len(totals),
+              sum(total['wall'] for total in totals.values()),
+              sum(total['cpu'] for total in totals.values()),
+              sum(len(total['cached']) for total in totals.values())))
+
+    print("\nSlowest proofs:")
+    for proof, total in sorted(totals.items(),
+                               key=lambda item: item[1]['wall'],
+                               reverse=True)[:top]:
+        print("  {:>10.1f}s {:>10.1f}s cpu  {}".format(
+            total['wall'], total['cpu'], proof))
+
+    print("\nMost memory-hungry proofs:")
+    for proof, total in sorted(totals.items(),
+                               key=lambda item: item[1]['rss'],
+                               reverse=True)[:top]:
+        print("  {:>10}  {}".format(megabytes(total['rss']), proof))
+
+    failed = [(proof, total['failed'])
+              for proof, total in sorted(totals.items()) if total['failed']]
+    if failed:
+        print("\nFailed steps:")
+        for proof, steps in failed:
+            print("  {}: {}".format(proof, ' '.join(steps)))
+
+def diff(ledger, base, run, threshold):
+    """Print the proofs whose runtime or memory use grew between two runs.
+
+    A proof with steps restored from the cache in either run is not
+    compared, since its runtime says nothing about the proof itself.
+    """
+
+    records = read_ledger(ledger)
+    names = runs(records)
+    run = run or (names[-1] if names else None)
+    if not base and run in names[1:]:
+        base = names[names.index(run) - 1]
+    if not base or not run:
+        print("Need two runs in {} to compare".format(ledger))
+        return
+    old = proof_totals(records, base)
+    new = proof_totals(records, run)
+
+    print("Comparing run {} against run {}".format(run, base))
+    regressions = 0
+    for proof in sorted(set(old) & set(new)):
+        if old[proof]['cached'] or new[proof]['cached']:
+            continue
+        for key, show in [('wall', lambda value: '{:.1f}s'.format(value)),
+                          ('rss', megabytes)]:
+            before, after = old[proof][key], new[proof][key]
+            if before and (after - before) / before > threshold:
+                regressions += 1
+                print("  {:<4} {:>10} -> {:>10} ({:+.0%})  {}".format(
+                    key, show(before), show(after),
+                    (after - before) / before, proof))
+    if not regressions:
+        print("  No regressions above {:.0%}".format(threshold))
+    for proof in sorted(set(new) - set(old)):
+        print("  new  {}".format(proof))
+    for proof in sorted(set(old) - set(new)):
+        print("  gone {}".format(proof))
+
+################################################################
+# The main function
+
+def main():
+    args = argument_parser().parse_args()
+    if args.command == 'record':
+        sys.exit(record_step(args.ledger, args.run, args.folder, args.step,
+                             args.cmd))
+    if args.command == 'report':
+        report(args.ledger, args.run, args.top)
+    if args.command == 'diff':
+        diff(args.ledger, args.base, args.run, args.threshold)
+
+################################################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(my_path))
+
+import pytest
+
+import proof_impact
+
+
+def write(path, text=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as handle:
+        handle.write(text)
+
+def write_proof(folder, entry):
+    write(os.path.join(folder, 'Makefile'),
+          'H_ENTRY = {}\nH_OBJS_EXCEPT_HARNESS = \n'.format(entry))
+
+@pytest.fixture
+def proofs(tmp_path):
+    """A plain proof and a proof with two configurations."""
+
+    root = str(tmp_path)
+    plain = os.path.join(root, 'ARP', 'ARPAgeCache')
+    write(os.path.join(plain, 'ARPAgeCache_harness.c'))
+    write_proof(plain, 'ARPAgeCache')
+
+    configured = os.path.join(root, 'ARP', 'ARPGetCacheEntry')
+    harness = os.path.join(configured, 'ARPGetCacheEntry_harness.c')
+    write(harness)
+    write(os.path.join(configured, 'Configurations.json'), '{}')
+    folders = [plain]
+    for config in ['config_default', 'config_LLMNR']:
+        folder = os.path.join(configured, config)
+        os.makedirs(folder)
+        os.link(harness, os.path.join(folder, 'ARPGetCacheEntry_harness.c'))
+        write_proof(folder, 'ARPGetCacheEntry')
+        folders.append(folder)
+    return folders
+
+def changed_proofs(proofs, *names):
+    root = os.path.dirname(os.path.dirname(proofs[0]))
+    changed = [os.path.join(root, name) for name in names]
+    return [os.path.relpath(proof, root)
+            for proof in proof_impact.affected_proofs(proofs, changed)]
+
+def test_plain_harness_selects_its_proof(proofs):
+    assert changed_proofs(proofs, 'ARP/ARPAgeCache/ARPAgeCache_harness.c') == \
+        [os.path.join('ARP', 'ARPAgeCache')]
+
+configured_changes = [
+    'ARP/ARPGetCacheEntry/ARPGetCacheEntry_harness.c',
+    'ARP/ARPGetCacheEntry/Configurations.json',
+]
+@pytest.mark.parametrize("name", configured_changes)
+def test_configuration_folder_selects_every_configuration(proofs, name):
+    assert changed_proofs(proofs, name) == [
+        os.path.join('ARP', 'ARPGetCacheEntry', 'config_default'),
+        os.path.join('ARP', 'ARPGetCacheEntry', 'config_LLMNR'),
+    ]
+
+def test_configuration_selects_only_itself(proofs):
+    assert changed_proofs(
+        proofs, 'ARP/ARPGetCacheEntry/config_LLMNR/Makefile') == \
+        [os.path.join('ARP', 'ARPGetCacheEntry', 'config_LLMNR')]
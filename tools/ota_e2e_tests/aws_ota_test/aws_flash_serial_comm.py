@@ -25,17 +25,24 @@ http://www.FreeRTOS.org
 """
 import subprocess
 import serial
+import codecs
 import os
+import sys
 from shutil import copyfile
 from time import sleep
-from threading import Thread, Condition
+from threading import Thread, Condition, Event
+from .aws_serial_log import SerialLogBuffer
+from .aws_serial_matcher import SerialPatternMatcher
+from .aws_serial_async import getSerialHub
 
 class FlashSerialComm:
     """Manage flashing and reading the output through the serial port of the board.
 
     Attributes:
         _flashConfig (dict): flash configuration defined in board.json under the filed 'flash_config'.
-        _serialThread (Thread): Long running thread that stores a log of the data read.
+        _serialThread (Thread): Long running thread that stores a log of the data read. With
+            'serial_transport' set to 'asyncio' in the flash_config, an AsyncSerialPort read by the
+            event loop shared by all of the boards instead.
     Example:
         flashComm = FlashSerialComm(flashConfig)
         flashComm.flashAndRead()
@@ -46,19 +53,37 @@ class FlashSerialComm:
     """
     def __init__(self, flashConfig, initial_image = None, reset_image = None):
         self._flashConfig = flashConfig
+        logBuffer = SerialLogBuffer(
+            flashConfig.get('serial_log_buffer_bytes', 4 * 1024 * 1024),
+            flashConfig.get('serial_log_spill_dir'),
+            flashConfig.get('serial_log_spill_file_bytes', 64 * 1024 * 1024),
+            flashConfig.get('serial_log_spill_files', 3)
+        )
         if flashConfig.get('run_executable', False):
             self._serialThread = ReadSerialThread(
                 flashConfig['serial_port'],
                 flashConfig['serial_baudrate'],
                 flashConfig['serial_timeout_sec'],
                 initial_image,
-                reset_image
+                reset_image,
+                logBuffer=logBuffer,
+                echo=flashConfig.get('serial_echo', True)
+            )
+        elif flashConfig.get('serial_transport', 'thread') == 'asyncio':
+            self._serialThread = getSerialHub().openPort(
+                flashConfig['serial_port'],
+                flashConfig['serial_baudrate'],
+                flashConfig['serial_timeout_sec'],
+                logBuffer=logBuffer,
+                echo=flashConfig.get('serial_echo', True)
             )
         else:
             self._serialThread = ReadSerialThread(
                 flashConfig['serial_port'],
                 flashConfig['serial_baudrate'],
-                flashConfig['serial_timeout_sec']
+                flashConfig['serial_timeout_sec'],
+                logBuffer=logBuffer,
+                echo=flashConfig.get('serial_echo', True)
             )
         # Start the serial reading thread, it will wait until we tell it to start reading.
         self._serialThread.start()
@@ -96,7 +121,7 @@ class FlashSerialComm:
         """Flash program the board and also open a serial port for reading.
         """
         retryCount = 0
-        testOutput = ''
+        testOutput = 0
         returnCodes = []
 
         while (not testOutput) and retryCount < self._flashConfig['flash_num_retry']:
@@ -120,8 +145,8 @@ class FlashSerialComm:
 
             # Wait the serial communication timeout to get an initial log output.
             sleep(self._flashConfig['serial_timeout_sec'])
-            # Get the initial log, it should not be blank, if it is we will repeat flashing.
-            testOutput = self._serialThread.getLog()
+            # Get the size of the initial log, it should not be blank, if it is we will repeat flashing.
+            testOutput = self._serialThread.getLogBuffer().size()
             retryCount += 1
 
         return returnCodes
@@ -136,6 +161,22 @@ class FlashSerialComm:
         """
         return self._serialThread.getLog()
 
+    def getSerialLogBuffer(self):
+        """Get the SerialLogBuffer of the serial thread, to read the log incrementally.
+        """
+        return self._serialThread.getLogBuffer()
+
+    def getSerialMatcher(self):
+        """Get the SerialPatternMatcher the serial thread feeds the lines it reads to.
+        """
+        return self._serialThread.getMatcher()
+
+    def writeSerialLog(self, outFile):
+        """Write the whole log since the board was last flashed, including the output dropped from
+        the log buffer, to a file open in binary mode.
+        """
+        self._serialThread.getLogBuffer().writeTo(outFile)
+
     def cleanup(self):
         """Clean up resources. Once cleaned this object cannot be used again.
         """
@@ -161,11 +202,12 @@ class ReadSerialThread(Thread):
         _stopRead (bool): Initially set to false so that we can begin reading as soon
             as we are told to grab the serial port. set to true in the middle of a read
             to let go of the serial port. The thread does not exit we go to the
-            _holdBeforeOpen state.
+            _openEvent wait.
         _exitRun (bool): Thread exits if this is set to True.
-        _holdBeforeOpen (bool): variable to wait on before opening the serial port for
-            reading.
-        _log (str): All of the serial output in the last run.
+        _openEvent (Event): Set to open the serial port for reading.
+        _logBuffer (SerialLogBuffer): The serial output in the last run.
+        _echo (bool): Print the serial output as it is read.
+        _matcher (SerialPatternMatcher): Matches the lines read against the registered patterns.
 
     Example:
         serialThread = ReadSerialThread(
@@ -179,7 +221,12 @@ class ReadSerialThread(Thread):
         log = serialThread.getLog()
         serialThread.close()
     """
-    def __init__(self, port, baudrate, serialTimeout, initial_executable = None, reset_executable = None):
+    # Read at most this many bytes at once from the output of an executable.
+    READ_SIZE = 65536
+    # The executable waits to be run again when it prints this.
+    RESET_MARKER = b'Please reset manually'
+
+    def __init__(self, port, baudrate, serialTimeout, initial_executable = None, reset_executable = None, logBuffer = None, echo = True):
         Thread.__init__(self)
         self._initial_executable = initial_executable
         self._reset_executable = reset_executable
@@ -188,8 +235,10 @@ class ReadSerialThread(Thread):
         self._timeout = serialTimeout
         self._stopRead = False
         self._exitRun = False
-        self._holdBeforeOpen = True
-        self._log = ''
+        self._openEvent = Event()
+        self._logBuffer = logBuffer if logBuffer else SerialLogBuffer()
+        self._echo = echo
+        self._matcher = SerialPatternMatcher()
 
     def stopRead(self):
         """ Stop reading from the serial port. This will not exit the thread. It will
@@ -201,52 +250,79 @@ class ReadSerialThread(Thread):
         """ Exit the thread.
         """
         self._exitRun = True
+        self._openEvent.set()
 
     def startRead(self):
         """ Start the serial reading. This will open the serial port and begin reading.
         """
-        self._holdBeforeOpen = False
+        self._openEvent.set()
 
     def getLog(self):
         """ Get the current serial log.
         """
-        return self._log
+        return self._logBuffer.getText()
+
+    def getLogBuffer(self):
+        """ Get the SerialLogBuffer holding the serial log.
+        """
+        return self._logBuffer
+
+    def getMatcher(self):
+        """ Get the SerialPatternMatcher fed with each line read.
+        """
+        return self._matcher
 
     def clearLog(self):
         """ Clear the serial log.
         """
-        self._log = ''
+        self._logBuffer.clear()
+
+    def _readChunk(self, outStream):
+        """ Read the bytes available, waiting up to the timeout for at least one.
+        """
+        if hasattr(outStream, 'read1'):
+            return outStream.read1(ReadSerialThread.READ_SIZE)
+        return outStream.read(max(1, outStream.in_waiting))
 
     def _readOutput(self, outStream):
         # Read until we are told to stop.
         self._stopRead = False
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # The end of the previous chunk, in case the reset marker is split across chunks.
+        tail = b''
+        # The lines after this cursor are not matched yet.
+        cursor = self._logBuffer.getEnd()
         while self._stopRead == False and not self._exitRun:
             try:
-                line = outStream.readline().decode()
-                # For windows simulator once we reach a reboot place, then we will manually reboot.
-                if 'Please reset manually' in line:
-                    return 'reset'
-            except UnicodeDecodeError:
-                # Discard data if fails to decode.
-                pass
+                data = self._readChunk(outStream)
             except Exception:
-                # All other exceptions stop the read.
+                # All exceptions stop the read.
                 self._stopRead = True
+                continue
+            if not data:
+                continue
+            self._logBuffer.append(data)
+            if self._echo:
+                sys.stdout.write(decoder.decode(data))
+            if self._matcher.hasPatterns():
+                lines, cursor = self._logBuffer.readLinesSince(cursor)
+                self._matcher.feed(lines)
             else:
-                if not line:
-                    continue
-                print(line, end='')
-                self._log += line
+                # Patterns only match the lines read after they are added.
+                cursor = self._logBuffer.getEnd()
+            # For windows simulator once we reach a reboot place, then we will manually reboot.
+            if ReadSerialThread.RESET_MARKER in tail + data:
+                return 'reset'
+            tail = data[-len(ReadSerialThread.RESET_MARKER):]
 
     def run(self):
         """ Run until this object is closed.
         """
         while not self._exitRun:
             # Start out each new read paused.
-            self._holdBeforeOpen = True
-            # Nonblocking wait for the open of the serial port.
-            while self._holdBeforeOpen and not self._exitRun:
-                sleep(0.5)
+            self._openEvent.clear()
+            # Wait for the open of the serial port.
+            self._openEvent.wait()
             # Exit the run if we are told to do so.
             if self._exitRun: continue
 
@@ -270,5 +346,5 @@ class ReadSerialThread(Thread):
         self.stopRead()
         # Exit the thread run().
         self.__exitRun()
-        # Clear the log file.
-        self.clearLog()
+        # Clear the log and free its spill files.
+        self._logBuffer.close()
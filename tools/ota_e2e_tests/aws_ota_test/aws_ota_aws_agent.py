@@ -23,38 +23,30 @@ http://aws.amazon.com/freertos
 http://www.FreeRTOS.org
 
 """
-import boto3
 import botocore
+import hashlib
+import threading
 import time
 import os
 import sys
-import subprocess
-import json
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime
-from collections import namedtuple
-
-def awsIotCliCommandForNonProdStage(command, stageParams):
-    """Custom AWS IoT CLI command using the input command parameters and the
-    stage parameters. A response is returned in JSON if there is one.
-    Args:
-        command(str): AWS IoT CLI Command and options omitting 'aws iot'
-        stageParams(dict): 'endpoint-url' and 'region' retrieved from the ota_e2e script arguments.
+from .aws_ota_aws_clients import getAwsClientPool
+from .aws_ota_job_watcher import OtaJobWatcher, MqttJobNotifier, JobStatus, FINISHED_JOB_STATUSES
+
+# Firmware images larger than this are uploaded to S3 in parts of this size, many parts at once.
+S3_MULTIPART_CHUNK_BYTES = 8 * 1024 * 1024
+S3_MULTIPART_CONCURRENCY = 8
+
+def fileSha256(path):
+    """Get the hex SHA-256 digest of the content of a file, read in chunks.
     """
-    response = subprocess.check_output(
-        'aws ' + \
-        'iot ' + \
-        command + ' ' + \
-        '--region ' + \
-        stageParams['region'] + ' ' + \
-        '--endpoint-url ' + \
-        stageParams['endpoint-url'],
-        shell=True # Test machine needs this parameter
-    )
-    if response:
-        response = response.decode('utf-8')
-        response = json.loads(response)
-    return response
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 class OtaAwsAgent:
     """OtaAwsAgent manages all AWS resource usage related to OTA.
@@ -77,7 +69,7 @@ class OtaAwsAgent:
     - Exceptions in testing should clean up AWS resources using OtaAwsAgent.cleanup().
 
     Attributes:
-        _awsIotClient(obj): boto3 AWS CLI IoT client
+        _awsIotClient(obj): boto3 AWS IoT client, shared with the other agents through the AwsClientPool.
         _cleanOnExit(bool): Should all of the AWS resources get cleaned when this agent exits?
         _iotThing: The IoT thing created with this AwsOtaAgent.
         _s3Bucket: The S3 bucket created with this AwsOtaAgent.
@@ -91,10 +83,13 @@ class OtaAwsAgent:
         uploadFirmwareToSignedBucket(localPathToFirmware, firmwareFileName)
         uploadFirmwareToS3Bucket(localPathToFirmware, firmwareFileName)
         signFirmwareInS3Bucket(firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform)
+        submitFirmwareSigning(localPathToFirmware, firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform)
         createIotStream(s3BucketName = None, firmwareFileName = None, customFiles = None)
         createOtaUpdate(deviceImageFileName = None, streamId = None, signerJobId = None, customFiles = None)
         quickCreateOtaUpdate(otaConfig)
-        pollOtaUpdateCompletion(otaUpdateId, timeout)
+        pollOtaUpdateCompletion(otaUpdateId, timeout, stopEvent)
+        waitOtaUpdatesCompletion(otaUpdateIds, timeout, stopEvent)
+        stopWaitingOtaUpdates(stopEvent)
         cancelJob(jobId)
         cleanup()
         __getJobStatus(jobId)
@@ -111,7 +106,7 @@ class OtaAwsAgent:
         otaUpdateId = self.createOtaUpdate(otaConfig['device_firmware_file_name'], streamId, signerJobId)
     """
     def __init__(self, boardName, otaConfig, stageParams, cleanOnExit):
-        self._awsIotClient = boto3.client('iot')
+        self._awsIotClient = getAwsClientPool().client('iot', stageParams)
         self._cleanOnExit = cleanOnExit
         self._iotThing = AWSIoTThing(boardName, stageParams)
         self._s3Bucket = AWSS3Bucket(otaConfig['aws_s3_bucket_name'], stageParams)
@@ -119,6 +114,14 @@ class OtaAwsAgent:
         self._stageParams = stageParams
         self._boardName = boardName
         self._protocols = otaConfig['data_protocols']
+        self._jobNotifications = otaConfig.get('job_notifications', True)
+        self._jobNotificationBroker = otaConfig.get('job_notification_broker')
+        self._jobWatcher = None
+        self._jobNotifier = None
+        self._transferWorkers = otaConfig.get('aws_transfer_workers', 4)
+        self._transferExecutor = None
+        self._signingFutures = {}
+        self._signingFuturesLock = threading.Lock()
 
         # TODO: Create an OTA Role automatically with agent creation.
         # TODO: Create certificates and upload to ACM with agent creation.
@@ -132,34 +135,26 @@ class OtaAwsAgent:
 
     def getAwsIotEndpoint(self):
         """Return the AWS IoT Core custom endpoint defined under the "Settings" section in the AWS IoT Core console.
+        The endpoint is looked up once per process.
         """
-        response = {}
-        if self._stageParams:
-            response = awsIotCliCommandForNonProdStage(
-                'describe-endpoint',
-                self._stageParams
-            )
-        else:
-            response = self._awsIotClient.describe_endpoint(endpointType='iot:Data-ATS')
-        return response['endpointAddress']
+        # Non-production stages only have the legacy endpoint type.
+        endpointType = {} if self._stageParams else {'endpointType': 'iot:Data-ATS'}
+        return getAwsClientPool().memoize(
+            ('describe_endpoint', self._awsIotClient.meta.region_name, self._awsIotClient.meta.endpoint_url),
+            lambda: self._awsIotClient.describe_endpoint(**endpointType)['endpointAddress']
+        )
 
     def getCodeSignerCertificateFromArn(self, certArn):
         """Get the certificate stored in ACM identified by the input ARN.
         If we are running in the beta stage, the certificate ARN for the designated region
         should have been configured the board configuration JSON.
+        The certificate is looked up once per process.
         """
-        certificate = ''
-        if self._stageParams:
-            response = subprocess.check_output(
-                'aws acm get-certificate --certificate-arn ' + certArn + ' ' + \
-                '--region ' + \
-                self._stageParams['region'],
-                shell=True
-            ).decode('utf-8')
-            certificate = json.loads(response)['Certificate']
-        else:
-            certificate = boto3.client('acm').get_certificate(CertificateArn=certArn)['Certificate']
-        return certificate
+        acmClient = getAwsClientPool().client('acm', self._stageParams)
+        return getAwsClientPool().memoize(
+            ('get_certificate', certArn),
+            lambda: acmClient.get_certificate(CertificateArn=certArn)['Certificate']
+        )
 
     def getThingName(self):
         """Get the name of the thing associate with this OTA agent. """
@@ -180,7 +175,7 @@ class OtaAwsAgent:
     def getS3ObjectVersion(self, key):
         """Get the version of the object, in the s3 bucket held by this OTA AWS agent, denoted by key.
         Will throw an exception if the the object doesn't exist."""
-        return self._s3Bucket.get_s3_object(key).version_id
+        return self._s3Bucket.get_version_id(key)
 
     def downloadS3File(self, key, fileSavePath):
         """Download the firmware file specified by key to the fileSavePath.
@@ -195,10 +190,12 @@ class OtaAwsAgent:
         Args:
             localPathToFirmware(str): The path on the machine this script is running of the firmware image.
             firmwareFileName(str): The name of the firmware, this is used as the key in the S3 bucket.
+        Returns the version ID of the S3 object with the firmware. The upload is skipped if the latest version
+        of the key already has the same content, see AWSS3Bucket.upload_file().
         """
-        self._s3Bucket.upload_file(localPathToFirmware, firmwareFileName)
+        return self._s3Bucket.upload_file(localPathToFirmware, firmwareFileName)
 
-    def signFirmwareInS3Bucket(self, firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform, profileName = None):
+    def signFirmwareInS3Bucket(self, firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform, profileName = None, firmwareVersionId = None):
         """Signs the firmware with key firmwareFileName.
         Returns the signer job ID, which is also the key of signed image.
         Args:
@@ -208,100 +205,65 @@ class OtaAwsAgent:
             awsSignerCertArn(str): The ARN of the signer certificates in ACM.
             awsSignerCertFilename(str): The path on the MCU device of the signer certificate.
             signerPlatform(str): The AWS Signer service identifier for the MCU.
+            firmwareVersionId(str): The version of the firmware object to sign, as returned by
+                uploadFirmwareToS3Bucket(). The latest version is signed if it is not given.
         """
-        # Create an AWS Signer client.
-        signer = boto3.client('signer')
+        # Get the AWS Signer client, at the signer endpoint of the stage if any.
+        signer = getAwsClientPool().client('signer', self._stageParams)
         # Timeout on AWS signer service.
         AWS_SIGNER_TIMEOUT = 30
 
         if not profileName:
             profileName = f'{self.getThingName()[-8:]}{self._boardName[:10]}'
 
-        # Get the object.
-        firmwareObject = self._s3Bucket.get_s3_object(firmwareFileName)
-
-        if self._stageParams:
-            try:
-                # region parameter needed for beta is now allowed in the boto3 API.
-                response = subprocess.check_output(
-                    'aws signer put-signing-profile --profile-name ' + profileName + ' ' + \
-                    '--signing-material certificateArn=\"' + awsSignerCertArn + '\" ' + \
-                    '--platform-id ' + signerPlatform + ' ' + \
-                    '--signing-parameters certname=\" ' + awsSignerCertFilename + '\" ' + \
-                    '--region ' + self._stageParams['region'] + \
-                    (' --endpoint-url ' + self._stageParams['signer-endpoint-url'] if self._stageParams['signer-endpoint-url'] else ''),
-                    shell=True
-                ).decode('utf-8')
-                print('put-signing-profile response: ' + response)
-            except Exception as e:
-                # Do nothing when put-signing-profile fails because that means that the signing profile probably already
-                # exists.
-                print(e)
-
-            startSigningResponse = subprocess.check_output(
-                'aws signer start-signing-job ' + \
-                '--profile-name ' + profileName + ' ' + \
-                '--source \"s3={bucketName=' + self._s3Bucket.s3_name + ',key=' + firmwareFileName + ',version=' + firmwareObject.version_id + '}\" ' + \
-                '--destination \"s3={bucketName=' + self._s3Bucket.s3_name + '}\" ' + \
-                '--region ' + self._stageParams['region'] + \
-                (' --endpoint-url ' + self._stageParams['signer-endpoint-url'] if self._stageParams['signer-endpoint-url'] else ''),
-                shell=True
-            ).decode('utf-8')
-            startSigningResponse = json.loads(startSigningResponse)
-        else:
-            try:
-                signer.put_signing_profile(
-                    profileName = profileName,
-                    signingMaterial = {
-                        'certificateArn' : awsSignerCertArn,
-                    },
-                    platformId = signerPlatform,
-                    signingParameters = {
-                        'certname' : awsSignerCertFilename
-                    }
-                )
-            except Exception as e:
-                # Do nothing when put-signing-profile fails because that means that the signing profile probably already
-                # exists.
-                print(e)
-                print('NOTE: If the last error was a name already exists error that is OK.')
-
-            # Start a signing job on the new firmware image.
-            startSigningResponse = signer.start_signing_job(
-                clientRequestToken = str(uuid4()),
-                profileName= profileName,
-                destination = {
-                    's3': {
-                        'bucketName': self._s3Bucket.s3_name,
-                        'prefix': ''
-                    }
+        # Get the version of the object to sign.
+        if not firmwareVersionId:
+            firmwareVersionId = self._s3Bucket.get_version_id(firmwareFileName)
+
+        try:
+            signer.put_signing_profile(
+                profileName = profileName,
+                signingMaterial = {
+                    'certificateArn' : awsSignerCertArn,
                 },
-                source = {
-                    's3': {
-                        'bucketName': self._s3Bucket.s3_name,
-                        'key': firmwareFileName,
-                        'version': firmwareObject.version_id
-                    }
+                platformId = signerPlatform,
+                signingParameters = {
+                    'certname' : awsSignerCertFilename
                 }
             )
+        except Exception as e:
+            # Do nothing when put-signing-profile fails because that means that the signing profile probably already
+            # exists.
+            print(e)
+            print('NOTE: If the last error was a name already exists error that is OK.')
+
+        # Start a signing job on the new firmware image.
+        startSigningResponse = signer.start_signing_job(
+            clientRequestToken = str(uuid4()),
+            profileName= profileName,
+            destination = {
+                's3': {
+                    'bucketName': self._s3Bucket.s3_name,
+                    'prefix': ''
+                }
+            },
+            source = {
+                's3': {
+                    'bucketName': self._s3Bucket.s3_name,
+                    'key': firmwareFileName,
+                    'version': firmwareVersionId
+                }
+            }
+        )
 
-        # Confirm that the signing job succeeded
+        # Confirm that the signing job succeeded, checking often at first since small images sign in about a second.
         timeout_end = time.time() + AWS_SIGNER_TIMEOUT
         signingInProgress = True
+        pollInterval = 0.25
         while signingInProgress and time.time() < timeout_end:
-            time.sleep(1)
-            describeSigningResponse = {}
-            if self._stageParams:
-                describeSigningResponse = subprocess.check_output(
-                    'aws signer describe-signing-job ' + \
-                    '--job-id ' + startSigningResponse['jobId'] + ' ' + \
-                    '--region ' + self._stageParams['region'] + \
-                    (' --endpoint-url ' + self._stageParams['signer-endpoint-url'] if self._stageParams['signer-endpoint-url'] else ''),
-                    shell=True
-                ).decode('utf-8')
-                describeSigningResponse = json.loads(describeSigningResponse)
-            else:
-                describeSigningResponse = signer.describe_signing_job(jobId = startSigningResponse['jobId'])
+            time.sleep(pollInterval)
+            pollInterval = min(pollInterval * 2, 2)
+            describeSigningResponse = signer.describe_signing_job(jobId = startSigningResponse['jobId'])
             if describeSigningResponse['status'] != 'InProgress':
                 signingInProgress = False
 
@@ -317,6 +279,47 @@ class OtaAwsAgent:
 
         return describeSigningResponse['jobId']
 
+    def __getTransferExecutor(self):
+        """Get the threads uploading and signing firmware in the background, created on first use.
+        """
+        if not self._transferExecutor:
+            self._transferExecutor = ThreadPoolExecutor(max_workers=self._transferWorkers, thread_name_prefix=f'{self._boardName}-transfer')
+        return self._transferExecutor
+
+    def __uploadAndSignFirmware(self, localPathToFirmware, firmwareFileName, digest, awsSignerCertArn, awsSignerCertFilename, signerPlatform, profileName):
+        # Sign the version just uploaded, not the latest one, which another submission may have replaced.
+        versionId = self._s3Bucket.upload_file(localPathToFirmware, firmwareFileName, digest)
+        return self.signFirmwareInS3Bucket(firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform, profileName, versionId)
+
+    def submitFirmwareSigning(self, localPathToFirmware, firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform, profileName = None):
+        """Upload a firmware image to the S3 bucket and sign it in the background.
+        Returns a concurrent.futures.Future of the signer job ID returned by signFirmwareInS3Bucket().
+        Submit all of the images needed first and then wait on the futures, so that their uploads and
+        signing jobs overlap. An image with the same content, key and signing parameters as one already
+        submitted to this agent is neither uploaded nor signed again: its future is returned, unless its
+        signing failed.
+        Args:
+            localPathToFirmware(str): The path on the machine this script is running of the firmware image.
+            The other arguments are those of uploadFirmwareToS3Bucket() and signFirmwareInS3Bucket().
+        """
+        digest = fileSha256(localPathToFirmware)
+        key = (digest, firmwareFileName, awsSignerCertArn, awsSignerCertFilename, signerPlatform, profileName)
+        with self._signingFuturesLock:
+            future = self._signingFutures.get(key)
+            if future is None or (future.done() and (future.exception() or future.result() is None)):
+                future = self.__getTransferExecutor().submit(
+                    self.__uploadAndSignFirmware,
+                    localPathToFirmware,
+                    firmwareFileName,
+                    digest,
+                    awsSignerCertArn,
+                    awsSignerCertFilename,
+                    signerPlatform,
+                    profileName
+                )
+                self._signingFutures[key] = future
+            return future
+
     def createIotStream(self, s3BucketName = None, firmwareFileName = None, customFiles = None):
         """Create an IOT stream of the firmware file in the given s3 bucket.
         Args:
@@ -336,21 +339,11 @@ class OtaAwsAgent:
                 },
             ]
 
-        if self._stageParams:
-            createStreamResponse = awsIotCliCommandForNonProdStage(
-                'create-stream --stream-id ' + \
-                str(uuid4()) + ' --files \"' + \
-                json.dumps(customFiles).replace('\"', '\\\"') + \
-                '\" --role-arn ' + \
-                self._otaRoleArn,
-                self._stageParams
-            )
-        else:
-            createStreamResponse = self._awsIotClient.create_stream(
-                streamId = str(uuid4()),
-                files= customFiles,
-                roleArn = self._otaRoleArn
-            )
+        createStreamResponse = self._awsIotClient.create_stream(
+            streamId = str(uuid4()),
+            files= customFiles,
+            roleArn = self._otaRoleArn
+        )
 
         return createStreamResponse['streamId']
 
@@ -369,55 +362,27 @@ class OtaAwsAgent:
         # Timeout for the AWS Job service to create an OTA update job.
         AWS_CREATE_OTA_UPDATE_JOB_TIMEOUT = 60
 
-        createOtaResponse = {}
-        if self._stageParams:
-            createOtaResponse = awsIotCliCommandForNonProdStage(
-                'create-ota-update ' + \
-                '--ota-update-id ' + \
-                str(uuid4()) + ' ' + \
-                '--files ' + \
-                '\"' + json.dumps(deploymentFiles).replace('\"', '\\\"') + '\" ' + \
-                '--targets ' + \
-                self._iotThing.thing_arn + ' ' + \
-                '--role-arn ' + \
-                self._otaRoleArn + ' ' + \
-                '--protocols ' + \
-                ' '.join(protocols) + ' ' + \
-                '--aws-job-presigned-url-config ' + \
-                'expiresInSec=' + str(urlExpired),
-                self._stageParams
-            )
-        else:
-            createOtaResponse = self._awsIotClient.create_ota_update(
-                otaUpdateId=str(uuid4()),
-                targets=[
-                    self._iotThing.thing_arn
-                ],
-                targetSelection='SNAPSHOT',
-                roleArn=self._otaRoleArn,
-                files=deploymentFiles,
-                protocols=protocols,
-                awsJobPresignedUrlConfig={
-                    'expiresInSec': urlExpired
-                }
-            )
+        createOtaResponse = self._awsIotClient.create_ota_update(
+            otaUpdateId=str(uuid4()),
+            targets=[
+                self._iotThing.thing_arn
+            ],
+            targetSelection='SNAPSHOT',
+            roleArn=self._otaRoleArn,
+            files=deploymentFiles,
+            protocols=protocols,
+            awsJobPresignedUrlConfig={
+                'expiresInSec': urlExpired
+            }
+        )
 
         # Confirm that the OTA update job is ready.
         timeout_end = time.time() + AWS_CREATE_OTA_UPDATE_JOB_TIMEOUT
         otaCreateInProgress = True
         while otaCreateInProgress and time.time() < timeout_end:
             time.sleep(1)
-            otaGetStatusResponse = {}
-            if self._stageParams:
-                otaGetStatusResponse = awsIotCliCommandForNonProdStage(
-                    'get-ota-update ' + \
-                    '--ota-update-id ' + \
-                    createOtaResponse['otaUpdateId'],
-                    self._stageParams
-                )
-            else:
-                otaGetStatusResponse = self._awsIotClient.get_ota_update(
-                    otaUpdateId = createOtaResponse['otaUpdateId'])
+            otaGetStatusResponse = self._awsIotClient.get_ota_update(
+                otaUpdateId = createOtaResponse['otaUpdateId'])
             if otaGetStatusResponse['otaUpdateInfo']['otaUpdateStatus'] in ('CREATE_COMPLETE', 'CREATE_FAILED'):
                 otaCreateInProgress = False
 
@@ -453,7 +418,7 @@ class OtaAwsAgent:
 
         """
         # Upload to the s3 bucket.
-        self.uploadFirmwareToS3Bucket(
+        firmwareVersionId = self.uploadFirmwareToS3Bucket(
             otaConfig['ota_firmware_file_path'],
             os.path.basename(otaConfig['ota_firmware_file_path'])
         )
@@ -470,7 +435,7 @@ class OtaAwsAgent:
                         's3Location': {
                             'bucket': otaConfig['aws_s3_bucket_name'],
                             'key': os.path.basename(otaConfig['ota_firmware_file_path']),
-                            'version': self.getS3ObjectVersion(os.path.basename(otaConfig['ota_firmware_file_path']))
+                            'version': firmwareVersionId
                         }
                     },
                     'codeSigning': {
@@ -496,69 +461,105 @@ class OtaAwsAgent:
             jobId(str): The AWS IoT Job ID to get the status of.
         Returns: The job status and the reason for the status in a namedtuple.
         """
-        JobStatus = namedtuple('JobStatus', 'status reason')
         try:
-            response = {}
-            if self._stageParams:
-                response = awsIotCliCommandForNonProdStage(
-                    'describe-job-execution ' + \
-                    '--job-id ' + \
-                    jobId + ' ' \
-                    '--thing-name ' + \
-                    self._iotThing.thing_name,
-                    self._stageParams
-                )
-            else:
-                response = self._awsIotClient.describe_job_execution(jobId=jobId, thingName=self._iotThing.thing_name)
+            response = self._awsIotClient.describe_job_execution(jobId=jobId, thingName=self._iotThing.thing_name)
         except:
             print("aws iot describe-job-execution failed.")
             return JobStatus('UNDEFINED', 'aws iot describe-job-execution failed.')
         executionResponse = response['execution']
         return JobStatus(executionResponse['status'], executionResponse['statusDetails'].get('detailsMap', {}).get('reason', ''))
 
-    def pollOtaUpdateCompletion(self, otaUpdateId, timeout):
-        """Poll on the job status waiting for it complete.
-        Returns the job status on completion. The job status is a namedtuple with fields
-        'status' and 'reason'.
-        Returns the job status and reason in a namedtuple (status, reason)
-        Args:
-            otaUpdateId(str): The AWS IoT OTA Update ID to poll completion of.
-            timeout(int): The timeout in seconds to poll for.
+    def __getJobWatcher(self):
+        """Get the watcher of the jobs of this agent's thing, creating it on first use.
+        The watcher is woken by the AWS IoT Jobs MQTT topics of the thing unless 'job_notifications'
+        is false in the OTA config. 'job_notification_broker' (host:port) points the notifications
+        at a plain MQTT broker instead of the AWS IoT endpoint, e.g. a local stub broker for testing.
+        Without notifications the watcher checks the jobs with exponential backoff only.
         """
-        seconds = 0
-        summary = None
+        if self._jobWatcher:
+            return self._jobWatcher
 
-        # Get the AWS Iot Job ID
-        response = {}
-        if self._stageParams:
-            response = awsIotCliCommandForNonProdStage(
-                'get-ota-update ' + \
-                '--ota-update-id ' + \
-                otaUpdateId,
-                self._stageParams
-            )
+        self._jobWatcher = OtaJobWatcher(self.__getJobStatus)
+        if not self._jobNotifications:
+            return self._jobWatcher
+
+        if self._jobNotificationBroker:
+            host, _, port = self._jobNotificationBroker.partition(':')
+            notifier = MqttJobNotifier(self._jobWatcher.notify, host, int(port or 1883), self._iotThing.thing_name)
         else:
-            response = self._awsIotClient.get_ota_update(otaUpdateId=otaUpdateId)
-        jobId = response['otaUpdateInfo']['awsIotJobId']
-
-        # Poll on the job status
-        jobStatus = self.__getJobStatus(jobId)
-        finishedJobStatuses = {'CANCELED', 'SUCCEEDED', 'FAILED', 'REJECTED', 'REMOVED'}
-        while seconds < timeout and jobStatus.status not in finishedJobStatuses:
-            time.sleep(5)
-            seconds = seconds + 5
-            jobStatus = self.__getJobStatus(jobId)
-
-        if jobStatus.status not in finishedJobStatuses:
-            if seconds >= timeout :
-                print("Timeout on OTA Update's job.")
-                summary = 'Timeout on OTA Update\'s job.'
-            # Clean up incomplete jobs.
-            self.cancelJob(jobId)
-
-        # Clean up the OTA Update
-        self.deleteOtaUpdate(otaUpdateId)
-        return jobStatus, summary
+            # Non-production stages have their own server certificate, escaped for C source files.
+            caCertificate = self._stageParams.get('certificate', '').replace('\\n', '\n') if self._stageParams else None
+            notifier = MqttJobNotifier(
+                self._jobWatcher.notify,
+                self.getAwsIotEndpoint(),
+                8883,
+                self._iotThing.thing_name,
+                certificate=self._iotThing.cert,
+                privateKey=self._iotThing.prv_key,
+                caCertificate=caCertificate
+            )
+        if notifier.start():
+            self._jobNotifier = notifier
+            self._jobWatcher.setNotifier(notifier)
+        return self._jobWatcher
+
+    def getOtaUpdateJobId(self, otaUpdateId):
+        """Get the AWS IoT job ID of an OTA Update.
+        Args:
+            otaUpdateId(str): The AWS IoT OTA Update ID.
+        """
+        response = self._awsIotClient.get_ota_update(otaUpdateId=otaUpdateId)
+        return response['otaUpdateInfo']['awsIotJobId']
+
+    def pollOtaUpdateCompletion(self, otaUpdateId, timeout, stopEvent=None):
+        """Wait on the job status for it to complete.
+        Returns the job status and reason in a namedtuple (status, reason), and a summary that is
+        None unless the job timed out or the wait was stopped.
+        Args:
+            otaUpdateId(str): The AWS IoT OTA Update ID to wait for completion of.
+            timeout(int): The timeout in seconds to wait for.
+            stopEvent(obj:Event): Stop waiting once set, see stopWaitingOtaUpdates().
+        """
+        return self.waitOtaUpdatesCompletion([otaUpdateId], timeout, stopEvent)[otaUpdateId]
+
+    def waitOtaUpdatesCompletion(self, otaUpdateIds, timeout, stopEvent=None):
+        """Wait on the jobs of many OTA Updates at once for them to complete.
+        Jobs not complete at the timeout or when the wait is stopped are canceled, and all of the
+        OTA Updates are deleted.
+        Returns a dictionary of each OTA Update ID to its (jobStatus, summary), as returned by
+        pollOtaUpdateCompletion().
+        Args:
+            otaUpdateIds(list(str)): The AWS IoT OTA Update IDs to wait for completion of.
+            timeout(int): The timeout in seconds to wait for all of the updates.
+            stopEvent(obj:Event): Stop waiting once set, see stopWaitingOtaUpdates().
+        """
+        jobIds = {otaUpdateId: self.getOtaUpdateJobId(otaUpdateId) for otaUpdateId in otaUpdateIds}
+        jobStatuses = self.__getJobWatcher().waitForJobs(list(jobIds.values()), timeout, stopEvent)
+
+        results = {}
+        for otaUpdateId, jobId in jobIds.items():
+            jobStatus = jobStatuses.get(jobId, JobStatus('UNDEFINED', 'The job status was never read.'))
+            summary = None
+            if jobStatus.status not in FINISHED_JOB_STATUSES:
+                if stopEvent and stopEvent.is_set():
+                    summary = 'Stopped waiting on OTA Update\'s job.'
+                else:
+                    summary = 'Timeout on OTA Update\'s job.'
+                print(summary)
+                # Clean up incomplete jobs.
+                self.cancelJob(jobId)
+
+            # Clean up the OTA Update
+            self.deleteOtaUpdate(otaUpdateId)
+            results[otaUpdateId] = (jobStatus, summary)
+        return results
+
+    def stopWaitingOtaUpdates(self, stopEvent):
+        """Stop a waitOtaUpdatesCompletion() given stopEvent, from any thread.
+        """
+        stopEvent.set()
+        if self._jobWatcher:
+            self._jobWatcher.notify()
 
     def deleteOtaUpdate(self, otaUpdateId):
         """
@@ -568,16 +569,7 @@ class OtaAwsAgent:
         """
         response = {}
         try:
-            if self._stageParams:
-                response = awsIotCliCommandForNonProdStage(
-                    'delete-ota-update ' + \
-                    '--ota-update-id ' + \
-                    otaUpdateId + ' ' + \
-                    '--delete-stream',
-                    self._stageParams
-                )
-            else:
-                response = self._awsIotClient.delete_ota_update(otaUpdateId=otaUpdateId, deleteStream=True)
+            response = self._awsIotClient.delete_ota_update(otaUpdateId=otaUpdateId, deleteStream=True)
         except Exception as e:
             print("Unable to delete ota update with ID: " + otaUpdateId)
             print(response)
@@ -592,18 +584,7 @@ class OtaAwsAgent:
         """
         response = {}
         try:
-            if self._stageParams:
-                response = awsIotCliCommandForNonProdStage(
-                    'cancel-job ' + \
-                    '--job-id ' + \
-                    jobId + ' ' + \
-                    '--comment ' + \
-                    '\"OTA integration testing cancellation of incomplete job.\" ' + \
-                    '--force',
-                    self._stageParams
-                )
-            else:
-                response = self._awsIotClient.cancel_job(jobId=jobId, comment='OTA integration testing cancellation of incomplete job.', force=True)
+            response = self._awsIotClient.cancel_job(jobId=jobId, comment='OTA integration testing cancellation of incomplete job.', force=True)
         except Exception as e:
             print("Unable to cancel job with ID: " + jobId)
             print(response)
@@ -612,6 +593,12 @@ class OtaAwsAgent:
     def cleanup(self):
         """Clean up all AWS IoT resources needed by the OTA test agent.
         """
+        if self._jobNotifier:
+            self._jobNotifier.stop()
+            self._jobNotifier = None
+        if self._transferExecutor:
+            self._transferExecutor.shutdown(wait=True)
+            self._transferExecutor = None
         if self._cleanOnExit:
             self._iotThing.cleanup()
             self._s3Bucket.cleanup()
@@ -622,22 +609,11 @@ class AWSIoTThing:
     """
     def __init__(self, name_prefix, stageParams):
         self._stageParams = stageParams
-        self._iot_client = boto3.client('iot')
-        self._account_id = boto3.client('sts').get_caller_identity()['Account']
-        if self._stageParams:
-            self._region_name = self._stageParams['region']
-            self._iot_thing = awsIotCliCommandForNonProdStage(
-                'create-thing --thing-name {}-{}'.format(name_prefix, uuid4().hex[:8]),
-                self._stageParams
-            )
-            self._cert_keys = awsIotCliCommandForNonProdStage(
-                'create-keys-and-certificate --set-as-active',
-                self._stageParams
-            )
-        else:
-            self._region_name = boto3.Session().region_name
-            self._iot_thing = self._iot_client.create_thing(thingName='{}-{}'.format(name_prefix, uuid4().hex[:8]))
-            self._cert_keys = self._iot_client.create_keys_and_certificate(setAsActive=True)
+        self._iot_client = getAwsClientPool().client('iot', stageParams)
+        self._account_id = getAwsClientPool().client('sts', stageParams).get_caller_identity()['Account']
+        self._region_name = self._iot_client.meta.region_name
+        self._iot_thing = self._iot_client.create_thing(thingName='{}-{}'.format(name_prefix, uuid4().hex[:8]))
+        self._cert_keys = self._iot_client.create_keys_and_certificate(setAsActive=True)
         self.thing_name = self._iot_thing['thingName']
         self.thing_arn = self._iot_thing['thingArn']
         self.cert = self._cert_keys['certificatePem']
@@ -656,53 +632,17 @@ class AWSIoTThing:
             } \
             ] \
         }"
-        if self._stageParams:
-            awsIotCliCommandForNonProdStage(
-                'create-policy --policy-name ' + self._policy_name + ' --policy-document ' + '\"' + self._policy_doc.replace('\"', '\\\"') + '\"',
-                self._stageParams
-            )
-            awsIotCliCommandForNonProdStage(
-                'attach-policy --policy-name ' + self._policy_name + ' --target ' + self.cert_arn,
-                self._stageParams
-            )
-        else:
-            self._iot_client.create_policy(policyName=self._policy_name, policyDocument=self._policy_doc)
-            self._iot_client.attach_policy(policyName=self._policy_name, target=self.cert_arn)
-            self._iot_client.attach_thing_principal(thingName=self.thing_name, principal=self.cert_arn)
+        self._iot_client.create_policy(policyName=self._policy_name, policyDocument=self._policy_doc)
+        self._iot_client.attach_policy(policyName=self._policy_name, target=self.cert_arn)
+        self._iot_client.attach_thing_principal(thingName=self.thing_name, principal=self.cert_arn)
 
     def cleanup(self):
-        if self._stageParams:
-            awsIotCliCommandForNonProdStage(
-                'detach-thing-principal --thing-name ' + self.thing_name + ' --principal ' + self.cert_arn,
-                self._stageParams
-            )
-            awsIotCliCommandForNonProdStage(
-                'detach-policy --policy-name ' + self._policy_name + ' --target ' + self.cert_arn,
-                self._stageParams
-            )
-            awsIotCliCommandForNonProdStage(
-                'delete-policy --policy-name ' + self._policy_name,
-                self._stageParams
-            )
-            awsIotCliCommandForNonProdStage(
-                'update-certificate --certificate-id ' + self.cert_id + ' --new-status INACTIVE',
-                self._stageParams
-            )
-            awsIotCliCommandForNonProdStage(
-                'delete-certificate --certificate-id ' + self.cert_id,
-                self._stageParams
-            )
-            awsIotCliCommandForNonProdStage(
-                'delete-thing --thing-name ' + self.thing_name,
-                self._stageParams
-            )
-        else:
-            self._iot_client.detach_thing_principal(thingName=self.thing_name, principal=self.cert_arn)
-            self._iot_client.detach_policy(policyName=self._policy_name,target=self.cert_arn)
-            self._iot_client.delete_policy(policyName=self._policy_name)
-            self._iot_client.update_certificate(certificateId=self.cert_id, newStatus='INACTIVE')
-            self._iot_client.delete_certificate(certificateId=self.cert_id)
-            self._iot_client.delete_thing(thingName=self.thing_name)
+        self._iot_client.detach_thing_principal(thingName=self.thing_name, principal=self.cert_arn)
+        self._iot_client.detach_policy(policyName=self._policy_name,target=self.cert_arn)
+        self._iot_client.delete_policy(policyName=self._policy_name)
+        self._iot_client.update_certificate(certificateId=self.cert_id, newStatus='INACTIVE')
+        self._iot_client.delete_certificate(certificateId=self.cert_id)
+        self._iot_client.delete_thing(thingName=self.thing_name)
 
     def __enter__(self):
         return self
@@ -715,14 +655,14 @@ class AWSS3Bucket:
     """ AWS S3 Versioned Bucket.
     """
     def __init__(self, name, stageParams):
-        self._s3_client = boto3.resource('s3')
-        if stageParams:
-            self._s3_client = boto3.resource('s3', region_name=stageParams['region'])
+        self._s3_client = getAwsClientPool().resource('s3', stageParams)
         self._stageParams = stageParams
         self.s3_name = name
         self.s3_bucket = self._s3_client.Bucket(self.s3_name)
         self.__create_bucket()
         self.s3_keys = []
+        self._uploadedVersions = {}
+        self._lock = threading.Lock()
 
     def __create_bucket(self):
         response = None
@@ -736,7 +676,7 @@ class AWSS3Bucket:
                 self.s3_bucket = self._s3_client.create_bucket(
                     Bucket = self.s3_name,
                     CreateBucketConfiguration = {
-                        'LocationConstraint': boto3.session.Session().region_name
+                        'LocationConstraint': self._s3_client.meta.client.meta.region_name
                     }
                 )
             self._s3_client.BucketVersioning(self.s3_name).enable()
@@ -747,9 +687,69 @@ class AWSS3Bucket:
             if response_region not in ('us-east-1', 'us-west-2'):
                 raise Exception(f'ERROR: Bucket {self.s3_name} already exist and it is in region {response_region}. However testing in gamma or beta only supports us-west-2 and us-east-1.')
 
-    def upload_file(self, file_path, file_name):
-        self.s3_keys.append(file_name)
-        self._s3_client.Bucket(self.s3_name).upload_file(file_path, file_name)
+    def upload_file(self, file_path, file_name, digest=None):
+        """Upload a file with its SHA-256 digest in the object metadata, and return the version ID of the
+        object with the file.
+        The upload is skipped when the latest version of the key already has the same digest, e.g. when
+        a test or an earlier run uploaded the same image. Large files are uploaded in parts at once.
+        Only the bucket's client is used, since unlike its resource it can be used from many threads.
+        """
+        digest = digest or fileSha256(file_path)
+        with self._lock:
+            if file_name not in self.s3_keys:
+                self.s3_keys.append(file_name)
+            uploaded = self._uploadedVersions.get(file_name)
+            if uploaded and uploaded[0] == digest:
+                return uploaded[1]
+        client = self._s3_client.meta.client
+        try:
+            head = client.head_object(Bucket=self.s3_name, Key=file_name)
+        except botocore.exceptions.ClientError:
+            head = {}
+        if head.get('Metadata', {}).get('sha256') == digest:
+            versionId = head.get('VersionId')
+        else:
+            versionId = self.__put_file(client, file_path, file_name, {'sha256': digest})
+        with self._lock:
+            self._uploadedVersions[file_name] = (digest, versionId)
+        return versionId
+
+    def __put_file(self, client, file_path, file_name, metadata):
+        """Put a file in the bucket, in parts at once if it is large, and return the version ID of the new
+        object. The managed transfers of boto3 don't return the version they create.
+        """
+        size = os.path.getsize(file_path)
+        if size <= S3_MULTIPART_CHUNK_BYTES:
+            with open(file_path, 'rb') as f:
+                return client.put_object(Bucket=self.s3_name, Key=file_name, Body=f, Metadata=metadata).get('VersionId')
+
+        uploadId = client.create_multipart_upload(Bucket=self.s3_name, Key=file_name, Metadata=metadata)['UploadId']
+
+        def uploadPart(partNumber):
+            with open(file_path, 'rb') as f:
+                f.seek((partNumber - 1) * S3_MULTIPART_CHUNK_BYTES)
+                body = f.read(S3_MULTIPART_CHUNK_BYTES)
+            response = client.upload_part(Bucket=self.s3_name, Key=file_name, UploadId=uploadId, PartNumber=partNumber, Body=body)
+            return {'PartNumber': partNumber, 'ETag': response['ETag']}
+
+        partCount = (size + S3_MULTIPART_CHUNK_BYTES - 1) // S3_MULTIPART_CHUNK_BYTES
+        try:
+            with ThreadPoolExecutor(max_workers=min(partCount, S3_MULTIPART_CONCURRENCY)) as executor:
+                parts = list(executor.map(uploadPart, range(1, partCount + 1)))
+            return client.complete_multipart_upload(
+                Bucket=self.s3_name,
+                Key=file_name,
+                UploadId=uploadId,
+                MultipartUpload={'Parts': parts}
+            ).get('VersionId')
+        except Exception:
+            client.abort_multipart_upload(Bucket=self.s3_name, Key=file_name, UploadId=uploadId)
+            raise
+
+    def get_version_id(self, key):
+        """Get the version ID of the latest version of the object key, with the bucket's client.
+        """
+        return self._s3_client.meta.client.head_object(Bucket=self.s3_name, Key=key).get('VersionId')
 
     def download_file(self, key, file_path):
         try:
@@ -771,6 +771,7 @@ class AWSS3Bucket:
             return
         for key in self.s3_keys:
             self._s3_client.Object(self.s3_name, key).delete()
+        self._uploadedVersions.clear()
 
     def __enter__(self):
         return self
@@ -0,0 +1,154 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import threading
+import boto3
+import botocore.config
+
+# The stage parameter holding the endpoint URL of each service with an endpoint of its own in the
+# non-production stages. The other services are only pointed at the stage's region.
+STAGE_ENDPOINT_URL_KEYS = {
+    'iot': 'endpoint-url',
+    'signer': 'signer-endpoint-url',
+}
+
+class AwsClientPool:
+    """The boto3 clients shared by all of the OTA agents of a process.
+
+    Creating a boto3 client loads the service model and opens its own connection pool, so each client
+    is created once per service, region and endpoint and then reused. The clients keep their HTTPS
+    connections alive between calls. boto3 clients can be used from many threads, unlike the session
+    that creates them, which is only used under a lock.
+
+    The pool also memoizes lookups of values that do not change during a run, e.g. the AWS IoT
+    endpoint of the account.
+
+    With a stub endpoint URL, every service is pointed at that URL instead of AWS, e.g. a local moto
+    server ("moto_server -p 5000"), so that the harness can run and be benchmarked offline. Fake
+    credentials are used unless some are configured.
+
+    Attributes:
+        _session(obj:boto3.session.Session): The session creating the clients.
+        _config(obj:botocore.config.Config): The configuration of every client.
+        _stubEndpointUrl(str): The endpoint URL of all of the services, None for AWS.
+        _clients(dict): The clients by (service, region, endpoint URL).
+        _lookups(dict): The memoized lookups by key.
+    Methods:
+        getSession()
+        client(service, stageParams)
+        resource(service, stageParams)
+        memoize(key, lookup)
+    Example:
+        iotClient = getAwsClientPool().client('iot')
+        endpoint = getAwsClientPool().memoize(('iot', 'endpoint'), lambda: iotClient.describe_endpoint()['endpointAddress'])
+    """
+    def __init__(self, stubEndpointUrl=None, maxPoolConnections=32):
+        self._stubEndpointUrl = stubEndpointUrl
+        self._session = boto3.session.Session()
+        if stubEndpointUrl:
+            region = self._session.region_name or 'us-east-1'
+            if self._session.get_credentials() is None:
+                self._session = boto3.session.Session(aws_access_key_id='testing', aws_secret_access_key='testing', region_name=region)
+            else:
+                self._session = boto3.session.Session(region_name=region)
+        configArgs = {'max_pool_connections': maxPoolConnections}
+        if stubEndpointUrl:
+            # A stub server does not have a host name per bucket.
+            configArgs['s3'] = {'addressing_style': 'path'}
+        try:
+            self._config = botocore.config.Config(tcp_keepalive=True, **configArgs)
+        except TypeError:
+            # botocore older than 1.27 keeps the connections alive without TCP keepalive probes.
+            self._config = botocore.config.Config(**configArgs)
+        self._clients = {}
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def getSession(self):
+        """Get the session creating the clients, e.g. to register botocore event handlers before
+        the first client is created.
+        """
+        return self._session
+
+    def __clientArgs(self, service, stageParams):
+        region = stageParams['region'] if stageParams else self._session.region_name
+        endpointUrl = stageParams.get(STAGE_ENDPOINT_URL_KEYS.get(service)) if stageParams else None
+        if self._stubEndpointUrl:
+            endpointUrl = self._stubEndpointUrl
+        return region, endpointUrl
+
+    def client(self, service, stageParams=None):
+        """Get the client of a service, in the region and at the endpoint of the stage if any.
+        Args:
+            service(str): The boto3 service name, e.g. 'iot'.
+            stageParams(dict): 'region' and the endpoint URLs of the non-production stage, see
+                STAGE_ENDPOINT_URL_KEYS. Empty or None for production.
+        """
+        region, endpointUrl = self.__clientArgs(service, stageParams)
+        key = (service, region, endpointUrl)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self._session.client(service, region_name=region, endpoint_url=endpointUrl, config=self._config)
+            return self._clients[key]
+
+    def resource(self, service, stageParams=None):
+        """Create a resource of a service, configured like client(). boto3 resources can not be
+        shared between threads, so each call creates a new one.
+        """
+        region, endpointUrl = self.__clientArgs(service, stageParams)
+        with self._lock:
+            return self._session.resource(service, region_name=region, endpoint_url=endpointUrl, config=self._config)
+
+    def memoize(self, key, lookup):
+        """Get the value of a lookup that does not change during the run, calling lookup() the first
+        time the key is asked for.
+        """
+        with self._lock:
+            if key in self._lookups:
+                return self._lookups[key]
+        value = lookup()
+        with self._lock:
+            return self._lookups.setdefault(key, value)
+
+_awsClientPool = None
+_awsClientPoolLock = threading.Lock()
+
+def configureAwsClientPool(stubEndpointUrl=None, maxPoolConnections=32):
+    """Replace the AwsClientPool of this process. Call this before any AWS API call, e.g. at start up
+    or in the initializer of a worker process.
+    """
+    global _awsClientPool
+    with _awsClientPoolLock:
+        _awsClientPool = AwsClientPool(stubEndpointUrl, maxPoolConnections)
+        return _awsClientPool
+
+def getAwsClientPool():
+    """Get the AwsClientPool of this process, creating one for AWS on first use.
+    """
+    global _awsClientPool
+    with _awsClientPoolLock:
+        if _awsClientPool is None:
+            _awsClientPool = AwsClientPool()
+        return _awsClientPool
@@ -0,0 +1,226 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import os
+import copy
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from time import sleep, monotonic
+
+def fileMtimeNs(path):
+    """Get the modification time of a file in nanoseconds, or None if it doesn't exist.
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def waitForFileReady(path, timeout=60, interval=0.25):
+    """Wait for a file written by a build tool to be complete.
+    The file is ready once it exists and its size and modification time are the same in two checks
+    interval seconds apart.
+    Returns True if the file was ready before the timeout in seconds.
+    """
+    deadline = monotonic() + timeout
+    lastStat = None
+    while monotonic() < deadline:
+        try:
+            stat = os.stat(path)
+            stat = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stat = None
+        if stat and stat == lastStat:
+            return True
+        lastStat = stat
+        sleep(interval)
+    return False
+
+# build_config fields that do not change the build outputs.
+BUILD_CACHE_CONFIG_FIELDS = {'build_cache', 'build_cache_dir', 'build_cache_max_entries', 'output_ready_timeout_sec'}
+
+def git(projectRootDir, *args):
+    """Run git in the project. Returns the output, or None if the project is not in git.
+    """
+    try:
+        return subprocess.check_output(['git', '-C', projectRootDir] + list(args), stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def sourceRevision(projectRootDir):
+    """Get the git commit checked out in the project, or '' if the project is not in git.
+    """
+    revision = git(projectRootDir, 'rev-parse', 'HEAD')
+    return revision.decode('utf-8').strip() if revision else ''
+
+def sourceSnapshot(projectRootDir):
+    """Get a git commit of the files git tracks in the project as they are now, uncommitted changes included.
+    This is the commit checked out if there are no changes, else a stash commit of the changes that is
+    not added to the stash list. Returns '' if the project is not in git or the commit can't be made.
+    """
+    revision = sourceRevision(projectRootDir)
+    if not revision:
+        return ''
+    # The stash commit needs a committer, which may not be configured.
+    snapshot = git(projectRootDir, '-c', 'user.name=ota-e2e', '-c', 'user.email=ota-e2e@localhost', 'stash', 'create')
+    if snapshot is None:
+        return ''
+    return snapshot.decode('utf-8').strip() or revision
+
+def rebaseConfigPaths(config, oldRoot, newRoot):
+    """Replace the oldRoot prefix of all of the paths in a board configuration with newRoot.
+    Args:
+        config(dict|list): The board configuration, or a part of it, to update in place.
+        oldRoot(str): The path the configuration paths are under.
+        newRoot(str): The path to move the configuration paths under.
+    """
+    items = config.items() if isinstance(config, dict) else enumerate(config)
+    for key, value in list(items):
+        if isinstance(value, (dict, list)):
+            rebaseConfigPaths(value, oldRoot, newRoot)
+        elif isinstance(value, str) and (value == oldRoot or value.startswith((oldRoot + '/', oldRoot + '\\'))):
+            config[key] = newRoot + value[len(oldRoot):]
+
+def buildCacheKey(projectRootDir, modifiedFiles, buildConfig):
+    """Hash everything the build outputs depend on that can change between builds of a project.
+    The key does not depend on where the project is, so that a project built in a copy of the
+    source tree, e.g. a git worktree, has the same key as in the original tree.
+    Args:
+        projectRootDir(str): The root of the FreeRTOS project. Its git commit and its changes from
+            the commit are hashed.
+        modifiedFiles(iterable(str)): The files changed by OtaAfrProject. The content of the files
+            git does not track is hashed.
+        buildConfig(dict): 'build_config' in board.json, including the build commands, the tool
+            paths and the outputs.
+    """
+    root = os.path.abspath(projectRootDir)
+    outputConfig = copy.deepcopy({key: value for key, value in buildConfig.items() if key not in BUILD_CACHE_CONFIG_FIELDS})
+    rebaseConfigPaths(outputConfig, projectRootDir, '{afr_root}')
+    rebaseConfigPaths(outputConfig, root, '{afr_root}')
+
+    digest = hashlib.sha256()
+    digest.update(sourceRevision(projectRootDir).encode('utf-8'))
+    digest.update(json.dumps(outputConfig, sort_keys=True).encode('utf-8'))
+
+    # The changes to the tracked files, with paths relative to the top of the git tree.
+    diff = git(projectRootDir, 'diff', '--binary', 'HEAD', '--', '.')
+    digest.update(diff if diff else b'')
+
+    modifiedFiles = sorted(os.path.relpath(filePath, root) for filePath in modifiedFiles)
+    tracked = git(projectRootDir, 'ls-files', '-z', '--', *modifiedFiles) if diff is not None and modifiedFiles else b''
+    tracked = set(tracked.decode('utf-8').split('\0')) if tracked else set()
+    for filePath in modifiedFiles:
+        if filePath in tracked:
+            continue
+        digest.update(filePath.encode('utf-8'))
+        with open(os.path.join(root, filePath), 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+class OtaBuildCache:
+    """A content addressed cache of the outputs of OtaAfrProject.buildProject().
+
+    Each entry is a directory, named by the key from buildCacheKey(), holding a copy of each build
+    output and OUTPUTS_FILE listing the paths they were copied from. Paths in the project are listed
+    relative to the project root, so that the outputs can be restored to another copy of the
+    project. Entries are stored atomically with a rename, and the least recently used entries are
+    removed when there are more than maxEntries.
+
+    The firmware images embed the device credentials, so the cache should be kept private.
+
+    Attributes:
+        _cacheDir(str): The directory holding the entries.
+        _maxEntries(int): The number of entries kept.
+    Methods:
+        contains(key)
+        restore(key, projectRootDir)
+        store(key, outputs, projectRootDir)
+    """
+    OUTPUTS_FILE = 'outputs.json'
+
+    def __init__(self, cacheDir, maxEntries=20):
+        self._cacheDir = cacheDir
+        self._maxEntries = maxEntries
+
+    def __entryPath(self, key):
+        return os.path.join(self._cacheDir, key)
+
+    @staticmethod
+    def __projectPath(path, projectRootDir):
+        """The path relative to the project root if it is in the project, else the absolute path.
+        """
+        path = os.path.abspath(path)
+        root = os.path.abspath(projectRootDir)
+        return os.path.relpath(path, root) if path.startswith(root + os.sep) else path
+
+    def contains(self, key):
+        """Is there an entry for the key?
+        """
+        return os.path.isfile(os.path.join(self.__entryPath(key), OtaBuildCache.OUTPUTS_FILE))
+
+    def restore(self, key, projectRootDir):
+        """Copy the cached build outputs back to their paths in the project.
+        Returns True if the outputs were found in the cache.
+        """
+        entry = self.__entryPath(key)
+        try:
+            with open(os.path.join(entry, OtaBuildCache.OUTPUTS_FILE), 'r') as f:
+                outputs = json.load(f)
+        except (OSError, ValueError):
+            return False
+        for index, output in enumerate(outputs):
+            output = os.path.join(projectRootDir, output)
+            if os.path.dirname(output):
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+            shutil.copyfile(os.path.join(entry, str(index)), output)
+        # Mark the entry as recently used.
+        os.utime(entry)
+        return True
+
+    def store(self, key, outputs, projectRootDir):
+        """Store copies of the build outputs of the project in the cache.
+        """
+        os.makedirs(self._cacheDir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self._cacheDir, prefix='.tmp-')
+        try:
+            for index, output in enumerate(outputs):
+                shutil.copyfile(output, os.path.join(tmp, str(index)))
+            with open(os.path.join(tmp, OtaBuildCache.OUTPUTS_FILE), 'w') as f:
+                json.dump([self.__projectPath(output, projectRootDir) for output in outputs], f)
+            os.rename(tmp, self.__entryPath(key))
+        except OSError:
+            # The entry already exists or an output could not be read.
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.__evict()
+
+    def __evict(self):
+        """Remove the least recently used entries over the maximum number of entries.
+        """
+        entries = [entry for entry in os.scandir(self._cacheDir) if entry.is_dir() and not entry.name.startswith('.')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[self._maxEntries:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,164 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import os
+import copy
+import queue
+import subprocess
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .aws_ota_project import OtaAfrProject
+from .aws_ota_build_cache import rebaseConfigPaths, sourceRevision, sourceSnapshot
+
+class OtaImagePlanner:
+    """Build all of the OTA images the test cases of a board need before the tests run.
+    Each test case lists the changes to the project before each of its builds, see
+    OtaTestCase.getBuildVariants(). The planner makes the same changes in copies of the board's
+    "afr_root", git worktrees under workspaceDir, and builds up to jobs images at once. The outputs
+    go to the build cache, from which the tests restore them instead of building.
+    Changes that only affect the cloud side of a test, e.g. the code signing certificate of the
+    OTA update, are not in the build variants as they do not change the image.
+    Args:
+        boardConfig(dict): The full board.json configuration.
+        workspaceDir(str): The directory holding the worktrees.
+        jobs(int): The number of images to build at once, one worktree per job.
+    Attributes:
+        _boardConfig(dict): The full board.json configuration.
+        _afrRoot(str): The board's "afr_root".
+        _workspaceDir(str): The directory holding the worktrees.
+        _jobs(int): The number of images to build at once.
+    Methods:
+        planBuilds(otaTestCases)
+        prebuild(otaTestCases)
+    Example:
+        planner = OtaImagePlanner(boardConfig, 'board_workspaces', 4)
+        planner.prebuild(otaTestCases)
+    """
+    def __init__(self, boardConfig, workspaceDir, jobs):
+        self._boardConfig = boardConfig
+        self._afrRoot = boardConfig['afr_root']
+        self._workspaceDir = workspaceDir
+        self._jobs = max(1, jobs)
+
+    def planBuilds(self, otaTestCases):
+        """Get every build the test cases make, in the order they make them.
+        Returns a list of (OtaTestCase, list of (OtaAfrProject method name, arguments)) tuples.
+        """
+        return [(otaTestCase, changes) for otaTestCase in otaTestCases for changes in otaTestCase.getBuildVariants()]
+
+    def __getWorktree(self, slot, revision, snapshot):
+        """Check out "afr_root" as it is, uncommitted changes included, in the worktree of a job.
+        The snapshot from sourceSnapshot() is checked out, then HEAD is moved back to the revision of
+        "afr_root" keeping the files, so that the changes from HEAD, and the build cache keys, are
+        the same as in "afr_root".
+        Returns the path of the worktree.
+        """
+        worktree = os.path.abspath(os.path.join(self._workspaceDir, '{}-prebuild-{}'.format(self._boardConfig['name'], slot)))
+        if not os.path.exists(worktree):
+            subprocess.check_call(['git', '-C', self._afrRoot, 'worktree', 'add', '--detach', worktree, snapshot])
+        else:
+            subprocess.check_call(['git', '-C', worktree, 'checkout', '--quiet', '--force', '--detach', snapshot])
+        if snapshot != revision:
+            subprocess.check_call(['git', '-C', worktree, 'reset', '--quiet', '--soft', revision])
+        return worktree
+
+    def __createProject(self, worktree):
+        """Create an OtaAfrProject for the board in a worktree.
+        """
+        boardConfig = copy.deepcopy(self._boardConfig)
+        rebaseConfigPaths(boardConfig, self._afrRoot, worktree)
+        # Share the build cache of the board's project.
+        buildCacheDir = self._boardConfig['build_config'].get('build_cache_dir')
+        if buildCacheDir:
+            boardConfig['build_config']['build_cache_dir'] = buildCacheDir
+        return OtaAfrProject(boardConfig)
+
+    def __build(self, otaProject, slot, freeSlots):
+        """Build the project in the worktree of a job, then free the worktree for the next build.
+        Returns True if the build succeeded.
+        """
+        try:
+            return all(returnCode == 0 for returnCode in otaProject.buildProject())
+        except Exception:
+            print(traceback.format_exc())
+            return False
+        finally:
+            freeSlots.put(slot)
+
+    def prebuild(self, otaTestCases):
+        """Build the images of the test cases that are not in the build cache yet.
+        The projects are changed one at a time in this thread, and built in up to _jobs threads.
+        Returns the number of images built.
+        """
+        buildConfig = self._boardConfig['build_config']
+        if not buildConfig.get('build_cache', True):
+            print('The build cache of {} is disabled, skipping the OTA image pre-build.'.format(self._boardConfig['name']))
+            return 0
+        revision = sourceRevision(self._afrRoot)
+        if not revision:
+            print('{} is not in git, skipping the OTA image pre-build.'.format(self._afrRoot))
+            return 0
+        # Build the sources the tests will build, with the uncommitted changes of "afr_root".
+        snapshot = sourceSnapshot(self._afrRoot)
+        if not snapshot:
+            print('WARNING: Could not copy the uncommitted changes of {}, skipping the OTA image pre-build.'.format(self._afrRoot))
+            return 0
+
+        builds = self.planBuilds(otaTestCases)
+        if len(builds) > buildConfig.get('build_cache_max_entries', 20):
+            print('WARNING: {} OTA images to pre-build but the build cache keeps {}, increase "build_cache_max_entries".'.format(
+                len(builds), buildConfig.get('build_cache_max_entries', 20)))
+
+        freeSlots = queue.Queue()
+        for slot in range(self._jobs):
+            freeSlots.put(slot)
+        plannedKeys = set()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            for sequenceNumber, (otaTestCase, changes) in enumerate(builds, 1):
+                slot = freeSlots.get()
+                try:
+                    otaProject = self.__createProject(self.__getWorktree(slot, revision, snapshot))
+                    otaTestCase.configureProject(otaProject)
+                    for method, args in changes:
+                        getattr(otaProject, method)(*args)
+                    # The tests number the builds of the board's project in this order.
+                    otaProject.setBootloaderSequenceNumber(sequenceNumber)
+                    cacheKey = otaProject.getBuildCacheKey()
+                    if cacheKey in plannedKeys or otaProject.isBuildCached():
+                        freeSlots.put(slot)
+                        continue
+                    plannedKeys.add(cacheKey)
+                    otaProject.setBootloaderSequenceNumber(sequenceNumber - 1)
+                except Exception:
+                    freeSlots.put(slot)
+                    raise
+                print('Pre-building OTA image {} of {} for {}.'.format(sequenceNumber, len(builds), otaTestCase.getName()))
+                futures.append(executor.submit(self.__build, otaProject, slot, freeSlots))
+
+        built = sum(future.result() for future in futures)
+        print('Pre-built {} OTA images for {}, {} failed, {} already built or in the build cache.'.format(
+            built, self._boardConfig['name'], len(futures) - built, len(builds) - len(futures)))
+        return built
@@ -0,0 +1,252 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from threading import Condition, Event
+from uuid import uuid4
+import paho.mqtt.client as mqtt
+
+# The status of an AWS IoT job execution and the reason the device gave for it.
+JobStatus = namedtuple('JobStatus', 'status reason')
+
+# Job execution statuses after which the job will not change any more.
+FINISHED_JOB_STATUSES = {'CANCELED', 'SUCCEEDED', 'FAILED', 'REJECTED', 'REMOVED'}
+
+class OtaJobWatcher:
+    """Wait for AWS IoT jobs to finish.
+
+    The status of each job is checked with an adaptive exponential backoff: the interval between
+    checks of a job starts at minInterval and is multiplied by backoffFactor after each check that
+    finds the job unfinished, up to maxInterval. When a notifier is attached, a notification about
+    a job wakes the watcher immediately, checks the job and resets its interval to minInterval, so
+    that a job is seen finished as soon as AWS IoT publishes it rather than at the next check.
+
+    All of the jobs given to waitForJobs() are watched from one loop in the calling thread.
+
+    Attributes:
+        _getJobStatus(function): Returns the JobStatus of a job ID.
+        _notifier(obj): Optional notifier with a subscribeJob(jobId) method, e.g. MqttJobNotifier.
+        _notified(set): Job IDs with notifications not yet handled. None stands for all jobs.
+    Methods:
+        setNotifier(notifier)
+        notify(jobId)
+        waitForJobs(jobIds, timeout, stopEvent)
+    Example:
+        watcher = OtaJobWatcher(getJobStatus)
+        notifier = MqttJobNotifier(watcher.notify, 'localhost', 1883, 'thing')
+        if notifier.start():
+            watcher.setNotifier(notifier)
+        statuses = watcher.waitForJobs(['AFR_OTA-1', 'AFR_OTA-2'], 600)
+    """
+    def __init__(self, getJobStatus, minInterval=1, maxInterval=30, backoffFactor=2):
+        self._getJobStatus = getJobStatus
+        self._minInterval = minInterval
+        self._maxInterval = maxInterval
+        self._backoffFactor = backoffFactor
+        self._notifier = None
+        self._notified = set()
+        self._condition = Condition()
+
+    def setNotifier(self, notifier):
+        """Attach a notifier. Jobs are subscribed to on the notifier when they are waited on."""
+        self._notifier = notifier
+
+    def notify(self, jobId=None):
+        """Wake the watcher to check a job now. A jobId of None checks all of the jobs.
+        This is safe to call from any thread, typically the MQTT network thread.
+        """
+        with self._condition:
+            self._notified.add(jobId)
+            self._condition.notify()
+
+    def __takeNotified(self, pending):
+        """Return the pending job IDs notified since the last call."""
+        with self._condition:
+            notified = self._notified
+            self._notified = set()
+        if None in notified:
+            return set(pending)
+        return notified & set(pending)
+
+    def __waitForNotification(self, until):
+        """Block until a notification arrives or the monotonic time until."""
+        with self._condition:
+            if not self._notified:
+                self._condition.wait(max(0, until - time.monotonic()))
+
+    def waitForJobs(self, jobIds, timeout, stopEvent=None):
+        """Wait for all of the jobs to finish, for the timeout, or for stopEvent to be set.
+        Returns a dictionary of each job ID to its last JobStatus. A job whose status is not in
+        FINISHED_JOB_STATUSES timed out or was stopped.
+        Args:
+            jobIds(list(str)): The AWS IoT job IDs to wait on.
+            timeout(int): The timeout in seconds for all of the jobs.
+            stopEvent(obj:Event): Stop waiting once set. Call notify() after setting it to stop
+                right away, the status of the jobs is then checked one last time.
+        """
+        if self._notifier:
+            for jobId in jobIds:
+                self._notifier.subscribeJob(jobId)
+
+        deadline = time.monotonic() + timeout
+        pending = {jobId: {'interval': self._minInterval, 'next': 0} for jobId in jobIds}
+        statuses = {}
+        while pending:
+            now = time.monotonic()
+            expired = now >= deadline
+            notified = self.__takeNotified(pending)
+            for jobId in list(pending):
+                job = pending[jobId]
+                if not (expired or jobId in notified or job['next'] <= now):
+                    continue
+                statuses[jobId] = self._getJobStatus(jobId)
+                if statuses[jobId].status in FINISHED_JOB_STATUSES:
+                    del pending[jobId]
+                    continue
+                if jobId in notified:
+                    job['interval'] = self._minInterval
+                job['next'] = time.monotonic() + job['interval']
+                job['interval'] = min(job['interval'] * self._backoffFactor, self._maxInterval)
+            if expired or not pending or (stopEvent and stopEvent.is_set()):
+                break
+            self.__waitForNotification(min(min(job['next'] for job in pending.values()), deadline))
+        return statuses
+
+
+class MqttJobNotifier:
+    """Subscribe to the AWS IoT Jobs MQTT topics of a thing and wake an OtaJobWatcher on each message.
+
+    The notifier listens to:
+        $aws/things/<thingName>/jobs/notify - the pending jobs of the thing changed.
+        $aws/things/<thingName>/jobs/+/update/accepted - the device updated a job execution.
+        $aws/events/jobExecution/<jobId>/+ - the job execution reached a terminal status, when job
+            execution events are enabled in the AWS IoT event configurations.
+    The messages are only used as a signal to check the job status, so any of them missing only
+    delays the watcher to its next backoff check.
+
+    The notifier connects with its own client ID, as connecting with the thing name would disconnect
+    the device. Without a certificate the notifier connects over plain TCP, which is what a local
+    stub broker (e.g. mosquitto) for testing expects.
+
+    Attributes:
+        _onNotification(function): Called with the job ID of a message, or None for all jobs.
+        _client(obj:mqtt.Client): The paho MQTT client.
+        _credentialsDir(str): Temporary directory holding the TLS credentials.
+    Methods:
+        start(timeout)
+        subscribeJob(jobId)
+        stop()
+    """
+    def __init__(self, onNotification, host, port, thingName, certificate=None, privateKey=None, caCertificate=None):
+        self._onNotification = onNotification
+        self._host = host
+        self._port = port
+        self._thingName = thingName
+        self._connected = Event()
+        self._credentialsDir = None
+        self._topics = [
+            f'$aws/things/{thingName}/jobs/notify',
+            f'$aws/things/{thingName}/jobs/+/update/accepted',
+        ]
+
+        self._client = mqtt.Client(client_id=f'{thingName}-job-watcher-{uuid4().hex[:8]}')
+        if certificate:
+            # The python ssl module only loads credentials from files.
+            self._credentialsDir = tempfile.mkdtemp(prefix='ota-job-watcher-')
+            self._client.tls_set(
+                ca_certs=self.__writeCredential('ca.pem', caCertificate) if caCertificate else None,
+                certfile=self.__writeCredential('cert.pem', certificate),
+                keyfile=self.__writeCredential('key.pem', privateKey)
+            )
+        self._client.on_connect = self.__onConnect
+        self._client.on_disconnect = self.__onDisconnect
+        self._client.on_message = self.__onMessage
+
+    def __writeCredential(self, fileName, content):
+        path = os.path.join(self._credentialsDir, fileName)
+        with open(path, 'w') as credentialFile:
+            credentialFile.write(content)
+        return path
+
+    def __onConnect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print(f'Job notifications: connection to {self._host}:{self._port} refused with code {rc}.')
+            return
+        # Subscriptions are not kept by the broker over a reconnect.
+        for topic in self._topics:
+            client.subscribe(topic, qos=1)
+        self._connected.set()
+        # Messages may have been missed while disconnected.
+        self._onNotification(None)
+
+    def __onDisconnect(self, client, userdata, rc):
+        self._connected.clear()
+
+    def __onMessage(self, client, userdata, message):
+        self._onNotification(self.jobIdFromTopic(message.topic))
+
+    @staticmethod
+    def jobIdFromTopic(topic):
+        """Return the job ID in an AWS IoT Jobs topic, or None if the topic concerns all jobs."""
+        levels = topic.split('/')
+        if levels[:3] == ['$aws', 'events', 'jobExecution'] and len(levels) > 3:
+            return levels[3]
+        if levels[:2] == ['$aws', 'things'] and len(levels) > 4 and levels[3] == 'jobs' and levels[4] != 'notify':
+            return levels[4]
+        return None
+
+    def start(self, timeout=10):
+        """Connect to the broker. Returns True if connected within the timeout in seconds."""
+        try:
+            self._client.connect_async(self._host, self._port, 60)
+            self._client.loop_start()
+        except Exception as e:
+            print(f'Job notifications: unable to connect to {self._host}:{self._port}: {e}')
+            return False
+        if not self._connected.wait(timeout):
+            print(f'Job notifications: timeout connecting to {self._host}:{self._port}, polling jobs with backoff only.')
+            self.stop()
+            return False
+        return True
+
+    def subscribeJob(self, jobId):
+        """Subscribe to the job execution events of a job."""
+        topic = f'$aws/events/jobExecution/{jobId}/+'
+        if topic not in self._topics:
+            self._topics.append(topic)
+            if self._connected.is_set():
+                self._client.subscribe(topic, qos=1)
+
+    def stop(self):
+        """Disconnect from the broker and remove the TLS credentials."""
+        self._client.disconnect()
+        self._client.loop_stop()
+        if self._credentialsDir:
+            shutil.rmtree(self._credentialsDir, ignore_errors=True)
+            self._credentialsDir = None
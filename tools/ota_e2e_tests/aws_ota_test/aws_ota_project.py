@@ -23,12 +23,10 @@ http://aws.amazon.com/freertos
 http://www.FreeRTOS.org
 
 """
-import fileinput
-import sys
 import subprocess
 import os
 import math
-from time import sleep
+from .aws_ota_build_cache import OtaBuildCache, buildCacheKey, waitForFileReady, fileMtimeNs
 
 
 class OtaAfrProject:
@@ -40,9 +38,14 @@ class OtaAfrProject:
         _boardProjectPath(str): the vendor/board/project specific path for building FreeRTOS.
         _buildProject(str): the name of the build project, which can be either 'demos' or 'tests'.
         _bootloaderSequenceNumber(int): the sequence number of bootloader.
+        _modifiedFiles(set(str)): The files in the project changed by this object.
+        _buildCache(obj:OtaBuildCache): Cache of the build outputs, None if disabled in the build_config.
     Methods:
         initializeOtaProject()
         buildProject()
+        getBuildCacheKey()
+        isBuildCached()
+        setBootloaderSequenceNumber(sequenceNumber)
         setClientCredentialForThingName(thingName)
         setClientCredentialKeys(certificate, privateKey)
         setApplicationVersion(major, minor, bugfix)
@@ -78,6 +81,15 @@ class OtaAfrProject:
         self._buildProject = boardConfig['demos_or_tests']
         self._boardProjectPath = boardConfig['vendor_board_path'] + '/aws_' +  self._buildProject
         self._bootloaderSequenceNumber = 0
+        self._otaConfig = boardConfig.get('ota_config', {})
+        self._flashConfig = boardConfig.get('flash_config', {})
+        self._modifiedFiles = set()
+        self._buildCache = None
+        if self._buildConfig.get('build_cache', True):
+            self._buildCache = OtaBuildCache(
+                self._buildConfig.get('build_cache_dir', os.path.join('build_cache', self._board_name)),
+                self._buildConfig.get('build_cache_max_entries', 20)
+            )
 
         OtaAfrProject.RUNNER_PATH = self._boardProjectPath + '/config_files/aws_demo_config.h'
         OtaAfrProject.OTA_CONFIG_PATH = self._boardProjectPath + '/config_files/aws_ota_agent_config.h'
@@ -103,7 +115,7 @@ class OtaAfrProject:
         else:
             raise Exception('ERROR: Invalid project root \"{}\". The valid values are \"demos\" and \"tests\".'.format(base))
 
-    def generateFactoryImage(self):
+    def generateFactoryImage(self, env=None):
         # If this board uses the FreeRTOS reference bootlaoder, then we want to
         # build and flash the factory image.
         if self._buildConfig.get('use_reference_bootloader', False) and OtaAfrProject.OTA_FACTORY_IMAGE_GENERATOR_PATH:
@@ -115,51 +127,98 @@ class OtaAfrProject:
                 '-x ' + self._buildConfig['bootloader_output']
             subprocess.call(
                 factoryImageGenCommand,
-                shell=True
+                shell=True,
+                env=env
             )
 
 
+    def __buildOutputs(self):
+        """The files written by buildProject() that exist: the build output, the OTA image, the
+        image to flash and the factory image.
+        """
+        outputs = [self._buildConfig['output'], self._otaConfig.get('ota_firmware_file_path'), self._flashConfig.get('output')]
+        if self._buildConfig.get('use_reference_bootloader', False) and OtaAfrProject.OTA_FACTORY_IMAGE_GENERATOR_PATH:
+            outputs.append(self._buildConfig['bootloader_output'])
+        return [output for index, output in enumerate(outputs) if output and output not in outputs[:index] and os.path.isfile(output)]
+
+    def __buildCommands(self):
+        return [command.format(**self._buildConfig) for command in self._buildConfig['commands']]
+
+    def getBuildCacheKey(self):
+        """Get the key of the outputs of building the project as it is now in the build cache.
+        """
+        return buildCacheKey(self._projectRootDir, self._modifiedFiles, self._buildConfig)
+
+    def isBuildCached(self):
+        """Are the outputs of building the project as it is now in the build cache?
+        """
+        return bool(self._buildCache) and self._buildCache.contains(self.getBuildCacheKey())
+
     def buildProject(self):
         """Build the FreeRTOS project represented by this object.
+        If the build cache holds the outputs of a build of the same sources, configuration files and
+        build commands, the outputs are restored instead.
         """
         # Update the bootloader sequence number for every new build
         returnCodes = []
         self.__incrementBootloaderSequenceNumber()
 
-        # Save the system path to restore.
-        system_path = os.environ['PATH']
-        # Add the tool_paths to the system PATH
+        buildCommands = self.__buildCommands()
+        cacheKey = None
+        if self._buildCache:
+            cacheKey = self.getBuildCacheKey()
+            if self._buildCache.restore(cacheKey, self._projectRootDir):
+                print('Build outputs of {} restored from the build cache.'.format(self._buildConfig['project_dir']))
+                return [0] * len(buildCommands)
+
+        # Add the tool_paths to the PATH of the build commands. The PATH of this process is left
+        # unchanged so that projects can be built from many threads at once.
+        env = dict(os.environ)
         for path in self._buildConfig['tool_paths']:
-            os.environ['PATH'] = path + os.pathsep + os.environ['PATH']
+            env['PATH'] = path + os.pathsep + env['PATH']
+
+        # The output of the previous build is still there, remember when it was written to tell it apart.
+        output = self._buildConfig['output']
+        previousOutputMtimeNs = fileMtimeNs(output)
 
-        buildCommands = self._buildConfig['commands']
         print('Building project {} ...'.format(self._buildConfig['project_dir']))
         for command in buildCommands:
-            command = command.format(**self._buildConfig)
             print('====> Executing Command: ' + command)
-            proc = subprocess.Popen(command + ' >> build.log 2>&1', shell=True)
+            proc = subprocess.Popen(command + ' >> build.log 2>&1', shell=True, env=env)
             proc.wait()
             print('====> Command run completed with the return code: ', proc.returncode)
             returnCodes.append(proc.returncode)
 
-        sleep(5) # added the sleep just to give enough time for the binaries to be generated properly and having unecessary exception.
-        output = self._buildConfig['output']
-        if not os.path.exists(output):
+        # Some build tools finish writing the binaries after the build command returns.
+        buildSucceeded = all(returnCode == 0 for returnCode in returnCodes)
+        if not waitForFileReady(output, self._buildConfig.get('output_ready_timeout_sec', 30)):
             print("ERROR: Could not find the output binary, the build might have failed.")
             print('Searched for build output at: {} and the current working directory is: '.format(self._buildConfig['output']), os.getcwd())
             raise Exception("Error building project check build.log")
         print('Build finished, output: {}'.format(self._buildConfig['output']))
 
         # We generate the factory image if applicable. This may depend on some build tool paths.
-        self.generateFactoryImage()
+        self.generateFactoryImage(env)
 
-        # Restore the system path
-        os.environ['PATH'] = system_path
+        # A build with unchanged inputs may leave the output of the previous build in place, which might
+        # not have been built from the sources of this key, so only a new output is cached.
+        if self._buildCache and buildSucceeded:
+            outputMtimeNs = fileMtimeNs(output)
+            if previousOutputMtimeNs is None or (outputMtimeNs is not None and outputMtimeNs > previousOutputMtimeNs):
+                self._buildCache.store(cacheKey, self.__buildOutputs(), self._projectRootDir)
+            else:
+                print('Build output {} is unchanged, not storing it in the build cache.'.format(output))
 
         return returnCodes
 
     def __incrementBootloaderSequenceNumber(self):
-        self._bootloaderSequenceNumber += 1
+        self.setBootloaderSequenceNumber(self._bootloaderSequenceNumber + 1)
+
+    def setBootloaderSequenceNumber(self, sequenceNumber):
+        """Set the sequence number of the last build. buildProject() numbers each build one more
+        than the last one.
+        """
+        self._bootloaderSequenceNumber = sequenceNumber
         if OtaAfrProject.OTA_BOOTLOADER_CONFIG_PATH:
             self.__setIdentifierInFile(
                 {
@@ -173,6 +232,7 @@ class OtaAfrProject:
         demos/ota/bootloader/utility/codesigner_cert_utility.
         """
         if OtaAfrProject.OTA_BOOTLOADER_CERTIFICATE_PATH:
+            self._modifiedFiles.add(os.path.abspath(os.path.join(self._projectRootDir, OtaAfrProject.OTA_BOOTLOADER_CERTIFICATE_PATH)))
             with open(os.path.join(self._projectRootDir, OtaAfrProject.OTA_BOOTLOADER_CERTIFICATE_PATH), 'w') as f:
                 f.write(certificate)
 
@@ -186,10 +246,11 @@ class OtaAfrProject:
 
         startMQTTdemo = "#define CONFIG_MQTT_DEMO_ENABLED"
         startotaUpdateDemo = "#define CONFIG_OTA_UPDATE_DEMO_ENABLED"
-        for line in fileinput.input(files=demoRunnerFilePath, inplace=True):
+        def rewriteLine(line):
             if (startMQTTdemo in line) and ("//" not in line) and ("/*" not in line):
                 line = line.replace(startMQTTdemo, startotaUpdateDemo)
-            sys.stdout.write(line)
+            return line
+        self.__rewriteFile(demoRunnerFilePath, rewriteLine)
 
     def __setTestRunnerForOtaDemo(self):
         """
@@ -241,13 +302,25 @@ class OtaAfrProject:
         Args:
             prefixToValue (dict[str:str]): Identifier to value.
         """
-        for line in fileinput.input(files=filePath, inplace=True):
+        def rewriteLine(line):
             if any(line.startswith(prefix) for prefix in prefixToValue.keys()):
                 prefix = next(prefix for prefix in prefixToValue.keys() if line.startswith(prefix))
                 if prefixToValue[prefix] != None:
                     line = '{} {}\n'.format(prefix, prefixToValue[prefix])
-            # print(line) will place an extra newline character in the file.
-            sys.stdout.write(line)
+            return line
+        self.__rewriteFile(filePath, rewriteLine)
+
+    def __rewriteFile(self, filePath, rewriteLine):
+        """
+        Rewrite the file in place with the text returned by rewriteLine(line) for each of its lines.
+        Unlike fileinput in place editing this does not redirect sys.stdout, so projects can be edited
+        while other threads are printing.
+        """
+        self._modifiedFiles.add(os.path.abspath(filePath))
+        with open(filePath, 'r') as f:
+            lines = f.readlines()
+        with open(filePath, 'w') as f:
+            f.writelines(rewriteLine(line) for line in lines)
 
     def setMqttLogsOn(self):
         """Set the MQTT debug logs to on in aws_mqtt_config.h
@@ -328,12 +401,11 @@ class OtaAfrProject:
     def __insertTexts(self, prefix, texts, filePath):
         """ insert texts after the line with prefix in the file filePath.
         """
-        for line in fileinput.input(files=filePath, inplace=True):
-            sys.stdout.write(line)
+        def rewriteLine(line):
             if (prefix in line) and ("//" not in line) and ("/*" not in line):
-                for text in texts:
-                    line = '{}\n'.format(text)
-                    sys.stdout.write(line)
+                line += ''.join('{}\n'.format(text) for text in texts)
+            return line
+        self.__rewriteFile(filePath, rewriteLine)
 
     def setBleConfig(self):
         """Set necessary configs for enabling OTA over BLE
@@ -395,10 +467,11 @@ class OtaAfrProject:
         """
         codeSignerCertificatePath = os.path.join(self._projectRootDir, OtaAfrProject.OTA_CODESIGNER_CERTIFICATE_PATH)
         signerCertificateTag = 'static const char signingcredentialSIGNING_CERTIFICATE_PEM[] = '
-        for line in fileinput.input(files=codeSignerCertificatePath, inplace=True):
+        def rewriteLine(line):
             if (signerCertificateTag in line):
                 line = '{} {}\n'.format(signerCertificateTag, '\"' + certificate.replace('\n', '\\n') + '\";')
-            sys.stdout.write(line)
+            return line
+        self.__rewriteFile(codeSignerCertificatePath, rewriteLine)
 
     def setOtaUpdateDemoForRootCA(self):
         """Sets the secure connection certificate in the MQTT connection parameters
@@ -419,11 +492,13 @@ class OtaAfrProject:
         clientCertificateKeysPath = os.path.join(self._projectRootDir, OtaAfrProject.CLIENT_CREDENTIAL_KEYS_PATH)
         rootCAPemTag = 'static const char clientcredentialROOT_CA_PEM[] ='
         found = False
-        for line in fileinput.input(files=clientCertificateKeysPath, inplace=True):
+        def rewriteLine(line):
+            nonlocal found
             if (rootCAPemTag in line):
                  line = '{} {}\n'.format(rootCAPemTag, ' \"' + certificate + '\";\n')
                  found = True
-            sys.stdout.write(line)
+            return line
+        self.__rewriteFile(clientCertificateKeysPath, rewriteLine)
 
         if not found:
             with open(clientCertificateKeysPath, 'a') as f:
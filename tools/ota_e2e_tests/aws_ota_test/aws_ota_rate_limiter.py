@@ -0,0 +1,85 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import time
+import multiprocessing
+from .aws_ota_aws_clients import getAwsClientPool
+
+# The limiter installed in this process by installRateLimiter().
+_rateLimiter = None
+
+class CloudRateLimiter:
+    """A token bucket shared by processes to keep their AWS API calls under a rate limit.
+    The limiter must be created in the parent process and handed to the worker processes when
+    they are created, e.g. as an initializer argument of a multiprocessing.Pool.
+    Attributes:
+        _rate(float): The number of calls per second.
+        _burst(float): The number of calls that can be made at once after a pause.
+        _tokens(multiprocessing.Value): The calls that can be made now.
+        _updated(multiprocessing.Value): The monotonic time _tokens was last updated.
+    Methods:
+        acquire()
+    """
+    def __init__(self, rate, burst=None):
+        self._rate = rate
+        self._burst = burst if burst else max(1, rate)
+        self._lock = multiprocessing.Lock()
+        self._tokens = multiprocessing.Value('d', self._burst, lock=False)
+        self._updated = multiprocessing.Value('d', time.monotonic(), lock=False)
+
+    def acquire(self):
+        """Block until a call can be made under the rate limit.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens.value = min(self._burst, self._tokens.value + (now - self._updated.value) * self._rate)
+                self._updated.value = now
+                if self._tokens.value >= 1:
+                    self._tokens.value -= 1
+                    return
+                wait = (1 - self._tokens.value) / self._rate
+            time.sleep(wait)
+
+def installRateLimiter(rateLimiter):
+    """Apply the rate limiter to all AWS API calls made in this process.
+    Calls through the boto3 clients and resources of the AwsClientPool are limited by a botocore
+    event hook. Install the limiter after configureAwsClientPool(), if called, and before the first
+    client is created, since clients copy the event hooks of the session when they are created.
+    """
+    global _rateLimiter
+    _rateLimiter = rateLimiter
+    getAwsClientPool().getSession().events.register('before-call', _throttleBotocoreCall)
+
+def _throttleBotocoreCall(**kwargs):
+    """botocore 'before-call' hook. Returning None lets the call proceed.
+    """
+    throttleAwsCall()
+
+def throttleAwsCall():
+    """Wait for the rate limiter installed in this process, if any, before an AWS API call.
+    """
+    if _rateLimiter:
+        _rateLimiter.acquire()
@@ -29,8 +29,10 @@ import time
 import errno
 import traceback
 import subprocess
+from threading import Event
 
 from .aws_ota_test_result import OtaTestResult
+from .aws_ota_test_timing import OtaTestTimer
 
 
 class OtaTestCase(ABC):
@@ -42,14 +44,45 @@ class OtaTestCase(ABC):
         _otaProject(obj:OtaAfrProject): FreeRTOS source code resource.
         _otaAwsAgent(obj:OtaAwsAgent): AWS CLI for OTA resource.
         _flashComm(obj:FlashSerialComm): MCU Flash and Serial read resource.
+        _timer(obj:OtaTestTimer): The timeline of the last run of the test.
     Methods:
         run() : abstract method
         getName()
+        configureProject(otaProject)
+        getBuildVariants()
         setup() : Sets up _otaProject as 0.9.0 should be overwritten if that is not desired.
         teardown()
         runTest()
+        pollOtaUpdateCompletion(otaUpdateId)
         getTestResultAfterOtaUpdateCompletion()
     """
+    # The changes to the project made by setup() before building the initial image, on top of the
+    # common configuration. Each change is an (OtaAfrProject method name, arguments) pair.
+    setupProjectChanges = []
+    # The changes to the project made by run() before each image it builds, in order.
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1))]
+    ]
+    # Lines of the device output, as regular expressions, showing that the device rejected the
+    # update. They fail a positive test and pass a negative one as soon as they are read.
+    rejectionSerialPatterns = [
+        r'Failed to pass \S+ signature verification',
+        r'Downgrade or same version not allowed, rejecting the update',
+        r'Rejecting job due to OTA_JobParseErr_t',
+        r'Received eOTA_JobEvent_Fail callback'
+    ]
+    # Lines of the device output that pass or fail the test as soon as they are read.
+    expectedSerialPatterns = []
+    failureSerialPatterns = []
+    # Lines of the OTA agent output, as regular expressions, marking the phases of the update on the
+    # device, see OTA_TEST_PHASES. Each (mark, pattern, mark it only once after) is timed when read.
+    timingSerialPatterns = [
+        ('job_accepted', r'Job was accepted\. Attempting to start transfer', None),
+        ('first_block', r'Received file block \d+, size (\d+)', 'job_accepted'),
+        ('download_complete', r'Received final expected block of file', None),
+        ('self_test', r'Received eOTA_JobEvent_StartTest callback|In self test mode', 'download_complete')
+    ]
+
     def __init__(self, positive, boardConfig, otaProject, otaAwsAgent, flashComm, protocol):
         self._name = self.__class__.__name__
         self._positive = positive
@@ -59,6 +92,7 @@ class OtaTestCase(ABC):
         self._otaAwsAgent = otaAwsAgent
         self._flashComm = flashComm
         self._protocol = protocol
+        self._timer = OtaTestTimer()
 
         self._logFilePath = os.path.join(
             'logs',
@@ -92,29 +126,51 @@ class OtaTestCase(ABC):
         """
         return f'{self._name}_{self._protocol}'
 
-    def setup(self):
-        """Setup the OTA test.
-        All the necessary setup. Optional method, but do call super setup if implementation is provided in sub-class.
+    def configureProject(self, otaProject):
+        """Make the changes to the project that setup() makes before building the initial image.
+        Args:
+            otaProject(obj:OtaAfrProject): The project to change, _otaProject or a copy of it.
         """
-        self._otaProject.initializeOtaProject()
-        self._otaProject.setClientCredentialsForAwsIotEndpoint(self._otaAwsAgent.getAwsIotEndpoint())
-        self._otaProject.setClientCredentialsForWifi(self._boardConfig['wifi_ssid'], self._boardConfig['wifi_password'], self._boardConfig['wifi_security'])
-        self._otaProject.setClientCredentialForThingName(self._otaAwsAgent.getThingName())
-        self._otaProject.setClientCredentialKeys(self._otaAwsAgent.getThingCertificate(), self._otaAwsAgent.getThingPrivateKey())
-        self._otaProject.copyCodesignerCertificateToBootloader(self._otaAwsAgent.getCodeSignerCertificateFromArn(self._otaConfig['aws_signer_certificate_arn']))
-        self._otaProject.setMqttLogsOn()
-        self._otaProject.setFreeRtosConfigNetworkInterface(self._boardConfig.get('windows_network_interface', 0))
+        otaProject.initializeOtaProject()
+        otaProject.setClientCredentialsForAwsIotEndpoint(self._otaAwsAgent.getAwsIotEndpoint())
+        otaProject.setClientCredentialsForWifi(self._boardConfig['wifi_ssid'], self._boardConfig['wifi_password'], self._boardConfig['wifi_security'])
+        otaProject.setClientCredentialForThingName(self._otaAwsAgent.getThingName())
+        otaProject.setClientCredentialKeys(self._otaAwsAgent.getThingCertificate(), self._otaAwsAgent.getThingPrivateKey())
+        otaProject.copyCodesignerCertificateToBootloader(self._otaAwsAgent.getCodeSignerCertificateFromArn(self._otaConfig['aws_signer_certificate_arn']))
+        otaProject.setMqttLogsOn()
+        otaProject.setFreeRtosConfigNetworkInterface(self._boardConfig.get('windows_network_interface', 0))
         if self._otaConfig.get('compile_codesigner_certificate', False):
-            self._otaProject.setCodesignerCertificate(self._otaAwsAgent.getCodeSignerCertificateFromArn(self._otaConfig['aws_signer_certificate_arn']))
+            otaProject.setCodesignerCertificate(self._otaAwsAgent.getCodeSignerCertificateFromArn(self._otaConfig['aws_signer_certificate_arn']))
         transportation = self._otaConfig.get('transportation')
         if transportation == 'ble':
-            self._otaProject.setBleConfig()
+            otaProject.setBleConfig()
         if 'HTTP' in self._protocol:
-            self._otaProject.setHTTPConfig()
-        self._otaProject.setApplicationVersion(0, 9, 0)
+            otaProject.setHTTPConfig()
+        otaProject.setApplicationVersion(0, 9, 0)
+        for method, args in self.setupProjectChanges:
+            getattr(otaProject, method)(*args)
+
+    def getBuildVariants(self):
+        """Get the changes to the project before each image this test case builds, on top of
+        configureProject(). The images can then be built ahead of the test, see OtaImagePlanner.
+        Returns a list with a list of (OtaAfrProject method name, arguments) pairs per image.
+        """
+        variants = [[]]
+        for changes in self.runProjectChanges:
+            variants.append(variants[-1] + list(changes))
+        return variants
+
+    def setup(self):
+        """Setup the OTA test.
+        All the necessary setup. Optional method, but do call super setup if implementation is provided in sub-class.
+        Changes to the project before the initial image is built go in setupProjectChanges.
+        """
+        self.configureProject(self._otaProject)
 
         buildReturnCode = self._otaProject.buildProject()
+        self._timer.mark('build_done')
         flashReturnCode = self._flashComm.flashAndRead()
+        self._timer.mark('flash_done')
 
         return buildReturnCode + flashReturnCode
 
@@ -126,24 +182,49 @@ class OtaTestCase(ABC):
 
         # Call git to reset the source code.
         try:
-          subprocess.run(['git', 'checkout', f'{self._boardConfig["afr_root"]}'])
+          subprocess.run(['git', '-C', f'{self._boardConfig["afr_root"]}', 'checkout', '.'])
         except OSError as e:
           print(f'Error reseting the source code: {e}')
 
+    def __addTimingPatterns(self):
+        """Time the phases of the update on the device from its output. Returns the pattern tokens.
+        """
+        matcher = self._flashComm.getSerialMatcher()
+        timer = self._timer
+
+        def onMatch(name, after):
+            def callback(match):
+                if after:
+                    timer.markOnceAfter(name, after, 'device')
+                else:
+                    timer.mark(name, 'device')
+                if name == 'first_block':
+                    timer.count('blocks')
+                    timer.count('block_bytes', int(match.group(1)))
+            return callback
+
+        return [matcher.addPattern(pattern, onMatch(name, after)) for name, pattern, after in self.timingSerialPatterns]
+
     def runTest(self):
         """Run this OTA test case.
         """
         start = time.time()
         print(f'---------- Running {self._boardConfig["name"]} : {self.getName()} ----------')
+        self._timer = OtaTestTimer()
+        self._timer.setMetadata('protocol', self._protocol)
+        self._timer.mark('test_start')
+        timingTokens = self.__addTimingPatterns()
 
         # Run the implemented runTest function
         logAppendage = ''
         try:
             # Run the implemented setup.
+            self._timer.mark('setup_start')
             returnCodes = self.setup()
 
             # Run the actual test.
             if all(p == 0 for p in returnCodes):
+                self._timer.mark('run_start')
                 testResult = self.run()
             else:
                 testResult = OtaTestResult(testName=self.getName(), result=OtaTestResult.ERROR, summary='Building or flashing failed. Please check logs.')
@@ -156,10 +237,15 @@ class OtaTestCase(ABC):
         self.createTestLog(logAppendage)
 
         # Clean up
+        self._timer.mark('teardown_start')
         self.teardown()
+        for token in timingTokens:
+            self._flashComm.getSerialMatcher().removePattern(token)
+        self._timer.mark('test_end')
 
         print(f'---------- Finished {self._boardConfig["name"]} : {self.getName()} ----------')
         end = time.time()
+        testResult.timing = self.__getTiming()
 
         time.sleep(3) # Wait for the device log flashes completely.
 
@@ -167,6 +253,17 @@ class OtaTestCase(ABC):
 
         return testResult
 
+    def __getTiming(self):
+        """Get the timing of the last run, with the size of the blocks and the download throughput.
+        """
+        timing = self._timer.toDict()
+        blocks = timing['counters'].get('blocks')
+        if blocks:
+            timing['metadata']['block_size'] = timing['counters']['block_bytes'] // blocks
+            if timing['phases'].get('download'):
+                timing['metadata']['download_bytes_per_sec'] = timing['counters']['block_bytes'] / timing['phases']['download']
+        return timing
+
     def createTestLog(self, appendage=''):
         """Create a log in the file system of the device output for this test case.
         """
@@ -176,8 +273,9 @@ class OtaTestCase(ABC):
             except OSError as exc: # Guard against race condition
                 if exc.errno != errno.EEXIST:
                     raise
-        with open(self._logFilePath, 'w') as logFile:
-            logFile.write(self._flashComm.getSerialLog() + appendage)
+        with open(self._logFilePath, 'wb') as logFile:
+            self._flashComm.writeSerialLog(logFile)
+            logFile.write(appendage.encode())
 
     @abstractmethod
     def run(self):
@@ -186,11 +284,52 @@ class OtaTestCase(ABC):
         """
         raise Exception("OtaTestCase::run is not implemented. Please provide the implementation.")
 
+    def pollOtaUpdateCompletion(self, otaUpdateId):
+        """Wait for the OTA update to complete, or for a line of the device output matching one of the
+        serial patterns to decide the test, whichever comes first.
+        Args:
+            otaUpdateId(str): AWS IoT OTA Update ID to poll for completion status.
+        Returns the job status, the summary, and the result (OtaTestResult.PASS or FAIL) decided by
+        the device output, None if no pattern matched.
+        """
+        matcher = self._flashComm.getSerialMatcher()
+        stopEvent = Event()
+        verdicts = []
+
+        def onMatch(result):
+            def callback(match):
+                if not verdicts:
+                    verdicts.append((result, match.string.strip()))
+                    self._otaAwsAgent.stopWaitingOtaUpdates(stopEvent)
+            return callback
+
+        rejectionResult = OtaTestResult.FAIL if self._positive else OtaTestResult.PASS
+        patterns = [(pattern, rejectionResult) for pattern in self.rejectionSerialPatterns] + \
+            [(pattern, OtaTestResult.PASS) for pattern in self.expectedSerialPatterns] + \
+            [(pattern, OtaTestResult.FAIL) for pattern in self.failureSerialPatterns]
+        tokens = [matcher.addPattern(pattern, onMatch(result)) for pattern, result in patterns]
+        self._timer.mark('job_created')
+        try:
+            jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'], stopEvent)
+        finally:
+            self._timer.mark('job_terminal')
+            for token in tokens:
+                matcher.removePattern(token)
+
+        if not verdicts:
+            return jobStatus, summary, None
+        result, line = verdicts[0]
+        print(f'Device output decided the test: {line}')
+        return jobStatus, f'Device output: {line}', result
+
     def getTestResultAfterOtaUpdateCompletion(self, otaUpdateId):
         """Utility helper to poll for completion of the input job then stop reading
         from the serial port.
         Args:
             otaUpdateId(str): AWS IoT OTA Update ID to poll for completion status.
         """
-        jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'])
-        return OtaTestResult.testResultFromJobStatus(self.getName(), jobStatus, self._positive, summary)
+        jobStatus, summary, serialResult = self.pollOtaUpdateCompletion(otaUpdateId)
+        testResult = OtaTestResult.testResultFromJobStatus(self.getName(), jobStatus, self._positive, summary)
+        if serialResult:
+            testResult.result = serialResult
+        return testResult
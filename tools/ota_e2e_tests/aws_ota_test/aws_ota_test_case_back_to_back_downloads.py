@@ -33,6 +33,11 @@ class OtaTestBackToBackDownloads(OtaTestCase):
     """
 
     is_positive = True
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1))],
+        [('setApplicationVersion', (0, 9, 2))],
+        [('setApplicationVersion', (0, 9, 3))]
+    ]
 
     def __buildAndOtaInputVersion(self, x, y, z):
         # Build x.y.z for download
@@ -42,7 +47,7 @@ class OtaTestBackToBackDownloads(OtaTestCase):
         # Start an OTA Update.
         otaUpdateId = self._otaAwsAgent.quickCreateOtaUpdate(self._otaConfig, [self._protocol])
         # Poll on completion
-        jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'])
+        jobStatus, summary, _ = self.pollOtaUpdateCompletion(otaUpdateId)
         return jobStatus, summary
 
     def run(self):
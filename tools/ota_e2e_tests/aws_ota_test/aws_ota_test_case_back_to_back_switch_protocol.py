@@ -37,19 +37,20 @@ class OtaTestBackToBackSwitchProtocol(OtaTestCase):
     """
 
     is_positive = True
+    # Always turn on MQTT and HTTP.
+    setupProjectChanges = [('setHTTPConfig', ())]
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1))],
+        [('setApplicationVersion', (0, 9, 2))]
+    ]
 
     @classmethod
     def generate_test_cases(cls, boardConfig, otaProject, otaAwsAgent, flashComm):
         return [cls(cls.is_positive, boardConfig, otaProject, otaAwsAgent, flashComm, 'MIXED')]
 
-    # Override the setup to always turn on MQTT and HTTP.
-    def setup(self):
-        self._otaProject.setHTTPConfig()
-        return super().setup()
-
     def _doOTAUpdate(self, protocol):
         otaUpdateId = self._otaAwsAgent.quickCreateOtaUpdate(self._otaConfig, [protocol])
-        jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'])
+        jobStatus, summary, _ = self.pollOtaUpdateCompletion(otaUpdateId)
         return jobStatus, summary
 
     def _doInvalidOTAUpdate(self, protocol):
@@ -89,7 +90,7 @@ class OtaTestBackToBackSwitchProtocol(OtaTestCase):
                 },
             ]
         )
-        jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'])
+        jobStatus, summary, _ = self.pollOtaUpdateCompletion(otaUpdateId)
         return jobStatus, summary
 
     def run(self):
@@ -39,17 +39,17 @@ class OtaTestDefaultDataProtocol(OtaTestCase):
     """
 
     is_positive = True
+    # Always turn on MQTT and HTTP. And set the primary data protocol to MQTT.
+    setupProjectChanges = [('setHTTPConfig', ()), ('setOTAPrimaryDataProtocol', ('MQTT',))]
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1)), ('setOTAPrimaryDataProtocol', ('HTTP',))],
+        [('setApplicationVersion', (0, 9, 2))]
+    ]
 
     @classmethod
     def generate_test_cases(cls, boardConfig, otaProject, otaAwsAgent, flashComm):
         return [cls(cls.is_positive, boardConfig, otaProject, otaAwsAgent, flashComm, 'MIXED')]
 
-    # Override the setup to always turn on MQTT and HTTP. And set the primary data protocol to MQTT.
-    def setup(self):
-        self._otaProject.setHTTPConfig()
-        self._otaProject.setOTAPrimaryDataProtocol('MQTT')
-        return super().setup()
-
     def run(self):
         # Set default protocol to HTTP in the new image.
         self._otaProject.setApplicationVersion(0, 9, 1)
@@ -59,7 +59,7 @@ class OtaTestDefaultDataProtocol(OtaTestCase):
         # Create an OTA update with both protocols. Device should perform a successful OTA update
         # with MQTT.
         otaUpdateId = self._otaAwsAgent.quickCreateOtaUpdate(self._otaConfig, ['MQTT', 'HTTP'])
-        jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'])
+        jobStatus, summary, _ = self.pollOtaUpdateCompletion(otaUpdateId)
         if jobStatus.status != 'SUCCEEDED':
             return OtaTestResult.testResultFromJobStatus(self.getName(), jobStatus, True, summary)
 
@@ -68,6 +68,6 @@ class OtaTestDefaultDataProtocol(OtaTestCase):
         self._otaProject.setApplicationVersion(0, 9, 2)
         self._otaProject.buildProject()
         otaUpdateId = self._otaAwsAgent.quickCreateOtaUpdate(self._otaConfig, ['MQTT', 'HTTP'])
-        jobStatus, summary = self._otaAwsAgent.pollOtaUpdateCompletion(otaUpdateId, self._otaConfig['ota_timeout_sec'])
+        jobStatus, summary, _ = self.pollOtaUpdateCompletion(otaUpdateId)
 
         return OtaTestResult.testResultFromJobStatus(self.getName(), jobStatus, self._positive, summary)
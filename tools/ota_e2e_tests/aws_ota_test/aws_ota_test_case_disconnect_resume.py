@@ -25,9 +25,9 @@ http://www.FreeRTOS.org
 """
 import time
 from pathlib import Path
-import boto3
 from botocore.exceptions import ClientError
 import paho.mqtt.client as mqtt
+from .aws_ota_aws_clients import getAwsClientPool
 from .aws_ota_test_case import OtaTestCase
 from .aws_ota_test_result import OtaTestResult
 
@@ -45,7 +45,7 @@ class OtaTestDisconnectResume(OtaTestCase):
     connected_to_iot = False
 
     def get_job_exec_status(self, update_id, thing_name):
-        iot_client = boto3.client('iot')
+        iot_client = getAwsClientPool().client('iot')
         exec_status = 'QUEUED'
         try:
             response = iot_client.describe_job_execution(jobId=f'AFR_OTA-{update_id}', thingName=thing_name)
@@ -38,6 +38,9 @@ class OtaTestDummyTest(OtaTestCase):
         # Adding empty list for return to indicate the successful setup.
         return []
 
+    def getBuildVariants(self):
+        return []
+
     def teardown(self):
         print('Ran OtaTestDummyTest::teardown.')
 
@@ -34,6 +34,9 @@ class OtaTestGreaterVersionMaxBlockConfig(OtaTestCase):
     """
 
     is_positive = True
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1)), ('setOtaBlockNumber', (128,))]
+    ]
 
     @staticmethod
     def supported_protocols():
@@ -34,6 +34,9 @@ class OtaTestGreaterVersionMinBlockConfig(OtaTestCase):
     """
 
     is_positive = True
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1)), ('setOtaBlockNumber', (1,))]
+    ]
 
     @staticmethod
     def supported_protocols():
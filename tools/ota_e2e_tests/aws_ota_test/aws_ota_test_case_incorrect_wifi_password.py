@@ -33,6 +33,9 @@ class OtaTestIncorrectWifiPassword(OtaTestCase):
     """
 
     is_positive = False
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 1)), ('setClientCredentialsForWifi', ('invalid_ssid', 'invalid_password', 'eWiFiSecurityWPA2'))]
+    ]
 
     def run(self):
         # Increase the version of the OTA image.
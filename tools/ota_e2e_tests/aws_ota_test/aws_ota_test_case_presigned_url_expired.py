@@ -37,17 +37,14 @@ class OtaTestPresignedUrlExpired(OtaTestCase):
     """
 
     is_positive = True
+    # Change block size to 1 KB, this is to slow down the OTA update.
+    # TODO, this varies from board to board, find a better way to slow down the OTA update.
+    setupProjectChanges = [('setOtaBlockSize', (1024,))]
 
     @staticmethod
     def supported_protocols():
         return ['HTTP']
 
-    def setup(self):
-        # Change block size to 1 KB, this is to slow down the OTA update.
-        # TODO, this varies from board to board, find a better way to slow down the OTA update.
-        self._otaProject.setOtaBlockSize(1024)
-        return super().setup()
-
     def teardown(self):
         # Change block size back to 4 KB.
         self._otaProject.setOtaBlockSize(4096)
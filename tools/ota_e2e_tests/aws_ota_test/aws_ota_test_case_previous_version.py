@@ -32,6 +32,9 @@ class OtaTestPreviousVersion(OtaTestCase):
     """
 
     is_positive = False
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 8, 0))]
+    ]
 
     def run(self):
         # Decrease the version of the OTA image.
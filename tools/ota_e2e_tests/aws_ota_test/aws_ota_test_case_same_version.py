@@ -32,6 +32,9 @@ class OtaTestSameVersion(OtaTestCase):
     """
 
     is_positive = False
+    runProjectChanges = [
+        [('setApplicationVersion', (0, 9, 0))]
+    ]
 
     def run(self):
         # Keep the same version of the image from setup() called in the superclass.
@@ -32,6 +32,7 @@ class OtaTestSingleByteImage(OtaTestCase):
     """
 
     is_positive = False
+    runProjectChanges = []
 
     def __init__(self, positive, boardConfig, otaProject, otaAwsAgent, flashComm, protocol):
         # Create a large-ish file that is not a working binary image.
@@ -43,20 +44,20 @@ class OtaTestSingleByteImage(OtaTestCase):
         # Call base constructor.
         super().__init__(positive, boardConfig, otaProject, otaAwsAgent, flashComm, protocol)
 
-    def run(self):
-        # Upload the bad image to s3.
-        self._otaAwsAgent.uploadFirmwareToS3Bucket(
+    def setup(self):
+        # Upload and sign the image while the board is built and flashed.
+        self._signerJobFuture = self._otaAwsAgent.submitFirmwareSigning(
             self.singleByteFileName,
-            self.singleByteFileName
-        )
-
-        # Sign the corrupted image in s3 from the unsigned bucket to the signed bucket.
-        signerJobId = self._otaAwsAgent.signFirmwareInS3Bucket(
             self.singleByteFileName,
             self._otaConfig['aws_signer_certificate_arn'],
             self._otaConfig['aws_signer_certificate_file_name'],
             self._otaConfig['aws_signer_platform']
         )
+        return super().setup()
+
+    def run(self):
+        # Wait for the bad image to be uploaded to s3 and signed.
+        signerJobId = self._signerJobFuture.result()
         # Create a stream from the image in the signed image in the signed bucket.
         streamId = self._otaAwsAgent.createIotStream(
             self._otaAwsAgent.getS3BucketName(),
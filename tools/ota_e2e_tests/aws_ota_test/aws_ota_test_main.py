@@ -27,12 +27,19 @@ import os
 import json
 import sys
 import argparse
+import subprocess
+import traceback
+from multiprocessing import Pool
 from threading import Thread
 from functools import reduce
 from operator import add
 from junit_xml import TestSuite, TestCase
 from .aws_ota_test_runner import *
 from .aws_ota_test_result import OtaTestResult
+from .aws_ota_rate_limiter import CloudRateLimiter, installRateLimiter
+from .aws_ota_aws_clients import configureAwsClientPool
+from .aws_ota_test_timing import formatPhases, writeTimingTrace
+from .aws_ota_build_cache import rebaseConfigPaths, sourceRevision
 
 def parseArgs():
     """Parse input arguments.
@@ -45,11 +52,17 @@ def parseArgs():
     parser.add_argument('--disable-tests', nargs='*', action='append', required=False, dest='disabledTests', help='The list of OTA E2E test cases to disabled. This option will excluse tests from the complete list. This option will be ignored if --tests is specified.')
     parser.add_argument('--tests', nargs='*', action='append', required=False, dest='enabledTests', help='The list of OTA E2E test cases to enable. This option allows for selecting specific tests.')
     parser.add_argument('--separate-threads-per-board', action='store_true', dest='separateThreads', help='Create a separate thread per board configuration. WARNING: You must have \"afr_root\" paths specified per board, as writing and build the project is not synchronized.')
+    parser.add_argument('--parallel-boards', action='store', type=int, required=False, default=0, dest='parallelBoards', help='Run up to this many boards at once, each in its own process with its own environment and its own git worktree of \"afr_root\" under --board-workspace-dir.')
+    parser.add_argument('--board-workspace-dir', action='store', required=False, default='board_workspaces', dest='boardWorkspaceDir', help='The directory of the git worktrees used by --parallel-boards and --prebuild-jobs. Worktrees are kept between runs so that builds stay incremental, and are checked out at the commit of \"afr_root\" on every run.')
+    parser.add_argument('--prebuild-jobs', action='store', type=int, required=False, default=0, dest='prebuildJobs', help='Build the OTA images of all of the tests of a board with this many jobs, each in its own git worktree of \"afr_root\" under --board-workspace-dir, before flashing the board. Requires the build cache.')
+    parser.add_argument('--cloud-api-rate', action='store', type=float, required=False, default=10, dest='cloudApiRate', help='The maximum number of AWS API calls per second shared by all of the boards run with --parallel-boards.')
     parser.add_argument('--stage', action='store', required=False, default='prod', dest='stage', choices=['alpha','beta','gamma','prod'], help='If the OTA E2E scripts are to use the \'beta\', \'alpha\', or \'gamma\' AWS service stack, then specify which.')
     parser.add_argument('--endpoint-url', action='store', required=False, dest='endpointUrl', help='The url for the endpoint for AWS IoT CLI operations when --stage is specified.')
     parser.add_argument('--signer-endpoint-url', action='store', required=False, dest='signerEndpointUrl', help='On certain stages AWS signer needs an endpoint URL')
     parser.add_argument('--region', action='store', required=False, dest='region', help='The region for AWS CLI operations when --stage is specified.')
     parser.add_argument('--certificate', action='store', required=False, dest='certificatePath', help='The path to the PEM encoded secure connection certificate needed for stages other than Production.')
+    parser.add_argument('--aws-stub-endpoint-url', action='store', required=False, dest='awsStubEndpointUrl', help='Send the AWS API calls of every service to this URL instead of AWS, e.g. a local moto server at http://localhost:5000, to run the tests offline.')
+    parser.add_argument('--timing-trace', action='store', required=False, default='ota_test_timing.json', dest='timingTrace', help='The JSON file to write the time spent in each phase of each test to, also viewable as a Chrome trace. Empty to not write it.')
     parser.add_argument('--data-protocols', nargs='+', required=False, default=['MQTT', 'HTTP'], dest='dataProtocols', help='OTA data transfer protocols, valid values are "mqtt" and "http". If not supported by device, tests are ignored.')
     args = parser.parse_args()
 
@@ -138,16 +151,70 @@ def formatConfigValues(targetConfig, formatConfig1, formatConfig2 = {}):
             value = value.format(**formatConfig1, **formatConfig2)
             targetConfig[key] = value
 
-def getBoardOtaTestResult(boardConfig, stageParams, otaTestResults):
+def getBoardOtaTestResult(boardConfig, stageParams, otaTestResults, prebuildJobs=0, workspaceDir='board_workspaces'):
     """Get the OTA test case results from the board under test specified in the boardConfig.
     Args:
         boardConfig(dict): Configuration for the board under test.
         otaTestResults(list(obj:OtaTestResult)): Array of test results to update.
+        prebuildJobs(int): The number of OTA images to pre-build at once, 0 to build during the tests.
+        workspaceDir(str): The directory holding the git worktrees the OTA images are pre-built in.
     """
     # Create a OtaTestRunner instance and call RunTests -> returns results.
-    otaTestRunner = OtaTestRunner(boardConfig, stageParams)
+    otaTestRunner = OtaTestRunner(boardConfig, stageParams, prebuildJobs, workspaceDir)
     otaTestResults += otaTestRunner.runTests()
 
+def isolateBoardWorkspace(boardConfig, workspaceDir):
+    """Check out the board's "afr_root" in a git worktree of its own and point the board configuration at it.
+    Boards run at the same time then neither edit nor build each other's sources. A worktree kept from an
+    earlier run is checked out again at the commit of "afr_root", so that it doesn't test old sources.
+    Args:
+        boardConfig(dict): Configuration for the board under test, updated in place.
+        workspaceDir(str): The directory holding the worktree of each board.
+    """
+    afrRoot = boardConfig['afr_root']
+    workspace = os.path.abspath(os.path.join(workspaceDir, boardConfig['name']))
+    revision = sourceRevision(afrRoot)
+    if not revision:
+        raise Exception('The "afr_root" {} of board {} is not a git repository.'.format(afrRoot, boardConfig['name']))
+    if not os.path.exists(workspace):
+        subprocess.check_call(['git', '-C', afrRoot, 'worktree', 'add', '--detach', workspace, revision])
+    else:
+        subprocess.check_call(['git', '-C', workspace, 'checkout', '--quiet', '--force', '--detach', revision])
+    rebaseConfigPaths(boardConfig, afrRoot, workspace)
+
+def getBoardOtaTestResultInProcess(boardConfig, stageParams, workspaceDir, prebuildJobs):
+    """Get the OTA test case results from the board under test in a worker process of runBoardsInProcesses().
+    The environment changes made by the test runner stay in this process.
+    Returns the board's list of OtaTestResult.
+    """
+    otaTestResults = []
+    try:
+        isolateBoardWorkspace(boardConfig, workspaceDir)
+        getBoardOtaTestResult(boardConfig, stageParams, otaTestResults, prebuildJobs, workspaceDir)
+    except Exception:
+        print(traceback.format_exc())
+        otaTestResults.append(OtaTestResult(result=OtaTestResult.ERROR, board=boardConfig['name'], testName='OtaTestRunner', summary='Exception found while running the board\'s tests. Please check logs.'))
+    return otaTestResults
+
+def initializeBoardProcess(rateLimiter, awsStubEndpointUrl):
+    """Set up the AWS clients of a worker process of runBoardsInProcesses().
+    """
+    configureAwsClientPool(awsStubEndpointUrl)
+    installRateLimiter(rateLimiter)
+
+def runBoardsInProcesses(boardConfigs, stageParams, args):
+    """Run the tests of many boards at once, one process per board.
+    All of the processes share one limit on the rate of AWS API calls.
+    Returns a dictionary of the board name to its list of OtaTestResult.
+    """
+    rateLimiter = CloudRateLimiter(args.cloudApiRate)
+    with Pool(processes=args.parallelBoards, initializer=initializeBoardProcess, initargs=(rateLimiter, args.awsStubEndpointUrl)) as pool:
+        boardToAsyncResults = {
+            boardConfig['name']: pool.apply_async(getBoardOtaTestResultInProcess, (boardConfig, stageParams, args.boardWorkspaceDir, args.prebuildJobs))
+            for boardConfig in boardConfigs
+        }
+        return { board: asyncResult.get() for board, asyncResult in boardToAsyncResults.items() }
+
 def createJunitTestResults(boardToResults, fileName):
     """Create junit xml test result.
     Args:
@@ -158,7 +225,13 @@ def createJunitTestResults(boardToResults, fileName):
     for board in boardToResults.keys():
         testCases = []
         for otaTestResult in boardToResults[board]:
-            testCase = TestCase(otaTestResult.testName, classname=board + '.OTAEndToEndTests')
+            timing = otaTestResult.timing
+            testCase = TestCase(
+                otaTestResult.testName,
+                classname=board + '.OTAEndToEndTests',
+                elapsed_sec=timing['phases'].get('total') if timing else None,
+                stdout=formatPhases(timing) if timing else None
+            )
             testCases.append(testCase)
             if otaTestResult.result == OtaTestResult.FAIL:
                 testCases[-1].add_failure_info(message=otaTestResult.summary)
@@ -195,8 +268,10 @@ def otaTestMain():
     boardConfigs = getBoardConfigsFromInputArgs(args)
     boardConfigs = cleanBoardConfigsForInputArgs(args, boardConfigs)
     stageParams = getStageParameters(args)
+    configureAwsClientPool(args.awsStubEndpointUrl)
     boardToResults = {}
     threads = []
+    parallelBoardConfigs = []
     for boardConfig in boardConfigs:
         if boardConfig['exclude']:
             continue
@@ -205,13 +280,15 @@ def otaTestMain():
         args.dataProtocols = [p.upper() for p in args.dataProtocols]
         data_protocols = set(args.dataProtocols) & set(boardConfig['ota_config'].get('data_protocols', ['MQTT']))
         boardConfig['ota_config']['data_protocols'] = list(data_protocols)
-        if args.separateThreads == True:
+        if args.parallelBoards > 0:
+            parallelBoardConfigs.append(boardConfig)
+        elif args.separateThreads == True:
             threads.append(Thread(
                 target=getBoardOtaTestResult, \
-                args=(boardConfig, stageParams, boardToResults[boardConfig['name']])
+                args=(boardConfig, stageParams, boardToResults[boardConfig['name']], args.prebuildJobs, args.boardWorkspaceDir)
             ))
         else:
-            getBoardOtaTestResult(boardConfig, stageParams, boardToResults[boardConfig['name']])
+            getBoardOtaTestResult(boardConfig, stageParams, boardToResults[boardConfig['name']], args.prebuildJobs, args.boardWorkspaceDir)
 
     for i in range(len(threads)):
         threads[i].start()
@@ -219,5 +296,10 @@ def otaTestMain():
     for i in range(len(threads)):
         threads[i].join()
 
+    if parallelBoardConfigs:
+        boardToResults.update(runBoardsInProcesses(parallelBoardConfigs, stageParams, args))
+
     # Compile results into a final junit file
     createJunitTestResults(boardToResults, 'ota_test_results.xml')
+    if args.timingTrace:
+        writeTimingTrace(boardToResults, args.timingTrace)
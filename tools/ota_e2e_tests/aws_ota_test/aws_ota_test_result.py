@@ -23,6 +23,8 @@ http://aws.amazon.com/freertos
 http://www.FreeRTOS.org
 
 """
+from .aws_ota_test_timing import formatPhases
+
 class OtaTestResult:
     """Object representing a OTA test result.
     Attributes
@@ -31,6 +33,7 @@ class OtaTestResult:
         testName(str): The name of this testcase.
         jobStatus(str): The job status from AWS IoT, containing both status and status reason provided by devices.
         summary(str): The summary for the test result.
+        timing(dict): The phases and marks of the test, see OtaTestTimer.toDict(), None if not timed.
     Methods:
         testResultFromJobStatus(passOrFail, jobStatus, isPositive)
     Example:
@@ -58,18 +61,21 @@ class OtaTestResult:
         ERROR:  __WARNING,
     }
 
-    def __init__(self, *, result, board='', testName='', jobStatus=None, summary=''):
+    def __init__(self, *, result, board='', testName='', jobStatus=None, summary='', timing=None):
         self.result = result
         self.board = board
         self.testName = testName
         self.jobStatus = jobStatus
         self.summary = summary
+        self.timing = timing
 
     def print(self, elapsed):
         print(self.__RESULT_COLOR[self.result] + 'OTA E2E TEST RESULT: ' + self.result)
         print(self.__OKBLUE + 'IOT JOB STATUS: ' + (self.jobStatus if self.jobStatus else 'No IoT Job Status'))
         print(self.__OKBLUE + 'OTA E2E TEST RESULT SUMMARY: ' + (self.summary if self.summary else 'No Test Summary') + self.__ENDC)
         print(self.__BOLD + 'Time Elapsed: ' + str(int(elapsed / 60)) + " Minutes and " + str(int(elapsed % 60)) + " Seconds"  + self.__ENDC)
+        if self.timing:
+            print(self.__OKBLUE + 'Time by phase:\n' + formatPhases(self.timing) + self.__ENDC)
 
     @staticmethod
     def testResultFromJobStatus(testName, jobStatus, isPositive, summary):
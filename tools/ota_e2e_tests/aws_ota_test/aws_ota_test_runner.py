@@ -30,6 +30,7 @@ from .aws_ota_project import OtaAfrProject
 from .aws_ota_aws_agent import OtaAwsAgent
 from .aws_ota_test_case_factory import OtaTestCaseFactory
 from .aws_ota_test_result import OtaTestResult
+from .aws_ota_image_planner import OtaImagePlanner
 
 class OtaTestRunner:
     """Run all of the OTA tests.
@@ -38,13 +39,18 @@ class OtaTestRunner:
     Args:
         boardConfig(dict): The full board.json configuration.
         stage(dict): What development environment stage the AWS service stack is in to run OTA tests.
+        prebuildJobs(int): Build the OTA images of all of the tests with this many jobs before running them. 0 to build during the tests.
+        workspaceDir(str): The directory holding the git worktrees the OTA images are pre-built in.
     Attributes:
         _flashComm(obj:FlashSerialComm): MCU flash and serial communication resource.
         _otaProject(obj:OtaAfrProject): FreeRTOS code resource.
         _otaAwsAgent(obj:OtaAwsAgent): Interface to AWS CLI resource.
         _otaTestCases(list(obj:OtaTestCase)): All of the OTA test cases in this run.
+        _prebuildJobs(int): The number of OTA images pre-built at once.
+        _workspaceDir(str): The directory holding the git worktrees the OTA images are pre-built in.
     Methods:
         runTests(): Run all of the tests found in the boardConfig during initialization.
+        __prebuildOtaImages(): Build the OTA images of all of the tests before running them.
         __initializeOtaProject(): Initialize _otaProject resource for testing.
         __getOtaTestCases(_otaConfig): Get all of the tests supported by the input board.
         __runTest(otaTestCase): Run a single test case.
@@ -53,7 +59,7 @@ class OtaTestRunner:
         testRunner = OtaTestRunner(boardConfig)
         testRunner.runTests()
     """
-    def __init__(self, boardConfig, stageParams):
+    def __init__(self, boardConfig, stageParams, prebuildJobs=0, workspaceDir='board_workspaces'):
         # Override AWS credentials if provided in config.
         if boardConfig.get('aws_access_id'):
             os.environ['AWS_ACCESS_KEY_ID'] = boardConfig['aws_access_id']
@@ -64,6 +70,8 @@ class OtaTestRunner:
 
         self._boardConfig = boardConfig
         self._stageParams = stageParams
+        self._prebuildJobs = prebuildJobs
+        self._workspaceDir = workspaceDir
         self._otaConfig = boardConfig['ota_config']
         self._otaProject = OtaAfrProject(boardConfig)
         # OTA jobs only accept underscore and no dots. We replace dots with underscores for all IoT Core related names.
@@ -111,12 +119,23 @@ class OtaTestRunner:
         testResult.board = self._boardConfig['name']
         return testResult
 
+    def __prebuildOtaImages(self):
+        """Build the OTA images of all of the tests into the build cache, so that the tests only
+        flash and update the board. The tests build any image that fails to pre-build.
+        """
+        try:
+            OtaImagePlanner(self._boardConfig, self._workspaceDir, self._prebuildJobs).prebuild(self._otaTestCases)
+        except Exception:
+            print(traceback.format_exc())
+
     def runTests(self):
         """Run all tests this Test Runner object holds.
         Returns the results of the tests.
         """
         try:
             testResults = []
+            if self._prebuildJobs > 0:
+                self.__prebuildOtaImages()
             for otaTestCase in self._otaTestCases:
                 testResults.append(self.__runTest(otaTestCase))
         finally:
@@ -0,0 +1,207 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import json
+import time
+from threading import Lock
+
+# The phases of an OTA test case, each timed from a mark named start to the next mark named end
+# after it. A phase repeated, e.g. by a test creating many OTA updates, adds up. The marks come from
+# the test harness and from the device output, see OtaTestCase.timingSerialPatterns.
+OTA_TEST_PHASES = [
+    # (phase, start mark, end mark)
+    ('build', 'setup_start', 'build_done'),
+    ('flash', 'build_done', 'flash_done'),
+    # Builds done by the test itself, uploads, signing and the creation of the OTA update.
+    ('job_creation', 'run_start', 'job_created'),
+    ('first_block', 'job_accepted', 'first_block'),
+    ('download', 'first_block', 'download_complete'),
+    # Activation of the new image, including the reset and the reconnection of the device.
+    ('activation', 'download_complete', 'self_test'),
+    ('self_test', 'self_test', 'job_terminal'),
+    ('job_wait', 'job_created', 'job_terminal'),
+    ('teardown', 'teardown_start', 'test_end'),
+    ('total', 'test_start', 'test_end')
+]
+
+def phaseSpans(marks):
+    """Get the (phase, start, end) spans of OTA_TEST_PHASES found in a list of (name, time) marks.
+    Each mark named start begins a span ending at the next mark named end, unless it is within the
+    previous span of the phase.
+    """
+    spans = []
+    for phase, startName, endName in OTA_TEST_PHASES:
+        phaseEnd = None
+        for name, startTime in marks:
+            if name != startName or (phaseEnd is not None and startTime < phaseEnd):
+                continue
+            phaseEnd = next((t for n, t in marks if n == endName and t >= startTime), None)
+            if phaseEnd is None:
+                break
+            spans.append((phase, startTime, phaseEnd))
+    return spans
+
+class OtaTestTimer:
+    """The timeline of an OTA test case: named marks at monotonic times, from the test harness or
+    from the device output, and counters and metadata describing the test.
+
+    Marks may be added from any thread, e.g. by the callbacks of the serial pattern matcher.
+
+    Attributes:
+        _startWallTime(float): The wall clock time the timer was created at, to place the marks of
+            tests run in many processes on one timeline.
+        _start(float): The monotonic time the timer was created at.
+        _marks(list): (name, seconds since the start, source) of each mark in order.
+        _counters(dict): Counts by name, e.g. the number of blocks received.
+        _metadata(dict): Values describing the test, e.g. its protocol.
+    Methods:
+        mark(name, source)
+        markOnceAfter(name, after, source)
+        count(name, increment)
+        setMetadata(key, value)
+        getPhases()
+        toDict()
+    Example:
+        timer = OtaTestTimer()
+        timer.mark('setup_start')
+        timer.mark('build_done')
+        print(timer.getPhases()['build'])
+    """
+    def __init__(self):
+        self._startWallTime = time.time()
+        self._start = time.monotonic()
+        self._marks = []
+        self._counters = {}
+        self._metadata = {}
+        self._lock = Lock()
+
+    def mark(self, name, source='harness'):
+        """Mark that the event name happened now.
+        """
+        with self._lock:
+            self._marks.append((name, time.monotonic() - self._start, source))
+
+    def markOnceAfter(self, name, after, source='harness'):
+        """Mark name only for its first occurrence after each mark named after, e.g. the first block
+        received after each job accepted.
+        """
+        with self._lock:
+            for markName, _, _ in reversed(self._marks):
+                if markName == name:
+                    return
+                if markName == after:
+                    self._marks.append((name, time.monotonic() - self._start, source))
+                    return
+
+    def count(self, name, increment=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+    def setMetadata(self, key, value):
+        with self._lock:
+            self._metadata[key] = value
+
+    def getPhases(self):
+        """Get the duration in seconds of each phase of OTA_TEST_PHASES with marks, in order.
+        """
+        with self._lock:
+            marks = [(name, t) for name, t, _ in self._marks]
+        phases = {}
+        for phase, startTime, endTime in phaseSpans(marks):
+            phases[phase] = phases.get(phase, 0) + endTime - startTime
+        return phases
+
+    def toDict(self):
+        """Get the timeline as plain data, which can be pickled and written to JSON.
+        """
+        phases = self.getPhases()
+        with self._lock:
+            return {
+                'start': self._startWallTime,
+                'marks': [{'name': name, 'time': t, 'source': source} for name, t, source in self._marks],
+                'phases': phases,
+                'counters': dict(self._counters),
+                'metadata': dict(self._metadata)
+            }
+
+def formatPhases(timing):
+    """Format the phases of the timing of a test, as returned by OtaTestTimer.toDict(), one per line.
+    """
+    lines = [f'{phase}: {duration:.1f} s' for phase, duration in timing['phases'].items()]
+    throughput = timing['metadata'].get('download_bytes_per_sec')
+    if throughput:
+        lines.append(f'download throughput: {throughput:.0f} B/s')
+    return '\n'.join(lines)
+
+def writeTimingTrace(boardToResults, fileName):
+    """Write the timing of all of the tests to a JSON file.
+    The file holds the phases of each test under 'otaTests', and the phases and marks as Chrome trace
+    events under 'traceEvents', which chrome://tracing and https://ui.perfetto.dev display as one
+    timeline with a row per board.
+    Args:
+        boardToResults(dict[str:list(obj:OtaTestResult)]): Dictionary of the board name to its results.
+        fileName(str): The name of the JSON file to write.
+    """
+    otaTests = []
+    traceEvents = []
+    for board, otaTestResults in boardToResults.items():
+        traceEvents.append({'name': 'process_name', 'ph': 'M', 'pid': board, 'args': {'name': board}})
+        for otaTestResult in otaTestResults:
+            timing = otaTestResult.timing
+            if not timing:
+                continue
+            otaTests.append({
+                'board': board,
+                'test': otaTestResult.testName,
+                'result': otaTestResult.result,
+                'phases': timing['phases'],
+                'counters': timing['counters'],
+                'metadata': timing['metadata']
+            })
+            toMicroseconds = lambda t: int((timing['start'] + t) * 1e6)
+            for phase, startTime, endTime in phaseSpans([(mark['name'], mark['time']) for mark in timing['marks']]):
+                traceEvents.append({
+                    'name': phase,
+                    'cat': otaTestResult.testName,
+                    'ph': 'X',
+                    'ts': toMicroseconds(startTime),
+                    'dur': toMicroseconds(endTime) - toMicroseconds(startTime),
+                    'pid': board,
+                    'tid': 'phases',
+                    'args': dict(timing['metadata'], test=otaTestResult.testName)
+                })
+            for mark in timing['marks']:
+                traceEvents.append({
+                    'name': mark['name'],
+                    'cat': otaTestResult.testName,
+                    'ph': 'i',
+                    's': 't',
+                    'ts': toMicroseconds(mark['time']),
+                    'pid': board,
+                    'tid': mark['source']
+                })
+
+    with open(fileName, 'w') as f:
+        json.dump({'otaTests': otaTests, 'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}, f, indent=1)
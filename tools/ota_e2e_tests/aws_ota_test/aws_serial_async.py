@@ -0,0 +1,329 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import os
+import sys
+import codecs
+import asyncio
+import serial
+from threading import Thread, Lock
+from .aws_serial_log import SerialLogBuffer
+from .aws_serial_matcher import SerialPatternMatcher
+
+class AsyncSerialHub:
+    """One asyncio event loop, in a thread of its own, reading the serial ports of many boards.
+
+    Each port is read only when its data is ready, so the boards of a whole rack can be watched from
+    a single thread. On platforms where the event loop can not wait on a serial port, e.g. Windows,
+    the reads of a port block in the default executor instead.
+
+    Attributes:
+        _loop(obj:asyncio.AbstractEventLoop): The event loop reading the ports.
+        _thread(obj:Thread): The thread running _loop.
+    Methods:
+        openPort(port, baudrate, timeout, logBuffer, echo)
+        call(coroutine)
+        callSoon(callback, *args)
+        close()
+    Example:
+        hub = getSerialHub()
+        serialPort = hub.openPort('/dev/ttyUSB0', 115200, 30)
+        serialPort.startRead()
+        # Do some other stuff.
+        log = serialPort.getLog()
+        serialPort.close()
+    """
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self.__run, name='AsyncSerialHub', daemon=True)
+        self._thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def call(self, coroutine):
+        """Run a coroutine on the event loop from another thread and return its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def callSoon(self, callback, *args):
+        """Call a function on the event loop from another thread, without waiting for it.
+        """
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def openPort(self, port, baudrate, timeout, logBuffer=None, echo=True):
+        """Create the reader of a serial port. The port is opened by AsyncSerialPort.startRead().
+        """
+        return AsyncSerialPort(self, port, baudrate, timeout, logBuffer, echo)
+
+    def close(self):
+        """Stop the event loop. The ports must be closed first.
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+_serialHub = None
+_serialHubLock = Lock()
+
+def getSerialHub():
+    """Get the AsyncSerialHub shared by all of the boards of this process.
+    """
+    global _serialHub
+    with _serialHubLock:
+        if _serialHub is None:
+            _serialHub = AsyncSerialHub()
+        return _serialHub
+
+
+class AsyncSerialPort:
+    """The serial port of a board, read by an AsyncSerialHub.
+
+    This has the same methods as ReadSerialThread, so FlashSerialComm can use either. startRead()
+    and stopRead() wake the reading coroutine through asyncio events, so the port is opened and let
+    go of as soon as they are called. Subscribers get each batch of complete lines read, on the
+    event loop thread.
+
+    Attributes:
+        _hub(obj:AsyncSerialHub): The hub reading the port.
+        _port (str): The serial communication port, 'COMx' in Windows and '/dev/xxx' in Unix.
+        _baudrate (int): The bps of the serial port.
+        _timeout (int): Timeout in seconds on the blocking reads of the executor fallback.
+        _logBuffer (SerialLogBuffer): The serial output in the last run.
+        _matcher (SerialPatternMatcher): Matches the lines read against the registered patterns.
+        _subscribers (dict): The token of each subscriber to its callback.
+    Methods:
+        start()
+        startRead()
+        stopRead()
+        subscribe(callback)
+        unsubscribe(token)
+        getLog()
+        getLogBuffer()
+        getMatcher()
+        clearLog()
+        close()
+        join()
+    """
+    # Read at most this many bytes at once in the executor fallback.
+    READ_SIZE = 65536
+
+    def __init__(self, hub, port, baudrate, timeout, logBuffer=None, echo=True):
+        self._hub = hub
+        self._port = port
+        self._baudrate = baudrate
+        self._timeout = timeout
+        self._logBuffer = logBuffer if logBuffer else SerialLogBuffer()
+        self._echo = echo
+        self._matcher = SerialPatternMatcher()
+        self._subscribers = {}
+        self._nextToken = 0
+        self._closed = False
+        # The lines after this cursor are not handed to the subscribers yet.
+        self._cursor = 0
+        self._decoder = None
+        self._task = hub.call(self.__create())
+
+    async def __create(self):
+        # The events belong to the loop they are created on.
+        self._startEvent = asyncio.Event()
+        self._stopEvent = asyncio.Event()
+        return asyncio.ensure_future(self.__run())
+
+    def start(self):
+        """The port is read by the hub's thread, there is no thread of its own to start.
+        """
+        pass
+
+    def startRead(self):
+        """Open the serial port and begin reading.
+        """
+        self._hub.callSoon(self.__startRead)
+
+    def __startRead(self):
+        self._stopEvent.clear()
+        self._startEvent.set()
+
+    def stopRead(self):
+        """Stop reading and let go of the serial port.
+        """
+        self._hub.callSoon(self._stopEvent.set)
+
+    def subscribe(self, callback):
+        """Call callback(lines) with each batch of complete lines read, from the event loop thread.
+        Returns the token to unsubscribe with.
+        """
+        token = self._nextToken
+        self._nextToken += 1
+        self._subscribers[token] = callback
+        return token
+
+    def unsubscribe(self, token):
+        self._subscribers.pop(token, None)
+
+    def getLog(self):
+        return self._logBuffer.getText()
+
+    def getLogBuffer(self):
+        return self._logBuffer
+
+    def getMatcher(self):
+        return self._matcher
+
+    def clearLog(self):
+        self._logBuffer.clear()
+
+    async def __run(self):
+        while not self._closed:
+            await self._startEvent.wait()
+            self._startEvent.clear()
+            if self._closed:
+                break
+            try:
+                serialPort = serial.Serial(port=self._port, baudrate=self._baudrate, timeout=0)
+            except Exception as e:
+                print(f'Could not open the serial port {self._port}: {e}')
+                continue
+            self._cursor = self._logBuffer.getEnd()
+            self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            try:
+                if not self.__addReader(serialPort):
+                    await self.__readInExecutor(serialPort)
+                await self._stopEvent.wait()
+            finally:
+                self.__removeReader(serialPort)
+                serialPort.close()
+
+    def __addReader(self, serialPort):
+        """Read the port whenever it has data. Returns False if the event loop can not wait on it.
+        """
+        if not hasattr(serialPort, 'fileno'):
+            return False
+        try:
+            asyncio.get_event_loop().add_reader(serialPort.fileno(), self.__onReadable, serialPort)
+        except (NotImplementedError, OSError, ValueError):
+            return False
+        return True
+
+    def __removeReader(self, serialPort):
+        if hasattr(serialPort, 'fileno'):
+            try:
+                asyncio.get_event_loop().remove_reader(serialPort.fileno())
+            except (NotImplementedError, OSError, ValueError):
+                pass
+
+    def __onReadable(self, serialPort):
+        try:
+            data = serialPort.read(max(1, serialPort.in_waiting))
+        except Exception as e:
+            # All exceptions stop the read, like in ReadSerialThread.
+            print(f'Stopped reading the serial port {self._port}: {e}')
+            self.__removeReader(serialPort)
+            self._stopEvent.set()
+            return
+        if data:
+            self.__onData(data)
+
+    async def __readInExecutor(self, serialPort):
+        """Read the port with blocking reads in the default executor until the read is stopped.
+        """
+        serialPort.timeout = self._timeout
+        loop = asyncio.get_event_loop()
+        while not self._stopEvent.is_set():
+            try:
+                data = await loop.run_in_executor(None, serialPort.read, AsyncSerialPort.READ_SIZE)
+            except Exception as e:
+                print(f'Stopped reading the serial port {self._port}: {e}')
+                self._stopEvent.set()
+                return
+            if data:
+                self.__onData(data)
+
+    def __onData(self, data):
+        self._logBuffer.append(data)
+        if self._echo:
+            sys.stdout.write(self._decoder.decode(data))
+        if not (self._subscribers or self._matcher.hasPatterns()):
+            # Lines are only handed to the subscribers and patterns there when they were read.
+            self._cursor = self._logBuffer.getEnd()
+            return
+        lines, self._cursor = self._logBuffer.readLinesSince(self._cursor)
+        if not lines:
+            return
+        self._matcher.feed(lines)
+        for callback in list(self._subscribers.values()):
+            callback(lines)
+
+    def close(self):
+        """Stop the read and free the resources. Once closed, the port can not be read again.
+        """
+        self._closed = True
+        self._hub.callSoon(self._stopEvent.set)
+        self._hub.callSoon(self._startEvent.set)
+        self._logBuffer.close()
+
+    def join(self):
+        """Wait for the reading coroutine to let go of the serial port after close().
+        """
+        self._hub.call(asyncio.wait([self._task]))
+
+
+class PtySerialStandIn:
+    """A pseudo terminal standing in for the serial port of a board, POSIX only.
+
+    Set the board's "serial_port" to port, then write() what the board would print. This runs the
+    serial reading, the log capture and the pattern matching without a board.
+
+    Attributes:
+        port(str): The path of the terminal to read as the serial port.
+    Methods:
+        write(data)
+        close()
+    Example:
+        standIn = PtySerialStandIn()
+        serialPort = getSerialHub().openPort(standIn.port, 115200, 1)
+        serialPort.startRead()
+        standIn.write('[OTA_AgentTask] Received: 1 bytes\\r\\n')
+        standIn.close()
+    """
+    def __init__(self):
+        import pty
+        import tty
+        self._master, self._slave = pty.openpty()
+        # Pass the bytes written through unchanged, as a UART would.
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    def write(self, data):
+        """Write what the board prints, as str or bytes.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        os.write(self._master, data)
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
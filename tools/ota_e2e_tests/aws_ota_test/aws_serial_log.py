@@ -0,0 +1,231 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import os
+import shutil
+import tempfile
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+class SerialLogBuffer:
+    """A bounded log of the output of a board.
+
+    The latest capacity bytes are kept in a ring buffer allocated once. Older bytes are spilled to
+    files in a directory of their own, rotated once a file holds spillFileBytes, and dropped once
+    there are more than spillFiles files. The output is kept as bytes and only decoded when it is
+    read as text.
+
+    Positions in the log are cursors: the number of bytes appended before the position since the
+    buffer was created. Cursors stay valid across clear(). Reading from a cursor older than the
+    bytes held starts from the oldest byte held.
+
+    The buffer is written by one thread and can be read from any thread.
+
+    Attributes:
+        _buffer(bytearray): The ring buffer.
+        _start(int): The cursor of the oldest byte in the ring buffer.
+        _end(int): The cursor after the newest byte.
+        _lineEnds(list(int)): The cursors after each newline in the ring buffer, in order.
+        _spillDir(str): The directory of the spill files, created on the first spill.
+        _spillFiles(list(str)): The spill files of the current log, oldest first.
+    Methods:
+        append(data)
+        clear()
+        size()
+        getEnd()
+        readSince(cursor)
+        readTextSince(cursor)
+        readLinesSince(cursor)
+        getText()
+        writeTo(outFile)
+        close()
+    Example:
+        logBuffer = SerialLogBuffer(1024 * 1024)
+        logBuffer.append(b'[OTA_AgentTask] Received: 1 bytes\\r\\n')
+        lines, cursor = logBuffer.readLinesSince(0)
+        logBuffer.close()
+    """
+    SPILL_FILE_NAME = 'serial.log'
+
+    def __init__(self, capacity=4 * 1024 * 1024, spillDir=None, spillFileBytes=64 * 1024 * 1024, spillFiles=3):
+        self._capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._start = 0
+        self._end = 0
+        self._lineEnds = []
+        self._textCache = (0, 0, '')
+        self._spillParentDir = spillDir
+        self._spillFileBytes = spillFileBytes
+        self._maxSpillFiles = spillFiles
+        self._spillDir = None
+        self._spillFiles = []
+        self._spillFile = None
+        self._spillCount = 0
+        self._lock = Lock()
+
+    def __copy(self, begin, end):
+        """Copy the bytes between two cursors held in the ring buffer.
+        """
+        view = memoryview(self._buffer)
+        first = begin % self._capacity
+        last = first + end - begin
+        if last <= self._capacity:
+            return bytes(view[first:last])
+        return bytes(view[first:]) + bytes(view[:last - self._capacity])
+
+    def __spill(self, data):
+        """Write bytes dropped from the ring buffer to the current spill file.
+        """
+        if self._maxSpillFiles <= 0:
+            return
+        if self._spillFile is None:
+            if self._spillDir is None:
+                if self._spillParentDir:
+                    os.makedirs(self._spillParentDir, exist_ok=True)
+                self._spillDir = tempfile.mkdtemp(prefix='serial_log_', dir=self._spillParentDir)
+            path = os.path.join(self._spillDir, '{}.{}'.format(SerialLogBuffer.SPILL_FILE_NAME, self._spillCount))
+            self._spillCount += 1
+            self._spillFile = open(path, 'wb')
+            self._spillFiles.append(path)
+        self._spillFile.write(data)
+        if self._spillFile.tell() >= self._spillFileBytes:
+            # Rotate, dropping the oldest file once there are too many.
+            self._spillFile.close()
+            self._spillFile = None
+            while len(self._spillFiles) >= self._maxSpillFiles:
+                os.remove(self._spillFiles.pop(0))
+
+    def append(self, data):
+        """Append bytes read from the board.
+        """
+        with self._lock:
+            if len(data) > self._capacity:
+                # Only the tail of the data fits, the rest goes straight to the spill file.
+                self.__spill(self.__copy(self._start, self._end))
+                self.__spill(data[:len(data) - self._capacity])
+                self._start = self._end = self._end + len(data) - self._capacity
+                data = data[len(data) - self._capacity:]
+            overflow = self._end + len(data) - self._start - self._capacity
+            if overflow > 0:
+                self.__spill(self.__copy(self._start, self._start + overflow))
+                self._start += overflow
+
+            view = memoryview(data)
+            first = self._end % self._capacity
+            count = min(len(data), self._capacity - first)
+            self._buffer[first:first + count] = view[:count]
+            self._buffer[:len(data) - count] = view[count:]
+
+            offset = data.find(b'\n')
+            while offset >= 0:
+                self._lineEnds.append(self._end + offset + 1)
+                offset = data.find(b'\n', offset + 1)
+            self._end += len(data)
+
+            # Forget the lines dropped from the ring buffer, a batch at a time.
+            dropped = bisect_left(self._lineEnds, self._start + 1)
+            if dropped > 1024 and dropped * 2 > len(self._lineEnds):
+                del self._lineEnds[:dropped]
+
+    def clear(self):
+        """Drop the log, keeping the cursors valid.
+        """
+        with self._lock:
+            self._start = self._end
+            self._lineEnds = []
+            if self._spillFile:
+                self._spillFile.close()
+                self._spillFile = None
+            for path in self._spillFiles:
+                os.remove(path)
+            self._spillFiles = []
+
+    def size(self):
+        """The number of bytes in the ring buffer.
+        """
+        return self._end - self._start
+
+    def getEnd(self):
+        """The cursor after the newest byte, to read what is appended from now on.
+        """
+        return self._end
+
+    def readSince(self, cursor):
+        """Read the bytes appended since a cursor.
+        Returns the bytes and the cursor to read the next bytes from.
+        """
+        with self._lock:
+            begin = max(cursor, self._start)
+            return self.__copy(begin, self._end) if begin < self._end else b'', self._end
+
+    def readTextSince(self, cursor):
+        """Read the text appended since a cursor.
+        Returns the text and the cursor to read the next text from.
+        """
+        data, cursor = self.readSince(cursor)
+        return data.decode(errors='replace'), cursor
+
+    def readLinesSince(self, cursor):
+        """Read the complete lines appended since a cursor. A line still being written is left for
+        the next read.
+        Returns the list of lines, with their line endings, and the cursor to read the next lines from.
+        """
+        with self._lock:
+            begin = max(cursor, self._start)
+            index = bisect_right(self._lineEnds, begin)
+            if index == len(self._lineEnds):
+                return [], max(cursor, begin)
+            end = self._lineEnds[-1]
+            data = self.__copy(begin, end)
+        return data.decode(errors='replace').splitlines(True), end
+
+    def getText(self):
+        """Get the text in the ring buffer. The text is decoded when it changed since the last call.
+        """
+        with self._lock:
+            start, end, text = self._textCache
+            if (start, end) != (self._start, self._end):
+                text = self.__copy(self._start, self._end).decode(errors='replace')
+                self._textCache = (self._start, self._end, text)
+            return text
+
+    def writeTo(self, outFile):
+        """Write the log, the spilled bytes then the ring buffer, to a file open in binary mode.
+        """
+        with self._lock:
+            if self._spillFile:
+                self._spillFile.flush()
+            for path in self._spillFiles:
+                with open(path, 'rb') as spillFile:
+                    shutil.copyfileobj(spillFile, outFile)
+            outFile.write(self.__copy(self._start, self._end))
+
+    def close(self):
+        """Free the spill files. Once closed, only the ring buffer can be read.
+        """
+        self.clear()
+        if self._spillDir:
+            shutil.rmtree(self._spillDir, ignore_errors=True)
+            self._spillDir = None
@@ -0,0 +1,105 @@
+"""
+FreeRTOS
+Copyright (C) 2020 Amazon.com, Inc. or its affiliates.  All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+http://aws.amazon.com/freertos
+http://www.FreeRTOS.org
+
+"""
+import re
+import traceback
+from threading import Lock
+
+class SerialPatternMatcher:
+    """Match the lines of the output of a board against many regular expressions as they are read.
+
+    The patterns are also compiled into one alternation, which rejects most lines with a single
+    search. Only the lines it matches are searched for each pattern. The callback of each pattern
+    found in a line is called with the re.Match, from the thread reading the output.
+
+    Attributes:
+        _patterns(dict): The token of each pattern to its compiled pattern and callback.
+        _anyPattern(obj:re.Pattern): The alternation of all of the patterns, None to search each.
+    Methods:
+        addPattern(pattern, callback)
+        removePattern(token)
+        hasPatterns()
+        feed(lines)
+    Example:
+        matcher = SerialPatternMatcher()
+        token = matcher.addPattern(r'Failed to pass \\S+ signature verification', lambda match: print(match.string))
+        matcher.feed(['[prvPAL_CheckFileSignature] ERROR - Failed to pass sig-sha256-ecdsa signature verification: 0.\\r\\n'])
+        matcher.removePattern(token)
+    """
+    def __init__(self):
+        self._patterns = {}
+        self._anyPattern = None
+        self._nextToken = 0
+        self._lock = Lock()
+
+    def __compileAnyPattern(self):
+        try:
+            self._anyPattern = re.compile('|'.join('(?:{})'.format(regex.pattern) for regex, _ in self._patterns.values()))
+        except re.error:
+            # e.g. the same group name in two patterns.
+            self._anyPattern = None
+
+    def addPattern(self, pattern, callback):
+        """Call callback(match) for each line read that matches the regular expression pattern.
+        Returns the token to remove the pattern with.
+        """
+        regex = re.compile(pattern)
+        with self._lock:
+            token = self._nextToken
+            self._nextToken += 1
+            self._patterns[token] = (regex, callback)
+            self.__compileAnyPattern()
+        return token
+
+    def removePattern(self, token):
+        """Stop matching the pattern added with the token.
+        """
+        with self._lock:
+            if self._patterns.pop(token, None):
+                self.__compileAnyPattern()
+
+    def hasPatterns(self):
+        return bool(self._patterns)
+
+    def feed(self, lines):
+        """Match lines of the output against the patterns.
+        """
+        with self._lock:
+            patterns = list(self._patterns.values())
+            anyPattern = self._anyPattern
+        if not patterns:
+            return
+        for line in lines:
+            if anyPattern and not anyPattern.search(line):
+                continue
+            for regex, callback in patterns:
+                match = regex.search(line)
+                if not match:
+                    continue
+                try:
+                    callback(match)
+                except Exception:
+                    # Keep reading the output whatever the callback does.
+                    print(traceback.format_exc())
@@ -0,0 +1,175 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Intel HEX codec
+
+Reads and writes Intel HEX files a record at a time rather than a byte at a
+time: the records of a file are decoded with a single unhexlify, and the
+data records are coalesced into contiguous segments.  The files written are
+the same as the ones written by the intelhex package.
+"""
+
+import binascii
+
+DATA_RECORD = 0
+EOF_RECORD = 1
+EXT_SEGMENT_ADDR_RECORD = 2
+START_SEGMENT_ADDR_RECORD = 3
+EXT_LINEAR_ADDR_RECORD = 4
+START_LINEAR_ADDR_RECORD = 5
+
+RECORD_BYTE_COUNT = 16
+
+
+class HexFileError(Exception):
+    """Raised when an Intel HEX file is malformed."""
+    pass
+
+
+def read_segments(path):
+    """
+    Read an Intel HEX file.  Returns the (address, data) segments of the file,
+    sorted by address, with the contiguous data records of the file joined.
+    """
+    with open(path, 'r') as f:
+        lines = f.read().split()
+    for lineno, line in enumerate(lines, 1):
+        if line[:1] != ':' or len(line) % 2 == 0 or len(line) < 11:
+            raise HexFileError("{}:{}: invalid record".format(path, lineno))
+    try:
+        raw = binascii.unhexlify(''.join(line[1:] for line in lines))
+    except (binascii.Error, ValueError):
+        raise HexFileError("{}: invalid hexadecimal digits".format(path))
+
+    segments = []
+    data = None
+    end = None
+    offset = 0
+    pos = 0
+    for lineno, line in enumerate(lines, 1):
+        size = (len(line) - 1) // 2
+        record = raw[pos:pos + size]
+        pos += size
+        length, addr_hi, addr_lo, rectype = record[:4]
+        if size != 5 + length:
+            raise HexFileError("{}:{}: invalid record length".format(
+                path, lineno))
+        if sum(record) & 0xff:
+            raise HexFileError("{}:{}: invalid checksum".format(path, lineno))
+        addr = (addr_hi << 8) | addr_lo
+        if rectype == DATA_RECORD:
+            addr += offset
+            if addr != end:
+                data = bytearray()
+                segments.append((addr, data))
+            data += record[4:-1]
+            end = addr + length
+        elif rectype == EOF_RECORD:
+            break
+        elif rectype in (EXT_SEGMENT_ADDR_RECORD, EXT_LINEAR_ADDR_RECORD):
+            if length != 2 or addr != 0:
+                raise HexFileError("{}:{}: invalid address record".format(
+                    path, lineno))
+            shift = 4 if rectype == EXT_SEGMENT_ADDR_RECORD else 16
+            offset = ((record[4] << 8) | record[5]) << shift
+        elif rectype in (START_SEGMENT_ADDR_RECORD, START_LINEAR_ADDR_RECORD):
+            # The start address doesn't matter to an MCUboot image
+            if length != 4 or addr != 0:
+                raise HexFileError("{}:{}: invalid start address "
+                                   "record".format(path, lineno))
+        else:
+            raise HexFileError("{}:{}: invalid record type {}".format(
+                path, lineno, rectype))
+    return coalesce(segments)
+
+
+def coalesce(segments):
+    """
+    Sort (address, data) segments, and join the ones that are contiguous
+    into new bytearrays, leaving the data of the segments unchanged.  Raises
+    HexFileError if two segments overlap.
+    """
+    joined = []
+    copied = False
+    for addr, data in sorted(segments, key=lambda segment: segment[0]):
+        if not data:
+            continue
+        if joined:
+            last_addr, last_data = joined[-1]
+            last_end = last_addr + len(last_data)
+            if addr < last_end:
+                raise HexFileError(
+                    "Data overlapping at address 0x{:x}".format(addr))
+            if addr == last_end:
+                if not copied:
+                    last_data = bytearray(last_data)
+                    joined[-1] = (last_addr, last_data)
+                    copied = True
+                last_data += data
+                continue
+        joined.append((addr, data))
+        copied = False
+    return joined
+
+
+def load(path, padding=0xff):
+    """
+    Load an Intel HEX file as a binary.  Returns the lowest address of the
+    file, or None if it has no data, and a bytearray of its data from that
+    address, with the gaps between segments filled with padding.
+    """
+    segments = read_segments(path)
+    if not segments:
+        return None, bytearray()
+    base_addr = segments[0][0]
+    last_addr, last_data = segments[-1]
+    if len(segments) == 1:
+        return base_addr, last_data
+    binary = bytearray([padding]) * (last_addr + len(last_data) - base_addr)
+    for addr, data in segments:
+        binary[addr - base_addr:addr - base_addr + len(data)] = data
+    return base_addr, binary
+
+
+def save(path, segments, byte_count=RECORD_BYTE_COUNT):
+    """
+    Save (address, data) segments as an Intel HEX file.  Segments that are
+    contiguous are written as one, and each record holds up to byte_count
+    bytes, without crossing a 64 KiB boundary.
+    """
+    segments = coalesce(segments)
+    lines = []
+    # Like the intelhex package, only write extended linear address records
+    # when an address doesn't fit in 16 bits.
+    need_ext_addr = bool(segments) and \
+        segments[-1][0] + len(segments[-1][1]) - 1 > 0xffff
+    high = None
+    for addr, data in segments:
+        hexdata = binascii.hexlify(data).upper().decode('ascii')
+        off = 0
+        while off < len(data):
+            cur = addr + off
+            if need_ext_addr and cur >> 16 != high:
+                high = cur >> 16
+                lines.append(':02000004{:04X}{:02X}\n'.format(
+                    high, -(6 + (high >> 8) + (high & 0xff)) & 0xff))
+            low = cur & 0xffff
+            n = min(byte_count, 0x10000 - low, len(data) - off)
+            checksum = -(n + (low >> 8) + (low & 0xff) +
+                         sum(data[off:off + n])) & 0xff
+            lines.append(':{:02X}{:04X}00{}{:02X}\n'.format(
+                n, low, hexdata[2 * off:2 * (off + n)], checksum))
+            off += n
+    lines.append(':00000001FF\n')
+    with open(path, 'w') as f:
+        f.writelines(lines)
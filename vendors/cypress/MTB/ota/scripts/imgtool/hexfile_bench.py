@@ -0,0 +1,79 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of imgtool.hexfile against the intelhex package
+
+Times loading and saving an Intel HEX file of random data, the way
+Image.load and Image.save do, with both codecs:
+
+    python -m imgtool.hexfile_bench --size 1024
+"""
+
+import os
+import tempfile
+import time
+
+import click
+from intelhex import IntelHex
+
+from imgtool import hexfile
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.option('-r', '--repeat', type=int, default=3, show_default=True,
+              help='Keep the best time of this many runs')
+@click.option('-a', '--address', type=int, default=0x10000000,
+              show_default=True, help='Address of the data')
+@click.option('-s', '--size', type=int, default=512, show_default=True,
+              help='Size of the data in KiB')
+@click.command(help='Compare the Intel HEX codecs of imgtool')
+def bench(size, address, repeat):
+    data = os.urandom(size * 1024)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.hex')
+        hexfile.save(path, [(address, data)])
+
+        def intelhex_load():
+            ih = IntelHex(path)
+            return ih.minaddr(), ih.tobinarray()
+
+        def intelhex_save():
+            h = IntelHex()
+            h.frombytes(bytes=data, offset=address)
+            h.tofile(path, 'hex')
+
+        runs = [
+            ('load', intelhex_load, lambda: hexfile.load(path)),
+            ('save', intelhex_save, lambda: hexfile.save(path, [(address, data)])),
+        ]
+        print("{} KiB at 0x{:x}, {} bytes of HEX".format(
+            size, address, os.path.getsize(path)))
+        print("{:6} {:>12} {:>12} {:>8}".format(
+            '', 'intelhex', 'hexfile', 'speedup'))
+        for name, slow, fast in runs:
+            slow_time = best_time(slow, repeat)
+            fast_time = best_time(fast, repeat)
+            print("{:6} {:>11.3f}s {:>11.3f}s {:>7.1f}x".format(
+                name, slow_time, fast_time, slow_time / fast_time))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,119 @@
+"""
+Tests for the Intel HEX codec
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+from intelhex import IntelHex
+
+# Setup sys path so 'imgtool' is in it.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from imgtool import hexfile
+from imgtool.image import Image
+from imgtool.version import decode_version
+
+
+class HexFile(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.random = random.Random(0x96f3b83d)
+
+    def tname(self, base):
+        return os.path.join(self.test_dir.name, base)
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def data(self, size):
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def layouts(self):
+        return [
+            [(0x100, self.data(100))],
+            [(0x0000fff5, self.data(40))],
+            [(0x10000000, self.data(0x12345))],
+            [(0x10000003, self.data(33)), (0x10000030, self.data(7)),
+             (0x1001fffe, self.data(5))],
+            # Contiguous segments are written as one
+            [(0x8000, self.data(10)), (0x800a, self.data(20))],
+        ]
+
+    def intelhex_file(self, segments, name):
+        h = IntelHex()
+        for addr, data in segments:
+            h.frombytes(bytes=data, offset=addr)
+        h.tofile(self.tname(name), 'hex')
+        return h
+
+    def test_save(self):
+        """Files are the same as the ones of the intelhex package"""
+        for i, segments in enumerate(self.layouts()):
+            self.intelhex_file(segments, 'expected.hex')
+            hexfile.save(self.tname('actual.hex'), segments)
+            with open(self.tname('expected.hex')) as f:
+                expected = f.read()
+            with open(self.tname('actual.hex')) as f:
+                self.assertEqual(f.read(), expected, "layout {}".format(i))
+
+    def test_load(self):
+        for i, segments in enumerate(self.layouts()):
+            h = self.intelhex_file(segments, 'test.hex')
+            h.start_addr = {'EIP': 0x10000001}
+            h.tofile(self.tname('test.hex'), 'hex')
+            base_addr, binary = hexfile.load(self.tname('test.hex'))
+            self.assertEqual(base_addr, h.minaddr(), "layout {}".format(i))
+            self.assertEqual(bytes(binary), h.tobinstr(),
+                             "layout {}".format(i))
+
+    def test_segment_address(self):
+        with open(self.tname('test.hex'), 'w') as f:
+            f.write(':020000021000EC\n'
+                    ':0400100001020304E2\n'
+                    ':00000001FF\n')
+        self.assertEqual(hexfile.read_segments(self.tname('test.hex')),
+                         [(0x10010, bytearray(b'\x01\x02\x03\x04'))])
+
+    def test_errors(self):
+        bad = [
+            # Checksum
+            ':0400100001020304E3\n',
+            # Record length
+            ':0500100001020304E2\n',
+            # Hexadecimal digits
+            ':04001000010203G4E2\n',
+            # Overlapping data
+            ':0400100001020304E2\n:0400120001020304E0\n',
+        ]
+        for records in bad:
+            with open(self.tname('bad.hex'), 'w') as f:
+                f.write(records + ':00000001FF\n')
+            with self.assertRaises(hexfile.HexFileError):
+                hexfile.read_segments(self.tname('bad.hex'))
+
+    def test_image(self):
+        """Images are the same through both codecs"""
+        self.intelhex_file([(0x10000400, self.data(3000))], 'in.hex')
+        for sparse in (False, True):
+            outputs = []
+            for fast_hex in (False, True):
+                img = Image(version=decode_version('1.2.3'),
+                            header_size=0x400, pad_header=True, pad=True,
+                            align=8, slot_size=0x10000)
+                img.load(self.tname('in.hex'), fast_hex=fast_hex)
+                img.create(None, None)
+                img.save(self.tname('out.hex'), sparse=sparse,
+                         fast_hex=fast_hex)
+                with open(self.tname('out.hex')) as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
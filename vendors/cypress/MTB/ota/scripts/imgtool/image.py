@@ -18,10 +18,14 @@
 Image signing and management.
 """
 
+from . import hexfile
 from . import version as versmod
 from enum import Enum
 from intelhex import IntelHex
+import functools
 import hashlib
+import mmap
+import re
 import struct
 import os.path
 from .keys import rsa, ecdsa
@@ -41,6 +45,16 @@ DEFAULT_MAX_SECTORS = 128
 MAX_ALIGN = 8
 DEP_IMAGES_KEY = "images"
 DEP_VERSIONS_KEY = "versions"
+# Encrypt the image this many bytes at a time, so that encryption
+# needs one chunk of memory on top of the image.
+ENCRYPT_CHUNK_SIZE = 64 * 1024
+# Smallest block of erased flash cached for padding
+ERASED_BLOCK_MIN = 4 * 1024
+ERASED_BLOCK_MAX = 64 * 1024
+# Size of the blocks of zeros left as holes by sparse binary output
+SPARSE_BLOCK_SIZE = 4 * 1024
+# Shortest run of erased flash left out of sparse Intel HEX output
+SPARSE_HEX_MIN_RUN = 64
 
 # Image header flags.
 IMAGE_F = {
@@ -68,6 +82,12 @@ TLV_INFO_SIZE = 4
 TLV_INFO_MAGIC = 0x6907
 TLV_PROT_INFO_MAGIC = 0x6908
 
+# Layouts read back by verify, in native byte order
+IMAGE_HEADER_STRUCT = struct.Struct('IIHHI')
+IMAGE_VERSION_STRUCT = struct.Struct('BBHI')
+TLV_INFO_STRUCT = struct.Struct('HH')
+TLV_STRUCT = struct.Struct('BBH')
+
 boot_magic = bytes([
     0x77, 0xc2, 0x95, 0xf3,
     0x60, 0xd2, 0xef, 0x7f,
@@ -86,6 +106,27 @@ VerifyResult = Enum('VerifyResult',
                     """)
 
 
+@functools.lru_cache(maxsize=16)
+def _erased_block(erased_val, size_class):
+    return bytes([erased_val]) * size_class
+
+
+def erased_bytes(erased_val, size):
+    """
+    Return a view of size bytes of erased flash.  The view is of a block
+    cached per erased value and power of two size, so padding many images
+    allocates the block once.  Blocks larger than ERASED_BLOCK_MAX aren't
+    cached, but built from the largest cached block.
+    """
+    size = max(size, 0)
+    if size > ERASED_BLOCK_MAX:
+        block = _erased_block(erased_val, ERASED_BLOCK_MAX)
+        count, rest = divmod(size, ERASED_BLOCK_MAX)
+        return memoryview(block * count + block[:rest])
+    size_class = max(ERASED_BLOCK_MIN, 1 << (size - 1).bit_length())
+    return memoryview(_erased_block(erased_val, size_class))[:size]
+
+
 class TLV():
     def __init__(self, endian, magic=TLV_INFO_MAGIC):
         self.magic = magic
@@ -132,6 +173,7 @@ class Image():
         self.erased_val = 0xff if erased_val is None else int(erased_val)
         self.payload = []
         self.enckey = None
+        self.digest = None
 
     def __repr__(self):
         return "<Image version={}, header_size={}, base_addr={}, load_addr={}, \
@@ -149,53 +191,126 @@ class Image():
                     self.__class__.__name__,
                     len(self.payload))
 
-    def load(self, path):
-        """Load an image from a given file"""
+    def load(self, path, fast_hex=False):
+        """
+        Load an image from a given file.  Intel HEX files are read with the
+        intelhex package, or with imgtool.hexfile if fast_hex is set.
+        """
         ext = os.path.splitext(path)[1][1:].lower()
         if ext == INTEL_HEX_EXT:
-            ih = IntelHex(path)
-            self.payload = ih.tobinarray()
-            self.base_addr = ih.minaddr()
+            if fast_hex:
+                self.base_addr, self.payload = hexfile.load(path)
+            else:
+                ih = IntelHex(path)
+                self.payload = ih.tobinarray()
+                self.base_addr = ih.minaddr()
+            # Add the image header if needed.
+            if self.pad_header and self.header_size > 0:
+                if self.base_addr:
+                    # Adjust base_addr for new header
+                    self.base_addr -= self.header_size
+                payload = bytearray(erased_bytes(self.erased_val,
+                                                 self.header_size))
+                payload += self.payload
+                self.payload = payload
         else:
-            with open(path, 'rb') as f:
-                self.payload = f.read()
-
-        # Add the image header if needed.
-        if self.pad_header and self.header_size > 0:
-            if self.base_addr:
-                # Adjust base_addr for new header
-                self.base_addr -= self.header_size
-            self.payload = bytes([self.erased_val] * self.header_size) + \
-                self.payload
+            # Read the file straight into the payload, after room for the
+            # image header if needed, to avoid copying the image.
+            pad = self.header_size if self.pad_header else 0
+            self.payload = bytearray(pad + os.path.getsize(path))
+            self.payload[:pad] = erased_bytes(self.erased_val, pad)
+            with open(path, 'rb') as f, memoryview(self.payload) as view:
+                off = pad
+                while off < len(view):
+                    n = f.readinto(view[off:])
+                    if not n:
+                        raise Exception("{} changed while being read".format(path))
+                    off += n
 
         self.check()
 
-    def save(self, path, hex_addr=None):
-        """Save an image from a given file"""
+    def save(self, path, hex_addr=None, sparse=False, fast_hex=False):
+        """
+        Save an image from a given file.  A sparse binary file leaves holes
+        for the blocks of zeros, and a sparse Intel HEX file leaves out the
+        runs of erased flash.  Intel HEX files are written with the intelhex
+        package, or with imgtool.hexfile if fast_hex is set.
+        """
         ext = os.path.splitext(path)[1][1:].lower()
         if ext == INTEL_HEX_EXT:
             # input was in binary format, but HEX needs to know the base addr
             if self.base_addr is None and hex_addr is None:
                 raise Exception("No address exists in input file neither was "
                                 "it provided by user")
-            h = IntelHex()
             if hex_addr is not None:
                 self.base_addr = hex_addr
-            h.frombytes(bytes=self.payload, offset=self.base_addr)
+            if sparse:
+                segments = [(self.base_addr + start, self.payload[start:end])
+                            for start, end in self._unerased_ranges()]
+            else:
+                segments = [(self.base_addr, self.payload)]
             if self.pad:
                 trailer_size = self._trailer_size(self.align, self.max_sectors,
                                                   self.overwrite_only,
                                                   self.enckey)
                 trailer_addr = (self.base_addr + self.slot_size) - trailer_size
-                padding = bytes([self.erased_val] *
-                                (trailer_size - len(boot_magic))) + boot_magic
-                h.puts(trailer_addr, padding)
-            h.tofile(path, 'hex')
+                if sparse:
+                    # Only the magic of the trailer isn't erased flash
+                    segments.append((trailer_addr + trailer_size -
+                                     len(boot_magic), boot_magic))
+                else:
+                    padding = bytes(erased_bytes(
+                        self.erased_val, trailer_size - len(boot_magic)))
+                    segments.append((trailer_addr, padding + boot_magic))
+            if fast_hex:
+                hexfile.save(path, segments)
+            else:
+                h = IntelHex()
+                for addr, data in segments:
+                    h.frombytes(bytes=data, offset=addr)
+                h.tofile(path, 'hex')
         else:
             if self.pad:
                 self.pad_to(self.slot_size)
             with open(path, 'wb') as f:
-                f.write(self.payload)
+                if sparse:
+                    self._write_sparse(f)
+                else:
+                    f.write(self.payload)
+
+    def _unerased_ranges(self):
+        """
+        Return the (start, end) ranges of the payload outside of the runs of
+        at least SPARSE_HEX_MIN_RUN bytes of erased flash.
+        """
+        erased_run = re.compile(b'%s{%d,}' % (
+            re.escape(bytes([self.erased_val])), SPARSE_HEX_MIN_RUN))
+        ranges = []
+        start = 0
+        for run in erased_run.finditer(self.payload):
+            if run.start() > start:
+                ranges.append((start, run.start()))
+            start = run.end()
+        if start < len(self.payload):
+            ranges.append((start, len(self.payload)))
+        return ranges
+
+    def _write_sparse(self, f):
+        """
+        Write the payload to f, seeking over its blocks of zeros.  On file
+        systems supporting holes, these blocks take no space, and they read
+        back as zeros anyway.
+        """
+        zeros = erased_bytes(0, SPARSE_BLOCK_SIZE).tobytes()
+        size = len(self.payload)
+        for off in range(0, size, SPARSE_BLOCK_SIZE):
+            block = self.payload[off:off + SPARSE_BLOCK_SIZE]
+            if block == zeros[:len(block)]:
+                f.seek(len(block), os.SEEK_CUR)
+            else:
+                f.write(block)
+        # Give the file its size if it ends with a hole
+        f.truncate(size)
 
     def check(self):
         """Perform some sanity checking of the image."""
@@ -252,7 +367,6 @@ class Image():
 
         # Protected TLVs must be added first, because they are also included
         # in the hash calculation
-        protected_tlv_off = None
         if protected_tlv_size != 0:
             for i in range(dependencies_num):
                 e = STRUCT_ENDIAN_DICT[self.endian]
@@ -266,16 +380,15 @@ class Image():
                                 )
                 prot_tlv.add('DEPENDENCY', payload)
 
-            protected_tlv_off = len(self.payload)
-            self.payload += prot_tlv.get()
-
         tlv = TLV(self.endian)
 
-        # Note that ecdsa wants to do the hashing itself, which means
-        # we get to hash it twice.
+        # Hash the image and the protected TLVs following it in one pass,
+        # without copying the image.
         sha = hashlib.sha256()
-        sha.update(self.payload)
+        sha.update(memoryview(self.payload))
+        sha.update(prot_tlv.get())
         digest = sha.digest()
+        self.digest = digest
 
         tlv.add('SHA256', digest)
 
@@ -286,20 +399,11 @@ class Image():
             pubbytes = sha.digest()
             tlv.add('KEYHASH', pubbytes)
 
-            # `sign` expects the full image payload (sha256 done internally),
-            # while `sign_digest` expects only the digest of the payload
-
-            if hasattr(key, 'sign'):
-                sig = key.sign(bytes(self.payload))
-            else:
-                sig = key.sign_digest(digest)
+            # All of the keys sign the digest of the payload rather than
+            # hashing the payload again.
+            sig = key.sign_digest(digest)
             tlv.add(key.sig_tlv(), sig)
 
-        # At this point the image was hashed + signed, we can remove the
-        # protected TLVs from the payload (will be re-added later)
-        if protected_tlv_off is not None:
-            self.payload = self.payload[:protected_tlv_off]
-
         if enckey is not None:
             plainkey = os.urandom(16)
 
@@ -318,9 +422,16 @@ class Image():
             cipher = Cipher(algorithms.AES(plainkey), modes.CTR(nonce),
                             backend=default_backend())
             encryptor = cipher.encryptor()
-            img = bytes(self.payload[self.header_size:])
-            self.payload[self.header_size:] = \
-                encryptor.update(img) + encryptor.finalize()
+            # Encrypt in place, one chunk at a time.  CTR mode outputs
+            # as many bytes as it is given.
+            chunk = bytearray(ENCRYPT_CHUNK_SIZE + 15)
+            with memoryview(self.payload) as view, memoryview(chunk) as out:
+                for off in range(self.header_size, len(view),
+                                 ENCRYPT_CHUNK_SIZE):
+                    end = min(off + ENCRYPT_CHUNK_SIZE, len(view))
+                    n = encryptor.update_into(view[off:end], out)
+                    view[off:off + n] = out[:n]
+            encryptor.finalize()
 
         self.payload += prot_tlv.get()
         self.payload += tlv.get()
@@ -357,7 +468,8 @@ class Image():
                 self.version.revision or 0,
                 self.version.build or 0,
                 0)  # Pad1
-        self.payload = bytearray(self.payload)
+        if not isinstance(self.payload, bytearray):
+            self.payload = bytearray(self.payload)
         self.payload[:len(header)] = header
 
     def _trailer_size(self, write_size, max_sectors, overwrite_only, enckey):
@@ -381,56 +493,93 @@ class Image():
         tsize = self._trailer_size(self.align, self.max_sectors,
                                    self.overwrite_only, self.enckey)
         padding = size - (len(self.payload) + tsize)
-        pbytes = bytes([self.erased_val] * padding)
-        pbytes += bytes([self.erased_val] * (tsize - len(boot_magic)))
-        pbytes += boot_magic
-        self.payload += pbytes
+        if not isinstance(self.payload, bytearray):
+            self.payload = bytearray(self.payload)
+        self.payload += erased_bytes(self.erased_val,
+                                     max(padding, 0) + tsize - len(boot_magic))
+        self.payload += boot_magic
 
     @staticmethod
     def verify(imgfile, key):
         with open(imgfile, "rb") as f:
-            b = f.read()
+            if os.fstat(f.fileno()).st_size < IMAGE_HEADER_SIZE:
+                return VerifyResult.INVALID_MAGIC, None
+            # Map the file rather than read it, the image is only hashed
+            # and the TLVs are only looked up.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                with memoryview(m) as b:
+                    return Image.verify_buffer(b, key)
 
-        magic, _, header_size, _, img_size = struct.unpack('IIHHI', b[:16])
-        version = struct.unpack('BBHI', b[20:28])
+    @staticmethod
+    def verify_buffer(b, key):
+        """Verify the image in the buffer b, without copying it."""
+        if len(b) < IMAGE_HEADER_SIZE:
+            return VerifyResult.INVALID_MAGIC, None
+        magic, _, header_size, prot_tlv_size, img_size = \
+            IMAGE_HEADER_STRUCT.unpack_from(b)
+        version = IMAGE_VERSION_STRUCT.unpack_from(b, 20)
 
         if magic != IMAGE_MAGIC:
             return VerifyResult.INVALID_MAGIC, None
 
-        tlv_info = b[header_size+img_size:header_size+img_size+TLV_INFO_SIZE]
-        magic, tlv_tot = struct.unpack('HH', tlv_info)
-        if magic != TLV_INFO_MAGIC:
+        # The hash covers the header, the image and the protected TLVs
+        hash_end = header_size + img_size + prot_tlv_size
+        tlvs = Image.index_tlvs(b, header_size + img_size)
+        if tlvs is None:
             return VerifyResult.INVALID_TLV_INFO_MAGIC, None
 
         sha = hashlib.sha256()
-        sha.update(b[:header_size+img_size])
-        digest = sha.digest()
+        with b[:hash_end] as payload:
+            sha.update(payload)
+            digest = sha.digest()
 
-        tlv_off = header_size + img_size
-        tlv_end = tlv_off + tlv_tot
-        tlv_off += TLV_INFO_SIZE  # skip tlv info
-        while tlv_off < tlv_end:
-            tlv = b[tlv_off:tlv_off+TLV_SIZE]
-            tlv_type, _, tlv_len = struct.unpack('BBH', tlv)
-            if tlv_type == TLV_VALUES["SHA256"]:
-                off = tlv_off + TLV_SIZE
-                if digest == b[off:off+tlv_len]:
-                    if key is None:
-                        return VerifyResult.OK, version
-                else:
+            for off, tlv_len in tlvs.get(TLV_VALUES["SHA256"], []):
+                if digest != b[off:off+tlv_len]:
                     return VerifyResult.INVALID_HASH, None
-            elif key is not None and tlv_type == TLV_VALUES[key.sig_tlv()]:
-                off = tlv_off + TLV_SIZE
-                tlv_sig = b[off:off+tlv_len]
-                payload = b[:header_size+img_size]
+                if key is None:
+                    return VerifyResult.OK, version
+            if key is None:
+                return VerifyResult.INVALID_SIGNATURE, None
+
+            for off, tlv_len in tlvs.get(TLV_VALUES[key.sig_tlv()], []):
+                tlv_sig = bytes(b[off:off+tlv_len])
                 try:
-                    if hasattr(key, 'verify'):
-                        key.verify(tlv_sig, payload)
-                    else:
+                    if hasattr(key, 'verify_digest'):
                         key.verify_digest(tlv_sig, digest)
+                    else:
+                        key.verify(tlv_sig, payload)
                     return VerifyResult.OK, version
                 except InvalidSignature:
                     # continue to next TLV
                     pass
-            tlv_off += TLV_SIZE + tlv_len
         return VerifyResult.INVALID_SIGNATURE, None
+
+    @staticmethod
+    def index_tlvs(b, tlv_off):
+        """
+        Index the TLVs following the image at tlv_off in one pass.  Returns a
+        dict mapping each TLV type to the (offset, length) of its values, in
+        the protected and then the unprotected TLV area, or None if there is
+        no unprotected TLV area at tlv_off.
+        """
+        tlvs = {}
+        for info_magic in (TLV_PROT_INFO_MAGIC, TLV_INFO_MAGIC):
+            if tlv_off + TLV_INFO_SIZE > len(b):
+                return None
+            magic, tlv_tot = TLV_INFO_STRUCT.unpack_from(b, tlv_off)
+            if magic != info_magic:
+                if info_magic == TLV_INFO_MAGIC:
+                    return None
+                # No protected TLVs
+                continue
+            tlv_end = tlv_off + tlv_tot
+            if tlv_end > len(b):
+                return None
+            tlv_off += TLV_INFO_SIZE  # skip tlv info
+            while tlv_off + TLV_SIZE <= tlv_end:
+                tlv_type, _, tlv_len = TLV_STRUCT.unpack_from(b, tlv_off)
+                tlv_off += TLV_SIZE
+                tlvs.setdefault(tlv_type, []).append((tlv_off, tlv_len))
+                tlv_off += tlv_len
+            tlv_off = tlv_end
+        return tlvs
@@ -35,6 +35,10 @@ def load(path, passwd=None):
     """Try loading a key from the given path.  Returns None if the password wasn't specified."""
     with open(path, 'rb') as f:
         raw_pem = f.read()
+    return load_pem(raw_pem, passwd)
+
+def load_pem(raw_pem, passwd=None):
+    """Try loading a key from PEM data.  Returns None if the password wasn't specified."""
     try:
         pk = serialization.load_pem_private_key(
                 raw_pem,
@@ -80,3 +84,14 @@ def load(path, passwd=None):
         return Ed25519Public(pk)
     else:
         raise Exception("Unknown key type: " + str(type(pk)))
+
+def dump_pem(key):
+    """Return the unencrypted PEM data of a key, as read back by load_pem."""
+    if hasattr(key.key, 'private_bytes'):
+        return key.key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption())
+    return key.key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo)
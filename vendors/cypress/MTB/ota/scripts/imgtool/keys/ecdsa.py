@@ -4,7 +4,7 @@ ECDSA key management
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import ec, utils
 from cryptography.hazmat.primitives.hashes import SHA256
 
 from .general import KeyClass
@@ -64,6 +64,17 @@ class ECDSA256P1Public(KeyClass):
         return k.verify(signature=signature, data=payload,
                         signature_algorithm=ec.ECDSA(SHA256()))
 
+    def verify_digest(self, signature, digest):
+        """Verify that signature is valid for the SHA256 digest of a payload"""
+        k = self.key
+        if isinstance(self.key, ec.EllipticCurvePrivateKey):
+            k = self.key.public_key()
+        # Drop the zeros padding the signature to sig_len(), after the
+        # DER sequence.
+        signature = signature[:signature[1] + 2]
+        return k.verify(signature=signature, data=digest,
+                        signature_algorithm=ec.ECDSA(utils.Prehashed(SHA256())))
+
 
 class ECDSA256P1(ECDSA256P1Public):
     """
@@ -108,3 +119,16 @@ class ECDSA256P1(ECDSA256P1Public):
         sig = self.raw_sign(payload)
         sig += b'\000' * (self.sig_len() - len(sig))
         return sig
+
+    def raw_sign_digest(self, digest):
+        """Return the actual signature of the SHA256 digest of a payload"""
+        return self.key.sign(
+                data=digest,
+                signature_algorithm=ec.ECDSA(utils.Prehashed(SHA256())))
+
+    def sign_digest(self, digest):
+        """Sign the SHA256 digest of a payload, the same as sign(payload)
+        without hashing the payload again."""
+        sig = self.raw_sign_digest(digest)
+        sig += b'\000' * (self.sig_len() - len(sig))
+        return sig
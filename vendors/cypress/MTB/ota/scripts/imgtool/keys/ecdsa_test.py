@@ -2,6 +2,7 @@
 Tests for ECDSA keys
 """
 
+import hashlib
 import io
 import os.path
 import sys
@@ -95,5 +96,20 @@ class EcKeyGeneration(unittest.TestCase):
                 data=b'This is thE message',
                 signature_algorithm=ec.ECDSA(SHA256()))
 
+    def test_sig_digest(self):
+        k = ECDSA256P1.generate()
+        buf = b'This is the message'
+        sig = k.sign_digest(hashlib.sha256(buf).digest())
+        self.assertEqual(len(sig), k.sig_len())
+
+        # The signature of the digest is the signature of the message.
+        k.verify(sig[:sig[1] + 2], buf)
+        k.verify_digest(sig, hashlib.sha256(buf).digest())
+
+        self.assertRaises(InvalidSignature,
+                k.verify_digest,
+                sig,
+                hashlib.sha256(b'This is thE message').digest())
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,7 @@ RSA Key management
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, utils
 from cryptography.hazmat.primitives.asymmetric.padding import PSS, MGF1
 from cryptography.hazmat.primitives.hashes import SHA256
 
@@ -70,6 +70,15 @@ class RSAPublic(KeyClass):
                         padding=PSS(mgf=MGF1(SHA256()), salt_length=32),
                         algorithm=SHA256())
 
+    def verify_digest(self, signature, digest):
+        """Verify that signature is valid for the SHA256 digest of a payload"""
+        k = self.key
+        if isinstance(self.key, rsa.RSAPrivateKey):
+            k = self.key.public_key()
+        return k.verify(signature=signature, data=digest,
+                        padding=PSS(mgf=MGF1(SHA256()), salt_length=32),
+                        algorithm=utils.Prehashed(SHA256()))
+
 
 class RSA(RSAPublic):
     """
@@ -115,3 +124,11 @@ class RSA(RSAPublic):
                 data=payload,
                 padding=PSS(mgf=MGF1(SHA256()), salt_length=32),
                 algorithm=SHA256())
+
+    def sign_digest(self, digest):
+        """Sign the SHA256 digest of a payload, the same as sign(payload)
+        without hashing the payload again."""
+        return self.key.sign(
+                data=digest,
+                padding=PSS(mgf=MGF1(SHA256()), salt_length=32),
+                algorithm=utils.Prehashed(SHA256()))
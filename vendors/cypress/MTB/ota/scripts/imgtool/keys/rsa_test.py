@@ -2,6 +2,7 @@
 Tests for RSA keys
 """
 
+import hashlib
 import io
 import os
 import sys
@@ -110,6 +111,21 @@ class KeyGeneration(unittest.TestCase):
                               padding=PSS(mgf=MGF1(SHA256()), salt_length=32),
                               algorithm=SHA256())
 
+    def test_sig_digest(self):
+        for key_size in RSA_KEY_SIZES:
+            k = RSA.generate(key_size=key_size)
+            buf = b'This is the message'
+            sig = k.sign_digest(hashlib.sha256(buf).digest())
+
+            # The signature of the digest is the signature of the message.
+            k.verify(sig, buf)
+            k.verify_digest(sig, hashlib.sha256(buf).digest())
+
+            self.assertRaises(InvalidSignature,
+                              k.verify_digest,
+                              sig,
+                              hashlib.sha256(b'This is thE message').digest())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -17,9 +17,14 @@
 
 import re
 import click
+import concurrent.futures
+import fnmatch
 import getpass
 import imgtool.keys as keys
+import json
+import os
 import sys
+import time
 from imgtool import image, imgtool_version
 from imgtool.version import decode_version
 
@@ -77,6 +82,16 @@ def get_password():
     return passwd.encode('utf-8')
 
 
+# Keys of a batch, by key file, in the processes creating or verifying the
+# images
+batch_keys = {}
+
+
+def init_batch_process(key_pems):
+    for keyfile, pem in key_pems.items():
+        batch_keys[keyfile] = keys.load_pem(pem)
+
+
 @click.option('-p', '--password', is_flag=True,
               help='Prompt for password to protect key')
 @click.option('-t', '--type', metavar='type', required=True,
@@ -127,6 +142,63 @@ def verify(key, imgfile):
     sys.exit(1)
 
 
+def verify_batch_image(imgfile, keyfile):
+    """Verify an image of a batch, and return its report."""
+    start = time.perf_counter()
+    ret, version = image.Image.verify(imgfile, batch_keys.get(keyfile))
+    report = {'imgfile': imgfile, 'result': ret.name}
+    if ret == image.VerifyResult.OK:
+        report['version'] = "{}.{}.{}+{}".format(*version)
+    report['seconds'] = round(time.perf_counter() - start, 6)
+    return report
+
+
+@click.option('-r', '--report', metavar='filename',
+              help='Also write a JSON report to this file')
+@click.option('-j', '--jobs', type=int, default=os.cpu_count(),
+              help='Verify this many images at a time (defaults to the '
+                   'number of CPUs)')
+@click.option('-p', '--pattern', default='*', show_default=True,
+              help='Only verify the files matching this pattern')
+@click.argument('imgdir', type=click.Path(exists=True, file_okay=False))
+@click.option('-k', '--key', metavar='filename')
+@click.command('verify-dir',
+               help="Check that all signed images in IMGDIR can be verified "
+                    "by given key")
+def verify_dir(key, imgdir, pattern, jobs, report):
+    imgfiles = sorted(entry.path for entry in os.scandir(imgdir)
+                      if entry.is_file() and fnmatch.fnmatch(entry.name,
+                                                             pattern))
+    start = time.perf_counter()
+    if key:
+        batch_keys[key] = load_key(key)
+    jobs = max(1, min(jobs, len(imgfiles)))
+    if jobs == 1:
+        results = [verify_batch_image(imgfile, key) for imgfile in imgfiles]
+    else:
+        key_pems = {keyfile: keys.dump_pem(k)
+                    for keyfile, k in batch_keys.items()}
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_batch_process,
+                initargs=(key_pems,)) as executor:
+            results = list(executor.map(verify_batch_image, imgfiles,
+                                        [key] * len(imgfiles)))
+    failed = [result for result in results if result['result'] != 'OK']
+    for result in results:
+        print("{}: {} {}".format(result['imgfile'], result['result'],
+                                 result.get('version', '')).rstrip())
+    print("{} of {} images verified in {:.3f}s".format(
+        len(results) - len(failed), len(results),
+        time.perf_counter() - start))
+    if report:
+        with click.open_file(report, 'w') as f:
+            json.dump({'images': results, 'failed': len(failed),
+                       'jobs': jobs}, f, indent=2)
+            f.write('\n')
+    if failed:
+        sys.exit(1)
+
+
 def validate_version(ctx, param, value):
     try:
         decode_version(value)
@@ -185,6 +257,12 @@ class BasedIntParamType(click.ParamType):
 @click.option('-R', '--erased-val', type=click.Choice(['0', '0xff']),
               required=False,
               help='The value that is read back from erased flash.')
+@click.option('--fast-hex', default=False, is_flag=True,
+              help='Read and write HEX files with the built-in codec '
+                   'instead of the intelhex package')
+@click.option('--sparse', default=False, is_flag=True,
+              help='Leave holes for the blocks of zeros in binary OUTFILE, '
+                   'or leave out the erased flash in HEX OUTFILE')
 @click.option('-x', '--hex-addr', type=BasedIntParamType(), required=False,
               help='Adjust address in hex output file.')
 @click.option('-L', '--load-addr', type=BasedIntParamType(), required=False,
@@ -217,15 +295,29 @@ class BasedIntParamType(click.ParamType):
                .hex extension, otherwise binary format is used''')
 def sign(key, align, version, header_size, pad_header, slot_size, pad,
          max_sectors, overwrite_only, endian, encrypt, infile, outfile,
-         dependencies, load_addr, hex_addr, erased_val):
-    img = image.Image(version=decode_version(version), header_size=header_size,
-                      pad_header=pad_header, pad=pad, align=int(align),
+         dependencies, load_addr, hex_addr, erased_val, sparse, fast_hex):
+    key = load_key(key) if key else None
+    enckey = load_key(encrypt) if encrypt else None
+    create_image(key, enckey, infile, outfile, align=int(align),
+                 version=decode_version(version), header_size=header_size,
+                 pad_header=pad_header, slot_size=slot_size, pad=pad,
+                 max_sectors=max_sectors, overwrite_only=overwrite_only,
+                 endian=endian, dependencies=dependencies,
+                 load_addr=load_addr, hex_addr=hex_addr,
+                 erased_val=erased_val, sparse=sparse, fast_hex=fast_hex)
+
+
+def create_image(key, enckey, infile, outfile, align, version, header_size,
+                 pad_header, slot_size, pad, max_sectors, overwrite_only,
+                 endian, dependencies, load_addr, hex_addr, erased_val,
+                 sparse=False, fast_hex=False):
+    """Create the image OUTFILE from INFILE, and return it."""
+    img = image.Image(version=version, header_size=header_size,
+                      pad_header=pad_header, pad=pad, align=align,
                       slot_size=slot_size, max_sectors=max_sectors,
                       overwrite_only=overwrite_only, endian=endian,
                       load_addr=load_addr, erased_val=erased_val)
-    img.load(infile)
-    key = load_key(key) if key else None
-    enckey = load_key(encrypt) if encrypt else None
+    img.load(infile, fast_hex)
     if enckey and key:
         if ((isinstance(key, keys.ECDSA256P1) and
              not isinstance(enckey, keys.ECDSA256P1Public))
@@ -234,7 +326,144 @@ def sign(key, align, version, header_size, pad_header, slot_size, pad,
             # FIXME
             raise Exception("Signing and encryption must use the same type of key")
     img.create(key, enckey, dependencies)
-    img.save(outfile, hex_addr)
+    img.save(outfile, hex_addr, sparse, fast_hex)
+    return img
+
+
+# Options of an image in a batch manifest, with the defaults of sign
+BATCH_OPTIONS = {
+    'key': None,
+    'encrypt': None,
+    'align': None,
+    'version': None,
+    'header_size': None,
+    'pad_header': False,
+    'slot_size': None,
+    'pad': False,
+    'max_sectors': None,
+    'overwrite_only': False,
+    'endian': 'little',
+    'dependencies': None,
+    'load_addr': None,
+    'hex_addr': None,
+    'erased_val': None,
+    'sparse': False,
+    'fast_hex': False,
+}
+
+
+def based_int(value):
+    if value is None or isinstance(value, int):
+        return value
+    return BasedIntParamType().convert(str(value), None, None)
+
+
+def get_batch_image(defaults, entry):
+    """Return the arguments of create_image for an image of a manifest."""
+    opts = dict(BATCH_OPTIONS, infile=None, outfile=None)
+    unknown = (set(defaults) | set(entry)) - set(opts)
+    if unknown:
+        raise click.BadParameter(
+            "Unknown manifest options: {}".format(", ".join(sorted(unknown))))
+    opts.update(defaults)
+    opts.update(entry)
+    for name in ('infile', 'outfile', 'version', 'header_size', 'slot_size',
+                 'align'):
+        if opts[name] is None:
+            raise click.BadParameter("Missing manifest option: {}".format(name))
+    try:
+        opts['version'] = decode_version(str(opts['version']))
+    except ValueError as e:
+        raise click.BadParameter("{}".format(e))
+    for name in ('header_size', 'slot_size', 'max_sectors', 'load_addr',
+                 'hex_addr'):
+        opts[name] = based_int(opts[name])
+    validate_header_size(None, None, opts['header_size'])
+    opts['align'] = int(opts['align'])
+    if opts['align'] not in (1, 2, 4, 8):
+        raise click.BadParameter("Invalid align: {}".format(opts['align']))
+    if opts['endian'] not in ('little', 'big'):
+        raise click.BadParameter("Invalid endian: {}".format(opts['endian']))
+    if opts['erased_val'] is not None:
+        if str(opts['erased_val']) not in ('0', '0xff'):
+            raise click.BadParameter(
+                "Invalid erased_val: {}".format(opts['erased_val']))
+        opts['erased_val'] = int(str(opts['erased_val']), 0)
+    opts['dependencies'] = get_dependencies(None, None, opts['dependencies'])
+    return opts
+
+
+def create_batch_image(opts):
+    """Create an image of a batch, and return its report."""
+    opts = dict(opts)
+    key = batch_keys.get(opts.pop('key'))
+    enckey = batch_keys.get(opts.pop('encrypt'))
+    report = {'infile': opts['infile'], 'outfile': opts['outfile']}
+    start = time.perf_counter()
+    try:
+        img = create_image(key, enckey, **opts)
+    except Exception as e:
+        report['error'] = "{}".format(e)
+    else:
+        report['digest'] = img.digest.hex()
+        report['size'] = os.path.getsize(opts['outfile'])
+    report['seconds'] = round(time.perf_counter() - start, 6)
+    return report
+
+
+@click.option('-r', '--report', metavar='filename', default='-',
+              help='Write the JSON report to this file (defaults to stdout)')
+@click.option('-j', '--jobs', type=int, default=os.cpu_count(),
+              help='Create this many images at a time (defaults to the '
+                   'number of CPUs)')
+@click.argument('manifest', type=click.File('r'))
+@click.command(help='''Create many signed or unsigned images\n
+               MANIFEST is a JSON file with an "images" list, each image an
+               object with the options of sign, e.g. "infile", "outfile",
+               "version", "slot_size" and "dependencies", and an optional
+               "defaults" object with the options shared by the images.
+               Each key is loaded once, and the images are created in
+               parallel.''')
+def batch(manifest, jobs, report):
+    try:
+        batch_manifest = json.load(manifest)
+        defaults = batch_manifest.get('defaults', {})
+        images = [get_batch_image(defaults, entry)
+                  for entry in batch_manifest['images']]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise click.BadParameter("Invalid manifest: {}".format(e))
+    start = time.perf_counter()
+    keyfiles = {opts[name] for opts in images for name in ('key', 'encrypt')}
+    keyfiles.discard(None)
+    for keyfile in sorted(keyfiles):
+        batch_keys[keyfile] = load_key(keyfile)
+    load_seconds = time.perf_counter() - start
+    jobs = max(1, min(jobs, len(images)))
+    if jobs == 1:
+        results = [create_batch_image(opts) for opts in images]
+    else:
+        key_pems = {keyfile: keys.dump_pem(key)
+                    for keyfile, key in batch_keys.items()}
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_batch_process,
+                initargs=(key_pems,)) as executor:
+            results = list(executor.map(create_batch_image, images))
+    failed = [result for result in results if 'error' in result]
+    summary = {
+        'images': results,
+        'failed': len(failed),
+        'jobs': jobs,
+        'key_load_seconds': round(load_seconds, 6),
+        'seconds': round(time.perf_counter() - start, 6),
+    }
+    with click.open_file(report, 'w') as f:
+        json.dump(summary, f, indent=2)
+        f.write('\n')
+    for result in failed:
+        print("{}: {}".format(result['infile'], result['error']),
+              file=sys.stderr)
+    if failed:
+        sys.exit(1)
 
 
 class AliasesGroup(click.Group):
@@ -271,7 +500,9 @@ def imgtool():
 imgtool.add_command(keygen)
 imgtool.add_command(getpub)
 imgtool.add_command(verify)
+imgtool.add_command(verify_dir)
 imgtool.add_command(sign)
+imgtool.add_command(batch)
 imgtool.add_command(version)
 
 
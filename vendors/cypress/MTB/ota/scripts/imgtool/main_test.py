@@ -0,0 +1,177 @@
+"""
+Tests for the commands creating and verifying many images
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+# Setup sys path so 'imgtool' is in it.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from imgtool import image
+from imgtool.keys import ECDSA256P1, load
+from imgtool.main import create_image, imgtool
+from imgtool.version import decode_version
+
+
+class Batch(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.key = self.tname('key.pem')
+        ECDSA256P1.generate().export_private(self.key)
+        for i in range(3):
+            with open(self.tname('in{}.bin'.format(i)), 'wb') as f:
+                f.write(os.urandom(1000 + i))
+
+    def tname(self, base):
+        return os.path.join(self.test_dir.name, base)
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def write_manifest(self, images):
+        manifest = {
+            'defaults': {
+                'key': self.key,
+                'version': '1.2.3',
+                'header_size': '0x200',
+                'pad_header': True,
+                'slot_size': '0x10000',
+                'align': 4,
+            },
+            'images': images,
+        }
+        with open(self.tname('manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        return self.tname('manifest.json')
+
+    def batch(self, images, jobs):
+        result = CliRunner().invoke(
+            imgtool, ['batch', '--jobs', str(jobs),
+                      '--report', self.tname('report.json'),
+                      self.write_manifest(images)])
+        with open(self.tname('report.json')) as f:
+            return result, json.load(f)
+
+    def test_batch(self):
+        images = [{'infile': self.tname('in{}.bin'.format(i)),
+                   'outfile': self.tname('out{}.bin'.format(i))}
+                  for i in range(3)]
+        images[2]['version'] = '2.0.0'
+        for jobs in (1, 2):
+            result, report = self.batch(images, jobs)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(report['failed'], 0)
+            self.assertEqual(report['jobs'], jobs)
+            self.assertEqual([r['outfile'] for r in report['images']],
+                             [entry['outfile'] for entry in images])
+            for entry, version in zip(images, ['1.2.3', '1.2.3', '2.0.0']):
+                ret, img_version = image.Image.verify(entry['outfile'],
+                                                      load(self.key))
+                self.assertEqual(ret, image.VerifyResult.OK)
+                self.assertEqual("{}.{}.{}".format(*img_version[:3]),
+                                 version)
+
+    def test_batch_failure(self):
+        images = [{'infile': self.tname('in0.bin'),
+                   'outfile': self.tname('out0.bin')},
+                  {'infile': self.tname('missing.bin'),
+                   'outfile': self.tname('out1.bin')}]
+        for jobs in (1, 2):
+            result, report = self.batch(images, jobs)
+            self.assertEqual(result.exit_code, 1)
+            self.assertEqual(report['failed'], 1)
+            self.assertNotIn('error', report['images'][0])
+            self.assertIn('error', report['images'][1])
+            self.assertTrue(os.path.isfile(self.tname('out0.bin')))
+
+    def test_batch_invalid_manifest(self):
+        result = CliRunner().invoke(
+            imgtool, ['batch', self.write_manifest([{'infile': 'in.bin'}])])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('Missing manifest option: outfile', result.output)
+
+
+class VerifyDir(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.key = self.tname('key.pem')
+        ECDSA256P1.generate().export_private(self.key)
+        self.img_dir = self.tname('images')
+        os.mkdir(self.img_dir)
+        with open(self.tname('in.bin'), 'wb') as f:
+            f.write(os.urandom(1000))
+        for name in ['good0.bin', 'good1.bin', 'hash.bin', 'magic.bin']:
+            create_image(load(self.key), None, self.tname('in.bin'),
+                         os.path.join(self.img_dir, name), align=4,
+                         version=decode_version('1.2.3'), header_size=0x200,
+                         pad_header=True, slot_size=0x10000, pad=False,
+                         max_sectors=None, overwrite_only=False,
+                         endian='little', dependencies=None, load_addr=None,
+                         hex_addr=None, erased_val=None)
+        # Corrupt the payload of one image, and the header of another
+        self.corrupt('hash.bin', 0x300)
+        self.corrupt('magic.bin', 0)
+
+    def tname(self, base):
+        return os.path.join(self.test_dir.name, base)
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def corrupt(self, name, offset):
+        with open(os.path.join(self.img_dir, name), 'r+b') as f:
+            f.seek(offset)
+            data = f.read(1)
+            f.seek(offset)
+            f.write(bytes([data[0] ^ 0xff]))
+
+    def verify_dir(self, *args):
+        result = CliRunner().invoke(
+            imgtool, ['verify-dir', '--key', self.key,
+                      '--report', self.tname('report.json')] + list(args) +
+            [self.img_dir])
+        with open(self.tname('report.json')) as f:
+            return result, json.load(f)
+
+    def test_verify_dir(self):
+        expected = {
+            'good0.bin': 'OK',
+            'good1.bin': 'OK',
+            'hash.bin': 'INVALID_HASH',
+            'magic.bin': 'INVALID_MAGIC',
+        }
+        for jobs in (1, 2):
+            result, report = self.verify_dir('--jobs', str(jobs))
+            self.assertEqual(result.exit_code, 1)
+            self.assertEqual(report['failed'], 2)
+            self.assertEqual(report['jobs'], jobs)
+            self.assertEqual({os.path.basename(r['imgfile']): r['result']
+                              for r in report['images']}, expected)
+            self.assertEqual(report['images'][0]['version'], '1.2.3+0')
+            self.assertIn('2 of 4 images verified', result.output)
+
+    def test_verify_dir_pattern(self):
+        result, report = self.verify_dir('--pattern', 'good*')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(len(report['images']), 2)
+
+    def test_verify_dir_wrong_key(self):
+        ECDSA256P1.generate().export_private(self.key)
+        result, report = self.verify_dir('--pattern', 'good*')
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual([r['result'] for r in report['images']],
+                         ['INVALID_SIGNATURE'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,7 @@ setuptools.setup(
     url="http://github.com/JuulLabs-OSS/mcuboot",
     packages=setuptools.find_packages(),
     install_requires=[
-        'cryptography>=2.4.2',
+        'cryptography>=2.6',
         'intelhex>=2.2.1',
         'click',
     ],